@@ -0,0 +1,340 @@
+# Воспроизводимый бенчмарк бота: настоящие обработчики, поддельный транспорт Telegram.
+#
+#   python benchmark.py                          # словари на 400, 10k и 100k глаголов, все сценарии
+#   python benchmark.py --sizes 400 --ops 500    # быстрый прогон
+#   python benchmark.py --compare old.json       # сравнить с прошлым результатом
+#
+# Каждый размер словаря прогоняется в отдельном процессе со своим временным каталогом данных,
+# чтобы старт, снимок и база SQLite создавались с нуля. Результаты сохраняются в JSON.
+import argparse
+import asyncio
+import csv
+import importlib.util
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+BOT_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'python-telegram-bot.py')
+VERBS_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '1_norwegian_verbs.csv')
+SCENARIOS = ['search', 'suggest', 'admin_add', 'start_burst', 'mixed']
+
+
+# Транспорт без сети: отвечает на методы Bot API так, как ответил бы Telegram
+class FakeTelegramRequest(BaseRequest):
+    def __init__(self):
+        self.calls = 0
+        self.message_id = 0
+
+    @property
+    def read_timeout(self):
+        return 5
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        self.calls += 1
+        name = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if name == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif name in ('sendMessage', 'editMessageText'):
+            self.message_id += 1
+            result = {'message_id': self.message_id, 'date': int(time.time()),
+                      'chat': {'id': params.get('chat_id', 1), 'type': 'private'}, 'text': params.get('text', '')}
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+# Генерация словаря: настоящие глаголы, дополненные синтетическими слабыми глаголами
+SYLLABLES = ['ba', 'de', 'fi', 'go', 'ha', 'ke', 'li', 'mo', 'nu', 'pa', 're', 'si', 'to', 've', 'sk', 'tr', 'bl',
+             'sp', 'fr', 'gl', 'kn', 'st', 'dr', 'øy', 'æl', 'år']
+RUSSIAN_SYLLABLES = ['ра', 'бо', 'ви', 'де', 'ло', 'ме', 'ну', 'пи', 'со', 'ту', 'ка', 'жи', 'зо', 'чи']
+
+
+def generate_dictionary(size, path, seed):
+    with open(VERBS_SOURCE, encoding='utf-8', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = [row for row in reader if row][:size]
+    rng = random.Random(seed)
+    seen = {row[0] for row in rows}
+    while len(rows) < size:
+        stem = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+        if f'å {stem}e' in seen:
+            continue
+        seen.add(f'å {stem}e')
+        if rng.random() < 0.5:
+            forms = [f'{stem}er', f'{stem}et', f'har {stem}et']
+        else:
+            forms = [f'{stem}er', f'{stem}te', f'har {stem}t']
+        translation = ''.join(rng.choice(RUSSIAN_SYLLABLES) for _ in range(rng.randint(2, 4))) + 'ть'
+        rows.append([f'å {stem}e', *forms, translation])
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+    return rows
+
+
+def load_bot(workdir):
+    os.chdir(workdir)
+    os.environ.setdefault('TOKEN', '123456:benchmark')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    spec = importlib.util.spec_from_file_location('verbbot', BOT_SOURCE)
+    bot = importlib.util.module_from_spec(spec)
+    sys.modules['verbbot'] = bot
+    spec.loader.exec_module(bot)
+    return bot
+
+
+# Построение обновлений. Операция - последовательность обновлений одного пользователя
+class UpdateFactory:
+    def __init__(self, rows, seed, admin_id):
+        self.rows = rows
+        self.admin_id = admin_id
+        self.rng = random.Random(seed)
+        self.update_id = 0
+        self.new_user_id = 10_000_000
+
+    def message(self, user_id, text):
+        self.update_id += 1
+        data = {'update_id': self.update_id,
+                'message': {'message_id': self.update_id, 'date': 0, 'text': text,
+                            'chat': {'id': user_id, 'type': 'private'},
+                            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Bench', 'username': f'u{user_id}'}}}
+        if text.startswith('/'):
+            data['message']['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return data
+
+    def regular_user(self):
+        return self.rng.randint(1, 5000)
+
+    def search_query(self):
+        row = self.rng.choice(self.rows)
+        kind = self.rng.random()
+        if kind < 0.5:
+            return self.rng.choice(row[:4]).replace('å ', '').replace('har ', '')
+        if kind < 0.7:
+            word = row[0][2:]
+            return word[:self.rng.randint(3, max(3, len(word)))]
+        if kind < 0.8:
+            return row[4].split(',')[0][:6]
+        if kind < 0.9:
+            word = list(row[1])
+            position = self.rng.randrange(len(word))
+            word[position] = self.rng.choice('abdeiklnorst')
+            return ''.join(word)
+        return ''.join(self.rng.choice('xyzqw') for _ in range(6))
+
+    def search(self):
+        return [self.message(self.regular_user(), self.search_query())]
+
+    def suggest(self):
+        user_id = self.regular_user()
+        stem = ''.join(self.rng.choice(SYLLABLES) for _ in range(3))
+        return [self.message(user_id, 'Legg til ord'),
+                self.message(user_id, f'å {stem}e, {stem}er, {stem}te, har {stem}t, предложение')]
+
+    def admin_add(self, batch=50):
+        lines = []
+        for _ in range(batch):
+            stem = ''.join(self.rng.choice(SYLLABLES) for _ in range(4))
+            lines.append(f'å {stem}e, {stem}er, {stem}et, har {stem}et, добавлено')
+        return [self.message(self.admin_id, 'Добавить'), self.message(self.admin_id, '\n'.join(lines))]
+
+    def start_burst(self):
+        self.new_user_id += 1
+        return [self.message(self.new_user_id, '/start')]
+
+    def scenario(self, name, ops):
+        if name != 'mixed':
+            return [getattr(self, name)() for _ in range(ops)]
+        weights = [('search', 0.75), ('suggest', 0.05), ('admin_add', 0.01), ('start_burst', 0.19)]
+        names, probabilities = zip(*weights)
+        return [getattr(self, self.rng.choices(names, probabilities)[0])() for _ in range(ops)]
+
+
+def disk_bytes_written():
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+async def replay(app, operations, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def run_operation(updates):
+        async with semaphore:
+            for data in updates:
+                update = Update.de_json(data, app.bot)
+                started = time.perf_counter()
+                await app.update_processor.process_update(update, app.process_update(update))
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run_operation(updates) for updates in operations))
+    return time.perf_counter() - started, latencies
+
+
+async def run_scenarios(bot, state, rows, args):
+    request = FakeTelegramRequest()
+    app = bot.build_application(state, request=request, get_updates_request=FakeTelegramRequest())
+    await app.initialize()
+    await app.update_processor.initialize()
+    results = {}
+    for index, name in enumerate(args.scenarios):
+        factory = UpdateFactory(rows, args.seed + index, min(bot.ADMIN_IDS))
+        ops = args.ops if name != 'admin_add' else max(1, args.ops // 50)
+        operations = factory.scenario(name, ops)
+        traced = factory.scenario(name, max(1, ops // 10))
+        calls_before = request.calls
+        written_before = disk_bytes_written()
+        size_before = directory_size(os.getcwd())
+        elapsed, latencies = await replay(app, operations, args.concurrency)
+        await bot.flush_contacts(app)
+        written_after = disk_bytes_written()
+        size_after = directory_size(os.getcwd())
+        # Выделения памяти меряются отдельным, меньшим прогоном: tracemalloc заметно замедляет код
+        tracemalloc.start()
+        snapshot_before = tracemalloc.take_snapshot()
+        await replay(app, traced, args.concurrency)
+        snapshot_after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        allocated = sum(stat.size_diff for stat in snapshot_after.compare_to(snapshot_before, 'filename')
+                        if stat.size_diff > 0)
+        traced_updates = sum(len(updates) for updates in traced)
+        latencies.sort()
+        results[name] = {
+            'operations': len(operations),
+            'updates': len(latencies),
+            'api_calls': request.calls - calls_before,
+            'seconds': round(elapsed, 4),
+            'updates_per_second': round(len(latencies) / elapsed, 1) if elapsed else None,
+            'latency_ms': {label: round(percentile(latencies, fraction) * 1000, 3)
+                           for label, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99), ('max', 1.0))},
+            'retained_bytes_per_update': round(allocated / traced_updates) if traced_updates else 0,
+            'traced_peak_bytes': peak,
+            'disk_bytes_written': (written_after - written_before) if written_before is not None else None,
+            'data_dir_growth_bytes': size_after - size_before,
+        }
+    await app.update_processor.shutdown()
+    await app.shutdown()
+    return results
+
+
+def run_worker(args):
+    workdir = tempfile.mkdtemp(prefix='verbbot-bench-')
+    try:
+        rows = generate_dictionary(args.size, os.path.join(workdir, '1_norwegian_verbs.csv'), args.seed)
+        started = time.perf_counter()
+        bot = load_bot(workdir)
+        state = bot.load_state()
+        startup = time.perf_counter() - started
+        result = {
+            'size': args.size,
+            'startup_seconds': round(startup, 4),
+            'startup_rss_megabytes': round(bot.current_rss_mb(), 1),
+            'index_megabytes': round(sum(state['search_index'].footprint().values()) / 2 ** 20, 1),
+            'scenarios': asyncio.run(run_scenarios(bot, state, rows, args)),
+        }
+        result['final_rss_megabytes'] = round(bot.current_rss_mb(), 1)
+    finally:
+        os.chdir(os.path.dirname(BOT_SOURCE))
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(json.dumps(result))
+
+
+def compare(previous, current):
+    old = {run['size']: run for run in previous['runs']}
+    for run in current['runs']:
+        base = old.get(run['size'])
+        if base is None:
+            continue
+        print(f"\nСловарь {run['size']}: сравнение с {previous['created']}")
+        for name, stats in run['scenarios'].items():
+            base_stats = base['scenarios'].get(name)
+            if not base_stats:
+                continue
+            for key in ('updates_per_second',):
+                print(f"  {name:12} {key}: {base_stats[key]} -> {stats[key]}")
+            for label in ('p50', 'p99'):
+                print(f"  {name:12} {label} ms: {base_stats['latency_ms'][label]} -> {stats['latency_ms'][label]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк NorwegianVerbBot на поддельном транспорте Telegram')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[400, 10_000, 100_000])
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--ops', type=int, default=2000, help='операций на сценарий')
+    parser.add_argument('--concurrency', type=int, default=64, help='одновременных операций')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None, help='куда сохранить JSON (по умолчанию benchmark-<время>.json)')
+    parser.add_argument('--compare', default=None, help='JSON прошлого прогона для сравнения')
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.size is not None:
+        run_worker(args)
+        return
+
+    runs = []
+    for size in args.sizes:
+        command = [sys.executable, os.path.abspath(__file__), '--size', str(size), '--ops', str(args.ops),
+                   '--concurrency', str(args.concurrency), '--seed', str(args.seed), '--scenarios', *args.scenarios]
+        completed = subprocess.run(command, capture_output=True, text=True, check=True)
+        run = json.loads(completed.stdout.strip().splitlines()[-1])
+        runs.append(run)
+        print(f"Словарь {size}: старт {run['startup_seconds']} с, {run['startup_rss_megabytes']} МБ, "
+              f"индекс {run['index_megabytes']} МБ")
+        for name, stats in run['scenarios'].items():
+            latency = stats['latency_ms']
+            print(f"  {name:12} {stats['updates_per_second']:>9} upd/s  p50 {latency['p50']} мс  "
+                  f"p95 {latency['p95']} мс  p99 {latency['p99']} мс  "
+                  f"{stats['retained_bytes_per_update']} Б/upd  диск {stats['disk_bytes_written']} Б")
+
+    created = time.strftime('%Y-%m-%dT%H:%M:%S')
+    report = {'created': created, 'python': sys.version.split()[0], 'ops': args.ops,
+              'concurrency': args.concurrency, 'seed': args.seed, 'runs': runs}
+    output = args.output or f"benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nРезультаты сохранены в {output}")
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
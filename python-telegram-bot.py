@@ -1,624 +1,3148 @@
-import pandas as pd
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, JobQueue
-from telegram.ext.filters import Text, Command
+import time
+
+STARTED_AT = time.perf_counter()
+
+from telegram import (Bot, Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup,
+                      InlineQueryResultArticle, InputTextMessageContent)
+from telegram.ext import (Application, BasePersistence, BaseUpdateProcessor, CallbackQueryHandler, CommandHandler,
+                          InlineQueryHandler, MessageHandler, ContextTypes, JobQueue, PersistenceInput)
+from telegram.ext.filters import Text, Command, Document
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
+from array import array
 import asyncio
-from datetime import datetime
+import bisect
+import csv
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+from datetime import datetime, timedelta
+from enum import Enum
+from functools import wraps
+import hashlib
+import heapq
+import hmac
+import html
+import httpx
+import json
+import logging
 import os  # Добавляем импорт os для работы с переменными окружения
+import marshal
+import random
+import re
+import secrets
+import signal
+import sqlite3
+import sys
+import tempfile
+import threading
 
 # Получение токена из переменной окружения
 TOKEN = os.getenv("TOKEN")
 if not TOKEN:
     raise ValueError("Токен бота не задан. Установите переменную окружения TOKEN.")
 
+# ID администраторов через запятую
+ADMIN_IDS = frozenset(int(admin_id) for admin_id in os.getenv("ADMIN_IDS", "509114893").split(',')
+                      if admin_id.strip())
+
+
+def is_admin(user_id):
+    return user_id in ADMIN_IDS
+
+
+# Логирование: уровень задаётся переменной LOG_LEVEL (DEBUG покажет каждое сообщение)
+logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+                    level=os.getenv("LOG_LEVEL", "INFO").upper())
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("apscheduler").setLevel(logging.WARNING)
+logger = logging.getLogger("verbbot")
+
 # Путь к файлам с данными
 VERBS_FILE_PATH = '1_norwegian_verbs.csv'
 SUGGESTIONS_FILE_PATH = 'Suggestions.csv'
 CONTACTS_FILE_PATH = '1_Kontakt.csv'
+DB_FILE_PATH = os.getenv("DB_FILE_PATH", "bot_data.sqlite3")
+SNAPSHOT_FILE_PATH = os.getenv("SNAPSHOT_FILE_PATH", "bot_data.snapshot")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))  # ожидание записи другого процесса
+
+VERB_COLUMNS = [
+    'Infinitiv (инфинитив)',
+    'Presens (настоящее время)',
+    'Preteritum (прошедшее время)',
+    'Presens perfektum (причастие прошедшего времени)',
+    'Перевод'
+]
+SUGGESTION_COLUMNS = VERB_COLUMNS + ['User_ID', 'Username', 'Contact']
+CONTACT_COLUMNS = ['User_ID', 'Username', 'Contact', 'Location', 'Device', 'Last_Active']
+
+
+# Инфинитив для сравнения: без регистра и без "å "
+def normalize_infinitiv(infinitiv):
+    infinitiv = infinitiv.strip().lower()
+    return infinitiv[2:].lstrip() if infinitiv.startswith('å ') else infinitiv
+
+
+# Строка словаря в том виде, в каком её хранит бот: pandas отдаёт None и числа, в базе - строки
+def verb_row(row):
+    return tuple('' if value is None else str(value) for value in row)
+
+
+# Метрики: счётчики событий и скользящее окно длительностей по этапам обработки
+# (для p50/p95/p99). Доступны админу через /stats и в текстовом формате Prometheus
+METRICS_WINDOW = int(os.getenv("METRICS_WINDOW", "2048"))
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.samples = defaultdict(lambda: deque(maxlen=METRICS_WINDOW))
+        self.totals = defaultdict(lambda: [0, 0.0])  # этап -> [количество, сумма секунд]
+
+    def inc(self, name, amount=1):
+        self.counters[name] += amount
+
+    def observe(self, stage, seconds):
+        self.samples[stage].append(seconds)
+        total = self.totals[stage]
+        total[0] += 1
+        total[1] += seconds
+
+    @contextmanager
+    def timer(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def percentiles(self, stage, quantiles=(0.5, 0.95, 0.99)):
+        values = sorted(self.samples[stage])
+        if not values:
+            return [0.0] * len(quantiles)
+        return [values[min(len(values) - 1, int(q * len(values)))] for q in quantiles]
+
+
+metrics = Metrics()
+
+
+# Декоратор: полное время работы обработчика
+def timed(stage):
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with metrics.timer(stage):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Запросы к Telegram API (отправка ответов) с замером времени
+class TimedRequest(HTTPXRequest):
+    async def do_request(self, *args, **kwargs):
+        with metrics.timer('send'):
+            return await super().do_request(*args, **kwargs)
+
+
+# Хранилище данных: SQLite в режиме WAL. Каждая запись - одна короткая транзакция,
+# поэтому падение процесса не может обрезать файл, как это было с to_csv.
+# CSV импортируются при первом запуске и могут быть выгружены обратно командой /export.
+class Storage:
+    def __init__(self, path):
+        is_new = not os.path.exists(path)
+        self.path = path
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS verbs (
+                id INTEGER PRIMARY KEY,
+                infinitiv TEXT NOT NULL,
+                presens TEXT,
+                preteritum TEXT,
+                perfektum TEXT,
+                translation TEXT,
+                from_csv INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS verbs_infinitiv ON verbs (infinitiv);
+            CREATE TABLE IF NOT EXISTS suggestions (
+                id INTEGER PRIMARY KEY,
+                infinitiv TEXT NOT NULL,
+                presens TEXT,
+                preteritum TEXT,
+                perfektum TEXT,
+                translation TEXT,
+                user_id INTEGER,
+                username TEXT,
+                contact TEXT
+            );
+            CREATE INDEX IF NOT EXISTS suggestions_infinitiv ON suggestions (infinitiv);
+            CREATE TABLE IF NOT EXISTS contacts (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL UNIQUE,
+                username TEXT,
+                contact TEXT,
+                location TEXT,
+                device TEXT,
+                last_active TEXT
+            );
+            CREATE TABLE IF NOT EXISTS sessions (
+                user_id INTEGER PRIMARY KEY,
+                data BLOB NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS reviews (
+                user_id INTEGER NOT NULL,
+                verb TEXT NOT NULL,
+                repetitions INTEGER NOT NULL,
+                interval REAL NOT NULL,
+                ease REAL NOT NULL,
+                due REAL NOT NULL,
+                PRIMARY KEY (user_id, verb)
+            );
+            CREATE INDEX IF NOT EXISTS reviews_due ON reviews (due);
+            CREATE TABLE IF NOT EXISTS quiz_users (
+                user_id INTEGER PRIMARY KEY,
+                reminders INTEGER NOT NULL DEFAULT 1,
+                reminded_at REAL NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY,
+                text TEXT NOT NULL,
+                status TEXT NOT NULL,
+                total INTEGER NOT NULL,
+                last_contact_id INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                blocked INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                created_at TEXT NOT NULL,
+                heartbeat REAL NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS blocked_users (
+                user_id INTEGER PRIMARY KEY,
+                blocked_at TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS query_stats (
+                day TEXT NOT NULL,
+                query TEXT NOT NULL,
+                hits INTEGER NOT NULL,
+                fuzzy INTEGER NOT NULL,
+                misses INTEGER NOT NULL,
+                PRIMARY KEY (day, query)
+            );
+            CREATE TABLE IF NOT EXISTS verb_stats (
+                day TEXT NOT NULL,
+                infinitiv TEXT NOT NULL,
+                lookups INTEGER NOT NULL,
+                PRIMARY KEY (day, infinitiv)
+            );
+            CREATE TABLE IF NOT EXISTS daily_stats (
+                day TEXT PRIMARY KEY,
+                searches INTEGER NOT NULL,
+                fuzzy INTEGER NOT NULL,
+                misses INTEGER NOT NULL,
+                latency_sum REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS daily_users (
+                day TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                PRIMARY KEY (day, user_id)
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+        ''')
+        # Столбцы, добавленные позже, в базах старых версий. Глаголы в них считаются добавленными
+        # через бота, пока не совпадут со строкой CSV при слиянии
+        with self.transaction() as conn:
+            for table, column, definition in (('verbs', 'from_csv', 'INTEGER NOT NULL DEFAULT 0'),
+                                              ('broadcasts', 'heartbeat', 'REAL NOT NULL DEFAULT 0')):
+                if column not in {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        if is_new:
+            self.import_csv()
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    # Чтение идёт через отдельное соединение каждого потока: в режиме WAL читатели
+    # не блокируют друг друга и писателя
+    def reader(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        return conn
+
+    def query(self, sql, params=()):
+        return self.reader().execute(sql, params).fetchall()
+
+    # Импорт существующих CSV (только при создании базы)
+    def import_csv(self):
+        logger.info("Импорт CSV файлов в базу данных...")
+        verbs = read_csv_rows(VERBS_FILE_PATH, VERB_COLUMNS)
+        suggestions = read_csv_rows(SUGGESTIONS_FILE_PATH, SUGGESTION_COLUMNS)
+        contacts = read_csv_rows(CONTACTS_FILE_PATH, CONTACT_COLUMNS)
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO verbs (infinitiv, presens, preteritum, perfektum, translation, from_csv) "
+                "VALUES (?, ?, ?, ?, ?, 1)", map(verb_row, verbs))
+            digest = file_digest(VERBS_FILE_PATH)
+            if digest is not None:
+                self.set_meta(conn, 'verbs_csv_digest', digest)
+            conn.executemany(
+                "INSERT INTO suggestions (infinitiv, presens, preteritum, perfektum, translation, user_id, username, "
+                "contact) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", suggestions)
+            conn.executemany(
+                "INSERT OR REPLACE INTO contacts (user_id, username, contact, location, device, last_active) "
+                "VALUES (?, ?, ?, ?, ?, ?)", contacts)
+
+    # Выгрузка базы обратно в CSV (через временный файл, чтобы не обрезать старый)
+    def export_csv(self):
+        write_csv_rows(VERBS_FILE_PATH, VERB_COLUMNS, self.verbs())
+        write_csv_rows(SUGGESTIONS_FILE_PATH, SUGGESTION_COLUMNS, [row[1:] for row in self.suggestions()])
+        write_csv_rows(CONTACTS_FILE_PATH, CONTACT_COLUMNS, self.contacts())
+
+    # Номера версий в таблице meta увеличиваются в той же транзакции, что и изменение данных:
+    # verbs_version - любое изменение словаря, verbs_generation - изменение уже загруженных строк,
+    # suggestions_version и contacts_version - изменения предложений и контактов.
+    # По ним другие процессы узнают, что нужно перечитать
+    def verbs_version(self):
+        rows = self.query("SELECT value FROM meta WHERE key = 'verbs_version'")
+        return rows[0][0] if rows else 0
+
+    def meta_value(self, key):
+        rows = self.query("SELECT value FROM meta WHERE key = ?", (key,))
+        return rows[0][0] if rows else None
+
+    @staticmethod
+    def set_meta(conn, key, value):
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    @staticmethod
+    def bump_version(conn, key):
+        conn.execute("INSERT INTO meta (key, value) VALUES (?, 1) ON CONFLICT (key) DO UPDATE SET value = value + 1",
+                     (key,))
+
+    # Согласованный срез: (наибольший id глагола, версии из meta)
+    def sync_state(self):
+        conn = self.reader()
+        conn.execute("BEGIN")
+        try:
+            max_verb_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM verbs").fetchone()[0]
+            versions = dict(conn.execute("SELECT key, value FROM meta").fetchall())
+        finally:
+            conn.execute("COMMIT")
+        return max_verb_id, versions
+
+    # Глаголы
+    def verbs(self, up_to_id=None):
+        if up_to_id is None:
+            return self.query("SELECT infinitiv, presens, preteritum, perfektum, translation FROM verbs ORDER BY id")
+        return self.query("SELECT infinitiv, presens, preteritum, perfektum, translation FROM verbs WHERE id <= ? "
+                          "ORDER BY id", (up_to_id,))
+
+    # Строки (id, инфинитив, формы, перевод) с id в промежутке (verb_id, up_to_id]
+    def verbs_after(self, verb_id, up_to_id):
+        return self.query("SELECT id, infinitiv, presens, preteritum, perfektum, translation FROM verbs "
+                          "WHERE id > ? AND id <= ? ORDER BY id", (verb_id, up_to_id))
+
+    # Добавление глаголов и удаление предложений (принятых или закрытых ими) одной транзакцией.
+    # Возвращает id добавленных глаголов
+    def move_verbs(self, rows, suggestion_ids=()):
+        with self.transaction() as conn:
+            last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM verbs").fetchone()[0]
+            conn.executemany(
+                "INSERT INTO verbs (infinitiv, presens, preteritum, perfektum, translation) VALUES (?, ?, ?, ?, ?)",
+                rows)
+            conn.executemany("DELETE FROM suggestions WHERE id = ?", [(i,) for i in suggestion_ids])
+            if rows:
+                self.bump_version(conn, 'verbs_version')
+            if suggestion_ids:
+                self.bump_version(conn, 'suggestions_version')
+        return range(last_id + 1, last_id + 1 + len(rows))
+
+    # Слияние строк из CSV со словарём. Строки сопоставляются по инфинитиву (повторяющиеся инфинитивы -
+    # по порядку): изменившиеся обновляются, новые добавляются в конец, а глаголы из CSV, которых в файле
+    # больше нет, удаляются. Столбец from_csv отличает их от глаголов, добавленных через бота или принятых
+    # из Anbefalinger: те остаются, пока не появятся в CSV (после /export они уже там).
+    # digest - хэш файла, из которого взяты строки (запоминается в meta).
+    # Возвращает (добавлено, обновлено, удалено)
+    def merge_verbs(self, rows, digest=None):
+        with self.transaction() as conn:
+            if digest is not None:
+                self.set_meta(conn, 'verbs_csv_digest', digest)
+            current = defaultdict(deque)
+            for verb_id, from_csv, *row in conn.execute(
+                    "SELECT id, from_csv, infinitiv, presens, preteritum, perfektum, translation FROM verbs "
+                    "ORDER BY id"):
+                row = verb_row(row)
+                current[normalize_infinitiv(row[0])].append((verb_id, from_csv, row))
+            added, updated, claimed = [], [], []
+            for row in map(verb_row, rows):
+                matches = current.get(normalize_infinitiv(row[0]))
+                if not matches:
+                    added.append(row)
+                    continue
+                verb_id, from_csv, old_row = matches.popleft()
+                if row != old_row:
+                    updated.append((*row, verb_id))
+                elif not from_csv:
+                    claimed.append((verb_id,))
+            deleted = [(verb_id,) for matches in current.values() for verb_id, from_csv, _ in matches if from_csv]
+            conn.executemany(
+                "INSERT INTO verbs (infinitiv, presens, preteritum, perfektum, translation, from_csv) "
+                "VALUES (?, ?, ?, ?, ?, 1)", added)
+            conn.executemany(
+                "UPDATE verbs SET infinitiv = ?, presens = ?, preteritum = ?, perfektum = ?, translation = ?, "
+                "from_csv = 1 WHERE id = ?", updated)
+            conn.executemany("UPDATE verbs SET from_csv = 1 WHERE id = ?", claimed)
+            conn.executemany("DELETE FROM verbs WHERE id = ?", deleted)
+            if added or updated or deleted:
+                self.bump_version(conn, 'verbs_version')
+            if updated or deleted:
+                self.bump_version(conn, 'verbs_generation')
+        return len(added), len(updated), len(deleted)
+
+    # Предложения: строки (id, инфинитив, формы, перевод, User_ID, Username, Contact)
+    def suggestions(self):
+        return self.query(
+            "SELECT id, infinitiv, presens, preteritum, perfektum, translation, user_id, username, contact "
+            "FROM suggestions ORDER BY id")
+
+    def suggestions_page(self, offset, limit):
+        return self.query(
+            "SELECT id, infinitiv, presens, preteritum, perfektum, translation, user_id, username, contact "
+            "FROM suggestions ORDER BY id LIMIT ? OFFSET ?", (limit, offset))
+
+    def count_suggestions(self):
+        return self.query("SELECT COUNT(*) FROM suggestions")[0][0]
+
+    # Строки (инфинитив, формы, перевод) выбранных предложений в порядке id
+    def suggestion_rows(self, suggestion_ids):
+        suggestion_ids = list(suggestion_ids)
+        rows = []
+        for i in range(0, len(suggestion_ids), 500):
+            chunk = suggestion_ids[i:i + 500]
+            rows += self.query(
+                "SELECT id, infinitiv, presens, preteritum, perfektum, translation FROM suggestions "
+                f"WHERE id IN ({', '.join('?' * len(chunk))})", chunk)
+        return [row[1:] for row in sorted(rows)]
+
+    # Возвращает id нового предложения
+    def add_suggestion(self, row):
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO suggestions (infinitiv, presens, preteritum, perfektum, translation, user_id, username, "
+                "contact) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", row)
+            self.bump_version(conn, 'suggestions_version')
+            return cursor.lastrowid
+
+    def update_suggestion(self, suggestion_id, verb_row):
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE suggestions SET infinitiv = ?, presens = ?, preteritum = ?, perfektum = ?, translation = ? "
+                "WHERE id = ?", (*verb_row, suggestion_id))
+            self.bump_version(conn, 'suggestions_version')
+
+    def delete_suggestions(self, suggestion_ids=None):
+        with self.transaction() as conn:
+            if suggestion_ids is None:
+                conn.execute("DELETE FROM suggestions")
+            else:
+                conn.executemany("DELETE FROM suggestions WHERE id = ?", [(i,) for i in suggestion_ids])
+            self.bump_version(conn, 'suggestions_version')
+
+    # Контакты
+    def contacts(self):
+        return self.query(
+            "SELECT user_id, username, contact, location, device, last_active FROM contacts ORDER BY id")
+
+    # Пакетное обновление активности: строки (User_ID, Username, Contact, Last_Active)
+    def touch_contacts(self, rows):
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO contacts (user_id, username, contact, last_active) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET username = excluded.username, "
+                "last_active = excluded.last_active", rows)
+            conn.executemany("DELETE FROM blocked_users WHERE user_id = ?", [(row[0],) for row in rows])
+            self.bump_version(conn, 'contacts_version')
+
+    # Рассылки. last_contact_id - все контакты с id не больше него уже обработаны.
+    # Заблокировавшие бота (blocked_users) пропускаются, пока снова не напишут боту.
+    # Рассылку ведёт один процесс: он обновляет heartbeat (time.time()) при каждой записи прогресса.
+    # Рассылка, чей heartbeat старше stale_before, осталась без владельца и может быть подхвачена.
+    # None, если уже есть незавершённая рассылка
+    def create_broadcast(self, text, now):
+        with self.transaction() as conn:
+            if conn.execute("SELECT 1 FROM broadcasts WHERE status IN ('running', 'stopping')").fetchone():
+                return None
+            total = conn.execute(
+                "SELECT COUNT(*) FROM contacts c LEFT JOIN blocked_users b ON b.user_id = c.user_id "
+                "WHERE b.user_id IS NULL").fetchone()[0]
+            cursor = conn.execute(
+                "INSERT INTO broadcasts (text, status, total, created_at, heartbeat) VALUES (?, 'running', ?, ?, ?)",
+                (text, total, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), now))
+            return cursor.lastrowid, total
+
+    # Рассылка без владельца переходит к вызвавшему процессу (строка как в broadcasts или None).
+    # Остановленная, но не успевшая остановиться рассылка без владельца просто помечается остановленной
+    def claim_broadcast(self, now, stale_before):
+        with self.transaction() as conn:
+            conn.execute("UPDATE broadcasts SET status = 'stopped' WHERE status = 'stopping' AND heartbeat < ?",
+                         (stale_before,))
+            row = conn.execute(
+                "SELECT id, text, status, total, last_contact_id, sent, blocked, failed FROM broadcasts "
+                "WHERE status = 'running' AND heartbeat < ? ORDER BY id LIMIT 1", (stale_before,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE broadcasts SET heartbeat = ? WHERE id = ?", (now, row[0]))
+            return row
+
+    # Остановка из любого процесса: владелец увидит 'stopping' при следующей записи прогресса,
+    # рассылка без владельца останавливается сразу. (id, новое состояние) или None, если рассылки нет
+    def request_broadcast_stop(self, stale_before):
+        with self.transaction() as conn:
+            row = conn.execute("SELECT id, heartbeat FROM broadcasts WHERE status IN ('running', 'stopping') "
+                               "ORDER BY id DESC LIMIT 1").fetchone()
+            if row is None:
+                return None
+            status = 'stopped' if row[1] < stale_before else 'stopping'
+            conn.execute("UPDATE broadcasts SET status = ? WHERE id = ?", (status, row[0]))
+            return row[0], status
+
+    def broadcasts(self, status=None, limit=1):
+        where = "WHERE status = ? " if status else ""
+        return self.query(
+            "SELECT id, text, status, total, last_contact_id, sent, blocked, failed FROM broadcasts "
+            f"{where}ORDER BY id DESC LIMIT ?", (status, limit) if status else (limit,))
+
+    # Следующие получатели: строки (id контакта, User_ID)
+    def broadcast_targets(self, after_id, limit):
+        return self.query(
+            "SELECT c.id, c.user_id FROM contacts c LEFT JOIN blocked_users b ON b.user_id = c.user_id "
+            "WHERE c.id > ? AND b.user_id IS NULL ORDER BY c.id LIMIT ?", (after_id, limit))
+
+    # Возвращает состояние в базе до записи; запрошенная остановка ('stopping') не затирается 'running'
+    def save_broadcast(self, broadcast_id, status, last_contact_id, sent, blocked, failed, blocked_ids, heartbeat):
+        blocked_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.transaction() as conn:
+            stored = conn.execute("SELECT status FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()[0]
+            if stored == 'stopping' and status == 'running':
+                status = stored
+            conn.execute("UPDATE broadcasts SET status = ?, last_contact_id = ?, sent = ?, blocked = ?, failed = ?, "
+                         "heartbeat = ? WHERE id = ?",
+                         (status, last_contact_id, sent, blocked, failed, heartbeat, broadcast_id))
+            conn.executemany("INSERT OR IGNORE INTO blocked_users (user_id, blocked_at) VALUES (?, ?)",
+                             [(user_id, blocked_at) for user_id in blocked_ids])
+        return stored
+
+    # Карточки квиза пользователя: строки (глагол, повторений подряд, интервал в днях, лёгкость, срок)
+    def reviews(self, user_id):
+        return self.query("SELECT verb, repetitions, interval, ease, due FROM reviews WHERE user_id = ?", (user_id,))
+
+    # Строки (User_ID, глагол, повторений подряд, интервал, лёгкость, срок)
+    def save_reviews(self, rows):
+        with self.transaction() as conn:
+            conn.executemany("INSERT OR REPLACE INTO reviews (user_id, verb, repetitions, interval, ease, due) "
+                             "VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def join_quiz(self, user_id):
+        with self.transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO quiz_users (user_id) VALUES (?)", (user_id,))
+
+    def set_quiz_reminders(self, user_id, enabled):
+        with self.transaction() as conn:
+            conn.execute("INSERT INTO quiz_users (user_id, reminders) VALUES (?, ?) "
+                         "ON CONFLICT (user_id) DO UPDATE SET reminders = excluded.reminders", (user_id, int(enabled)))
+
+    # Кому пора напомнить: (User_ID, число карточек со сроком до now) среди User_ID % workers == worker_id
+    def due_reminders(self, now, reminded_before, limit, workers=1, worker_id=0):
+        return self.query(
+            "SELECT q.user_id, COUNT(*) FROM quiz_users q JOIN reviews r ON r.user_id = q.user_id "
+            "WHERE q.reminders = 1 AND q.reminded_at < ? AND r.due <= ? AND q.user_id % ? = ? "
+            "GROUP BY q.user_id LIMIT ?",
+            (reminded_before, now, workers, worker_id, limit))
+
+    # Отметка отправленных напоминаний; заблокировавшим бота напоминания отключаются
+    def mark_reminded(self, user_ids, blocked_ids, now):
+        with self.transaction() as conn:
+            conn.executemany("UPDATE quiz_users SET reminded_at = ? WHERE user_id = ?", [(now, i) for i in user_ids])
+            conn.executemany("UPDATE quiz_users SET reminders = 0 WHERE user_id = ?", [(i,) for i in blocked_ids])
+
+    # Аналитика: прибавление свёрнутых счётчиков и удаление дней старше keep_since.
+    # Возвращает запросы, у которых общее число промахов в этой записи достигло miss_threshold
+    # и которые ни разу не находились с исправлением опечатки
+    def save_analytics(self, query_rows, verb_rows, day_rows, user_rows, keep_since, miss_threshold):
+        missed = [row[1] for row in query_rows if row[4]]
+        with self.transaction() as conn:
+            before = {query: self.query_misses(conn, query)[0] for query in missed}
+            conn.executemany(
+                "INSERT INTO query_stats (day, query, hits, fuzzy, misses) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (day, query) DO UPDATE SET hits = hits + excluded.hits, fuzzy = fuzzy + excluded.fuzzy, "
+                "misses = misses + excluded.misses", query_rows)
+            conn.executemany(
+                "INSERT INTO verb_stats (day, infinitiv, lookups) VALUES (?, ?, ?) ON CONFLICT (day, infinitiv) "
+                "DO UPDATE SET lookups = lookups + excluded.lookups", verb_rows)
+            conn.executemany(
+                "INSERT INTO daily_stats (day, searches, fuzzy, misses, latency_sum) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (day) DO UPDATE SET searches = searches + excluded.searches, "
+                "fuzzy = fuzzy + excluded.fuzzy, misses = misses + excluded.misses, "
+                "latency_sum = latency_sum + excluded.latency_sum", day_rows)
+            conn.executemany("INSERT OR IGNORE INTO daily_users (day, user_id) VALUES (?, ?)", user_rows)
+            for table in ('query_stats', 'verb_stats', 'daily_stats', 'daily_users'):
+                conn.execute(f"DELETE FROM {table} WHERE day < ?", (keep_since,))
+            crossed = []
+            for query, misses_before in before.items():
+                misses, fuzzy = self.query_misses(conn, query)
+                if misses_before < miss_threshold <= misses and not fuzzy:
+                    crossed.append(query)
+            return crossed
+
+    # (промахов, найдено с исправлением опечатки) по запросу за всё хранимое время
+    @staticmethod
+    def query_misses(conn, query):
+        return conn.execute("SELECT COALESCE(SUM(misses), 0), COALESCE(SUM(fuzzy), 0) FROM query_stats "
+                            "WHERE query = ?", (query,)).fetchone()
+
+    # Сводка за дни начиная с since: (поисков, с опечаткой, промахов, сумма задержек), активные по дням и топы
+    def analytics_report(self, since, limit):
+        return {
+            'totals': self.query("SELECT COALESCE(SUM(searches), 0), COALESCE(SUM(fuzzy), 0), "
+                                 "COALESCE(SUM(misses), 0), COALESCE(SUM(latency_sum), 0) FROM daily_stats "
+                                 "WHERE day >= ?", (since,))[0],
+            'daily_users': self.query("SELECT day, COUNT(*) FROM daily_users WHERE day >= ? GROUP BY day "
+                                      "ORDER BY day", (since,)),
+            'queries': self.query("SELECT query, SUM(hits) AS n FROM query_stats WHERE day >= ? GROUP BY query "
+                                  "HAVING n > 0 ORDER BY n DESC, query LIMIT ?", (since, limit)),
+            'fuzzy': self.query("SELECT query, SUM(fuzzy) AS n FROM query_stats WHERE day >= ? GROUP BY query "
+                                "HAVING n > 0 ORDER BY n DESC, query LIMIT ?", (since, limit)),
+            'misses': self.query("SELECT query, SUM(misses) AS n FROM query_stats WHERE day >= ? GROUP BY query "
+                                 "HAVING n > 0 ORDER BY n DESC, query LIMIT ?", (since, limit)),
+            'verbs': self.query("SELECT infinitiv, SUM(lookups) AS n FROM verb_stats WHERE day >= ? "
+                                "GROUP BY infinitiv ORDER BY n DESC, infinitiv LIMIT ?", (since, limit)),
+        }
+
+    # Сессии (user_data): строки (User_ID, данные в формате marshal, время записи)
+    def sessions(self, since):
+        return self.query("SELECT user_id, data, updated_at FROM sessions WHERE updated_at >= ?", (since,))
+
+    # Запись изменившихся сессий, удаление сброшенных и устаревших одной транзакцией
+    def save_sessions(self, rows, dropped_ids, expire_before):
+        with self.transaction() as conn:
+            conn.executemany("INSERT OR REPLACE INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?)", rows)
+            conn.executemany("DELETE FROM sessions WHERE user_id = ?", [(i,) for i in dropped_ids])
+            conn.execute("DELETE FROM sessions WHERE updated_at < ?", (expire_before,))
+
+
+# pandas нужен только для импорта и выгрузки CSV, поэтому импортируется по требованию
+def read_csv_rows(path, columns):
+    import pandas as pd
+    try:
+        df = pd.read_csv(path)
+    except FileNotFoundError:
+        logger.info("Файл %s не найден, пропускаем...", path)
+        return []
+    df = df.reindex(columns=columns).astype(object)
+    df = df.where(df.notna(), None)
+    return list(df.itertuples(index=False, name=None))
+
+
+def write_csv_rows(path, columns, rows):
+    import pandas as pd
+    tmp_path = path + '.tmp'
+    pd.DataFrame(rows, columns=columns).to_csv(tmp_path, index=False, encoding='utf-8')
+    os.replace(tmp_path, path)
+
+
+# Хэш содержимого файла: первые 60 бит sha256, чтобы помещался в INTEGER таблицы meta. None, если файла нет
+def file_digest(path):
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return None
+    return int(digest.hexdigest()[:15], 16)
+
+
+def file_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return 0
+
+
+# Снимок словаря для быстрого старта: кортежи строк в формате marshal вместе с версией словаря.
+# Словарь хранится в базе; снимок пересоздаётся, когда verbs_version в базе не совпадает с его версией.
+# Если CSV изменён, пока бот не работал (хэш не совпадает с запомненным), он сливается со словарём
+# так же, как при подхвате на ходу: без удаления глаголов, которых в CSV нет.
+# Возвращает (строки, срез sync_state, которому они соответствуют)
+SNAPSHOT_FORMAT = 1
+
+
+def load_verbs(storage):
+    digest = file_digest(VERBS_FILE_PATH)
+    if digest is not None and digest != storage.meta_value('verbs_csv_digest'):
+        rows = read_csv_rows(VERBS_FILE_PATH, VERB_COLUMNS)
+        if rows:
+            added, updated, deleted = storage.merge_verbs(rows, digest)
+            logger.info("CSV с глаголами изменён: добавлено строк %d, изменено %d, удалено %d",
+                        added, updated, deleted)
+        else:
+            logger.warning("Файл %s пуст, словарь не изменён", VERBS_FILE_PATH)
+    snapshot_mtime = file_mtime(SNAPSHOT_FILE_PATH)
+    state = storage.sync_state()
+    max_verb_id, versions = state
+    version = versions.get('verbs_version', 0)
+    if snapshot_mtime:
+        try:
+            with open(SNAPSHOT_FILE_PATH, 'rb') as f:
+                snapshot_format, snapshot_version, rows = marshal.load(f)
+            if snapshot_format == SNAPSHOT_FORMAT and snapshot_version == version:
+                return rows, state
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+    logger.info("Создание снимка словаря...")
+    rows = [tuple(row) for row in storage.verbs(max_verb_id)]
+    tmp_path = f"{SNAPSHOT_FILE_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        marshal.dump((SNAPSHOT_FORMAT, version, rows), f)
+    os.replace(tmp_path, SNAPSHOT_FILE_PATH)
+    return rows, state
+
+
+# Текущий объём памяти процесса в МБ (на Linux - из /proc, иначе пиковый)
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Блокирующая работа с диском и поиском выполняется вне цикла событий:
+# один поток-писатель для всех изменений (порядок записей сохраняется)
+# и несколько потоков-читателей для поиска
+READ_WORKERS = int(os.getenv("READ_WORKERS", "4"))
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))
+write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='writer')
+read_executor = ThreadPoolExecutor(max_workers=READ_WORKERS, thread_name_prefix='reader')
+
+
+async def run_write(func, *args):
+    with metrics.timer('persist'):
+        return await asyncio.get_running_loop().run_in_executor(write_executor, func, *args)
+
+
+async def run_read(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(read_executor, func, *args)
+
+
+# Ограничение частоты сообщений от одного пользователя: token bucket на RATE_LIMIT_BURST сообщений,
+# пополняемый со скоростью RATE_LIMIT_PER_MINUTE. Хранится в форме GCRA - одно число на пользователя:
+# момент, когда его корзина снова станет полной. Записи с уже полной корзиной ничем не отличаются от
+# отсутствующих, поэтому вытесняются; размер словаря ограничен RATE_LIMIT_MAX_USERS
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "30"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "8"))
+RATE_LIMIT_MAX_USERS = int(os.getenv("RATE_LIMIT_MAX_USERS", "100000"))
+USER_MAX_QUEUED = int(os.getenv("USER_MAX_QUEUED", "4"))
+RATE_LIMIT_NOTICE = "Слишком много сообщений. Подождите немного и попробуйте снова."
+
+
+class RateLimiter:
+    def __init__(self, per_minute, burst, max_users):
+        self.interval = 60 / per_minute
+        self.tolerance = self.interval * (burst - 1)
+        self.max_users = max_users
+        self.full_at = OrderedDict()  # user_id -> момент полной корзины, в порядке последнего обращения
+        self.noticed = set()  # кому уже отправлено предупреждение с момента последнего пропущенного сообщения
+
+    def allow(self, user_id):
+        now = time.monotonic()
+        full_at = max(self.full_at.pop(user_id, now), now)
+        allowed = full_at - now <= self.tolerance
+        self.full_at[user_id] = full_at + self.interval if allowed else full_at
+        if allowed:
+            self.noticed.discard(user_id)
+        self.evict(now)
+        return allowed
+
+    # Одно предупреждение на серию отклонённых сообщений
+    def should_notice(self, user_id):
+        if user_id in self.noticed:
+            return False
+        self.noticed.add(user_id)
+        return True
+
+    def evict(self, now):
+        while self.full_at:
+            user_id, full_at = next(iter(self.full_at.items()))
+            if full_at > now and len(self.full_at) <= self.max_users:
+                break
+            del self.full_at[user_id]
+            self.noticed.discard(user_id)
+
+
+# Обновления разных пользователей обрабатываются параллельно, а обновления
+# одного пользователя - строго по очереди (чтение после собственной записи).
+# Общий предел - семафор max_concurrent_updates базового класса: process_update (final в PTB) берёт слот
+# и вызывает do_process_update. Лимит частоты и длина очереди пользователя проверяются сразу, так что
+# обновление, ждущее своей очереди, держит слот, но таких у одного пользователя не больше USER_MAX_QUEUED
+# (у администратора очередь не ограничена).
+# Inline-запросы не трогают user_data и идут мимо очереди пользователя. Лимит частоты проверяется сразу,
+# затем запрос без слота ждёт INLINE_DEBOUNCE секунд в отдельной задаче и отбрасывается, как только придёт
+# более новый (пользователь ещё печатает); дождавшийся запрос заново проходит через process_update
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates, rate_limiter=None):
+        super().__init__(max_concurrent_updates)
+        self.rate_limiter = rate_limiter
+        self.user_locks = {}  # user_id -> [asyncio.Lock, число ожидающих]
+        self.pending_inline = {}  # user_id -> (задача, корутина) inline-запроса, ждущего INLINE_DEBOUNCE
+        self.ready_inline = set()  # update_id inline-запросов, дождавшихся своей очереди
+        self.inline_tasks = set()
+
+    async def do_process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await coroutine
+            return
+        if update.inline_query is not None:
+            if update.update_id in self.ready_inline:
+                self.ready_inline.discard(update.update_id)
+                await coroutine
+            else:
+                self.debounce_inline_query(update, coroutine)
+            return
+        entry = self.user_locks.get(user.id)
+        if not is_admin(user.id):
+            if entry is not None and entry[1] >= USER_MAX_QUEUED:
+                await self.drop(update, coroutine, 'dropped_queue_full')
+                return
+            if self.rate_limiter is not None and not self.rate_limiter.allow(user.id):
+                await self.drop(update, coroutine, 'dropped_rate_limited')
+                return
+        if entry is None:
+            entry = self.user_locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self.user_locks.pop(user.id, None)
+
+    def debounce_inline_query(self, update, coroutine):
+        user_id = update.effective_user.id
+        if self.rate_limiter is not None and not is_admin(user_id) and not self.rate_limiter.allow(user_id):
+            metrics.inc('dropped_rate_limited')
+            coroutine.close()
+            return
+        pending = self.pending_inline.pop(user_id, None)
+        if pending is not None:
+            metrics.inc('inline_debounced')
+            self.discard_inline(*pending)
+        task = asyncio.create_task(self.process_inline_query(update, coroutine))
+        self.pending_inline[user_id] = (task, coroutine)
+        self.inline_tasks.add(task)
+        task.add_done_callback(self.inline_tasks.discard)
+
+    async def process_inline_query(self, update, coroutine):
+        await asyncio.sleep(INLINE_DEBOUNCE)
+        del self.pending_inline[update.effective_user.id]
+        self.ready_inline.add(update.update_id)
+        try:
+            await self.process_update(update, coroutine)
+        finally:
+            self.ready_inline.discard(update.update_id)
+
+    # Отменённая до запуска задача не выполняет тело process_inline_query, поэтому корутина закрывается здесь
+    @staticmethod
+    def discard_inline(task, coroutine):
+        task.cancel()
+        coroutine.close()
+
+    async def drop(self, update, coroutine, reason):
+        metrics.inc(reason)
+        coroutine.close()
+        if self.rate_limiter is not None and self.rate_limiter.should_notice(update.effective_user.id):
+            await self.notify_limited(update)
+
+    @staticmethod
+    async def notify_limited(update):
+        try:
+            if update.callback_query:
+                await update.callback_query.answer(RATE_LIMIT_NOTICE)
+            elif update.effective_message:
+                await update.effective_message.reply_text(RATE_LIMIT_NOTICE)
+        except TelegramError as error:
+            logger.debug("Не удалось отправить предупреждение о лимите: %s", error)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        for pending in self.pending_inline.values():
+            self.discard_inline(*pending)
+        self.pending_inline.clear()
+
+
+# Спряжение. Большинство глаголов относится к правильным классам:
+#   et:  kaste - kaster - kastet - har kastet
+#   te:  spise - spiser - spiste - har spist (kjenne - kjente - har kjent)
+#   de:  prøve - prøver - prøvde - har prøvd
+#   dde: bo - bor - bodde - har bodd
+# Класс глагола словаря определяется по его формам (None - сильный или неправильный глагол).
+# Производные формы (повелительное наклонение, пассив на -s, "hadde"/"å ha"/"er"/"ble"/"blir" + причастие)
+# попадают в хэш-таблицу точных совпадений индекса
+VERB_CLASSES = {'et': ('et', 'et'), 'te': ('te', 't'), 'de': ('de', 'd'), 'dde': ('dde', 'dd')}
+VOWELS = set('aeiouyæøå')
+CONJUGATION_SUFFIX_LENGTH = 4
+CONJUGATION_MAX_PROPOSALS = 3
+# Приставки, с которыми основой составного глагола может быть и короткий глагол (ut+gå, for+stå)
+COMPOUND_PREFIXES = {'an', 'av', 'be', 'bort', 'er', 'for', 'fra', 'fram', 'frem', 'gjennom', 'inn', 'med', 'mot',
+                     'ned', 'om', 'opp', 'over', 'på', 'sammen', 'til', 'under', 'ut'}
+
+
+def participle(perfektum):
+    return perfektum[4:] if perfektum.startswith('har ') else perfektum
+
+
+# (presens, preteritum, perfektum) правильного глагола заданного класса
+def regular_forms(word, verb_class):
+    preteritum_ending, participle_ending = VERB_CLASSES[verb_class]
+    stem = word[:-1] if verb_class != 'dde' and word.endswith('e') else word
+    if verb_class == 'te' and len(stem) > 2 and stem[-1] == stem[-2] and stem[-1] in 'lmn':
+        stem = stem[:-1]
+    return word + 'r', stem + preteritum_ending, 'har ' + stem + participle_ending
+
 
-# Чтение данных из CSV с обработкой ошибок
-print("Чтение CSV файла с глаголами...")
-try:
-    df_verbs = pd.read_csv(VERBS_FILE_PATH)
-except FileNotFoundError:
-    print("Файл с глаголами не найден, создаём новый...")
-    df_verbs = pd.DataFrame(columns=[
-        'Infinitiv (инфинитив)',
-        'Presens (настоящее время)',
-        'Preteritum (прошедшее время)',
-        'Presens perfektum (причастие прошедшего времени)',
-        'Перевод'
-    ])
-    df_verbs.to_csv(VERBS_FILE_PATH, index=False, encoding='utf-8')
-
-print("Чтение CSV файла с предложениями...")
-try:
-    df_suggestions = pd.read_csv(SUGGESTIONS_FILE_PATH)
-except FileNotFoundError:
-    print("Файл с предложениями не найден, создаём новый...")
-    df_suggestions = pd.DataFrame(columns=[
-        'Infinitiv (инфинитив)',
-        'Presens (настоящее время)',
-        'Preteritum (прошедшее время)',
-        'Presens perfektum (причастие прошедшего времени)',
-        'Перевод',
-        'User_ID',
-        'Username',
-        'Contact'
-    ])
-    df_suggestions.to_csv(SUGGESTIONS_FILE_PATH, index=False, encoding='utf-8')
-
-print("Чтение CSV файла с контактами...")
-try:
-    df_contacts = pd.read_csv(CONTACTS_FILE_PATH)
-except FileNotFoundError:
-    print("Файл с контактами не найден, создаём новый...")
-    df_contacts = pd.DataFrame(columns=[
-        'User_ID',
-        'Username',
-        'Contact',
-        'Last_Active'
-    ])
-    df_contacts.to_csv(CONTACTS_FILE_PATH, index=False, encoding='utf-8')
+def classify_verb(lowered):
+    word = normalize_infinitiv(lowered[0])
+    forms = (lowered[1], lowered[2], 'har ' + participle(lowered[3]))
+    for verb_class in VERB_CLASSES:
+        if regular_forms(word, verb_class) == forms:
+            return verb_class
+    return None
+
+
+def derived_forms(lowered):
+    word = normalize_infinitiv(lowered[0])
+    forms = set()
+    # У глаголов из нескольких слов (legge seg, kaste bort) повелительное наклонение и пассив строятся
+    # не по первому слову (legg deg), поэтому для них добавляются только формы с "hadde"/"å ha"
+    single = ' ' not in word
+    if word and single:
+        # kaste -> kast!, bo -> bo!
+        if len(word) > 2 and word.endswith('e') and word[-2] not in VOWELS:
+            forms.add(word[:-1])
+        if not word.endswith('s'):
+            forms.add(word + 's')
+    part = participle(lowered[3])
+    if part:
+        auxiliaries = ('hadde', 'å ha', 'er', 'ble', 'blir') if single else ('hadde', 'å ha')
+        forms.update(f"{auxiliary} {part}" for auxiliary in auxiliaries)
+    return forms
+
+
+# Классы по умолчанию, от более вероятного, когда в словаре нет глаголов с таким окончанием
+def default_classes(word):
+    if not word.endswith('e'):
+        return ['dde', 'te', 'et', 'de']
+    stem = word[:-1]
+    if stem.endswith(('v', 'g', 'ei', 'øy', 'au')):
+        return ['de', 'et', 'te', 'dde']
+    if len(stem) > 1 and stem[-1] == stem[-2] and stem[-1] in 'lmn':
+        return ['te', 'et', 'de', 'dde']
+    if len(stem) > 1 and stem[-1] not in VOWELS and stem[-2] not in VOWELS:
+        return ['et', 'te', 'de', 'dde']
+    return ['te', 'et', 'de', 'dde']
+
+
+# Предложение форм для нового инфинитива по глаголам словаря: составной глагол (opp+legge) наследует
+# формы основы, в том числе неправильные; иначе классы упорядочиваются по частоте среди глаголов
+# словаря с самым длинным совпадающим окончанием. Дополняется в потоке-писателе вместе с индексом
+class Conjugator:
+    def __init__(self):
+        self.by_word = {}  # инфинитив без "å " -> (presens, preteritum, perfektum) в нижнем регистре
+        self.suffix_classes = defaultdict(Counter)  # окончание инфинитива -> частоты классов
+
+    def learn(self, lowered, verb_class):
+        word = normalize_infinitiv(lowered[0])
+        self.by_word.setdefault(word, (lowered[1], lowered[2], lowered[3]))
+        if verb_class is not None:
+            for length in range(1, min(len(word), CONJUGATION_SUFFIX_LENGTH) + 1):
+                self.suffix_classes[word[-length:]][verb_class] += 1
+
+    def propose(self, infinitiv):
+        word = normalize_infinitiv(infinitiv)
+        proposals = []
+        if word in self.by_word:
+            proposals.append(self.by_word[word])
+        else:
+            for i in range(2, len(word) - 1):
+                forms = self.by_word.get(word[i:])
+                if forms is not None and (len(word) - i >= 3 or word[:i] in COMPOUND_PREFIXES):
+                    prefix = word[:i]
+                    proposals.append(tuple('har ' + prefix + form[4:] if form.startswith('har ') else prefix + form
+                                           for form in forms))
+                    break
+        counts = {}
+        for length in range(min(len(word), CONJUGATION_SUFFIX_LENGTH), 0, -1):
+            counts = self.suffix_classes.get(word[-length:])
+            if counts:
+                break
+        defaults = default_classes(word)
+        for verb_class in sorted(defaults, key=lambda c: (-(counts or {}).get(c, 0), defaults.index(c))):
+            forms = regular_forms(word, verb_class)
+            if forms not in proposals:
+                proposals.append(forms)
+        return proposals[:CONJUGATION_MAX_PROPOSALS]
+
+    # Строка словаря из инфинитива и перевода с самыми вероятными формами
+    def complete_row(self, infinitiv, translation):
+        infinitiv = infinitiv.strip()
+        if not infinitiv.lower().startswith('å '):
+            infinitiv = 'å ' + infinitiv
+        return (infinitiv, *self.propose(infinitiv)[0], translation.strip())
+
+
+# Значения словарей индекса: одно значение хранится как есть, несколько - кортежем.
+# У большинства форм и триграммных вариантов ровно одно значение, а кортеж на каждый ключ - лишние 56 байт
+def index_values(value):
+    return value if type(value) is tuple else () if value is None else (value,)
+
+
+def merge_index_values(value, new_values):
+    values = index_values(value) + tuple(new_values)
+    return values[0] if len(values) == 1 else values
+
+
+# Размер объекта в байтах вместе с содержимым контейнеров; объекты из seen не считаются повторно
+def deep_sizeof(obj, seen):
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+    return size
+
+
+FORMS_SEPARATOR = '\x00'  # разделитель форм в self.texts, в запросах не встречается
+
+
+# Поисковый индекс по глаголам: триграммы по формам в нижнем регистре.
+# Строится один раз при загрузке и дополняется при добавлении глаголов.
+# Строки интернируются, и строка в нижнем регистре, совпадающая с исходной, - тот же объект, поэтому
+# одинаковые формы и переводы хранятся в памяти один раз. Номера строк в postings - отсортированные
+# массивы array('I') по 4 байта на номер.
+# Списки строк только растут, а массивы в postings и кортежи в exact заменяются целиком (copy-on-write),
+# поэтому поиск из потоков-читателей не мешает добавлению из потока-писателя.
+class VerbSearchIndex:
+    def __init__(self):
+        self.rows = []       # исходные строки (инфинитив, формы, перевод)
+        self.lowered = []    # те же строки в нижнем регистре
+        self.postings = {}   # триграмма -> array('I') номеров строк по возрастанию
+        self.cards = []      # готовые HTML-карточки для ответа
+        self.texts = []      # формы глагола (без перевода), в том числе без "å " и "har ", через FORMS_SEPARATOR
+        self.exact = {}      # форма (в том числе производная) -> номер строки или кортеж номеров, для совпадения за O(1)
+        self.classes = []    # класс спряжения каждой строки (None - неправильный глагол)
+        self.conjugator = Conjugator()
+        self.fuzzy = FuzzyIndex()  # поиск с опечатками, только когда обычный поиск ничего не нашёл
+        self.version = 0     # увеличивается при каждом изменении словаря
+
+    @staticmethod
+    def trigrams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def add(self, row):
+        self.add_many([row])
+
+    # Формы для точного и префиксного совпадения: "å legge" ищется и как "legge", "har lagt" - и как "lagt"
+    @staticmethod
+    def verb_forms(lowered):
+        forms = set(lowered[:4])
+        for value in lowered[:4]:
+            for prefix in ('å ', 'har '):
+                if value.startswith(prefix):
+                    forms.add(value[len(prefix):])
+        forms.discard('')
+        return tuple(forms)
+
+    @staticmethod
+    def lower(value):
+        lowered = value.lower()
+        return value if lowered == value else sys.intern(lowered)
+
+    def add_many(self, rows):
+        new_postings = {}
+        new_exact = {}
+        new_derived = {}
+        for row in rows:
+            row = tuple(sys.intern('' if value is None else str(value)) for value in row)
+            row_id = len(self.rows)
+            lowered = tuple(self.lower(value) for value in row)
+            self.rows.append(row)
+            self.lowered.append(lowered)
+            self.cards.append(render_verb_card(row))
+            forms = tuple(sys.intern(form) for form in self.verb_forms(lowered))
+            self.texts.append(FORMS_SEPARATOR + FORMS_SEPARATOR.join(forms))
+            for form in forms:
+                new_exact.setdefault(form, []).append(row_id)
+            verb_class = classify_verb(lowered)
+            self.classes.append(verb_class)
+            self.conjugator.learn(lowered, verb_class)
+            for form in derived_forms(lowered).difference(forms):
+                new_derived.setdefault(form, []).append(row_id)
+            for value in lowered:
+                for gram in self.trigrams(value):
+                    new_postings.setdefault(gram, []).append(row_id)
+        for gram, row_ids in new_postings.items():
+            posting = self.postings.get(gram)
+            # номер строки попадает в список один раз, даже если триграмма есть в нескольких её формах
+            row_ids = array('I', sorted(set(row_ids)))
+            self.postings[gram] = posting + row_ids if posting else row_ids
+        for form, row_ids in new_exact.items():
+            self.exact[form] = merge_index_values(self.exact.get(form), row_ids)
+        for form, row_ids in new_derived.items():
+            self.exact[form] = merge_index_values(self.exact.get(form), row_ids)
+        self.fuzzy.add_many(new_exact.items())
+        self.version += 1
+
+    def exact_ids(self, form):
+        return index_values(self.exact.get(form))
+
+    # Память по частям индекса, байт. Общие объекты (интернированные строки) учитываются в первой
+    # части, где встретились. Вызывается в потоке-писателе, чтобы индекс не менялся во время обхода
+    def footprint(self):
+        seen = set()
+        parts = {
+            'rows': self.rows,
+            'lowered': self.lowered,
+            'texts': self.texts,
+            'cards': self.cards,
+            'classes': self.classes,
+            'exact': self.exact,
+            'postings': self.postings,
+            'fuzzy': self.fuzzy,
+            'conjugator': self.conjugator,
+        }
+        return {name: deep_sizeof(part, seen) for name, part in parts.items()}
+
+    # Поиск с ранжированием, не больше SEARCH_TOP_K строк:
+    # 0 - точное совпадение с формой (по хэш-таблице, работает и для запросов короче 3 символов),
+    # 1 - форма начинается с запроса, 2 - запрос внутри формы, 3 - совпадение только в переводе.
+    # Внутри одного уровня сохраняется порядок файла
+    # Поиск не создаёт коллекций по числу кандидатов: списки postings пересекаются слиянием прямо
+    # при ранжировании, кандидаты проверяются поиском подстроки в готовых строках нижнего регистра,
+    # а на каждом уровне хранится не больше SEARCH_TOP_K номеров
+    def search(self, query):
+        query = query.lower().replace(FORMS_SEPARATOR, '')
+        exact = self.exact_ids(query)
+        if len(query) < 3 or len(exact) >= SEARCH_TOP_K:
+            return list(exact[:SEARCH_TOP_K])
+        postings = sorted((self.postings.get(gram, ()) for gram in self.trigrams(query)), key=len)
+        if not postings[0]:
+            return list(exact)
+        return self.ranked(exact, self.intersect(postings, exact), query)
+
+    # Номера строк из всех списков postings, кроме skip, по возрастанию: обход самого короткого списка,
+    # в остальных - двоичный поиск вперёд от предыдущей найденной позиции
+    @staticmethod
+    def intersect(postings, skip):
+        first, rest = postings[0], postings[1:]
+        positions = [0] * len(rest)
+        for row_id in first:
+            for i in range(len(rest)):
+                posting = rest[i]
+                position = bisect.bisect_left(posting, row_id, positions[i])
+                if position == len(posting):
+                    return
+                positions[i] = position
+                if posting[position] != row_id:
+                    break
+            else:
+                if row_id not in skip:
+                    yield row_id
+
+    # Тот же результат, что и search(query), но среди строк, найденных по началу запроса.
+    # Годится, только если тот результат не был усечён и начало запроса не короче 3 символов
+    def refine(self, row_ids, query):
+        query = query.lower().replace(FORMS_SEPARATOR, '')
+        exact = self.exact_ids(query)
+        if len(exact) >= SEARCH_TOP_K:
+            return list(exact[:SEARCH_TOP_K])
+        return self.ranked(exact, (row_id for row_id in sorted(row_ids) if row_id not in exact), query)
+
+    # Уровни 1-3 для кандидатов по возрастанию номера; строки без совпадения отбрасываются
+    def ranked(self, exact, candidates, query):
+        limit = SEARCH_TOP_K - len(exact)
+        levels = ([], [], [])
+        prefix = FORMS_SEPARATOR + query
+        texts = self.texts
+        lowered = self.lowered
+        for row_id in candidates:
+            text = texts[row_id]
+            if prefix in text:
+                level = levels[0]
+            elif query in text:
+                level = levels[1]
+            elif query in lowered[row_id][4]:
+                level = levels[2]
+            else:
+                continue
+            if len(level) < limit:
+                level.append(row_id)
+                if len(levels[0]) == limit:
+                    break
+        return list(exact) + (levels[0] + levels[1] + levels[2])[:limit]
+
+    # Результат запроса для кэша: (номера строк, первая страница ответа).
+    # Если ничего не найдено, предлагаются ближайшие по написанию глаголы
+    def search_entry(self, query):
+        row_ids = tuple(self.search(query))
+        if row_ids:
+            return row_ids, render_search_page(self, row_ids, 0)
+        row_ids = tuple(self.fuzzy.search(query))
+        return row_ids, render_page(FUZZY_HEADER, [self.cards[row_id] for row_id in row_ids], "\n\n", 0)
+
+
+# Поиск с опечатками (расстояние редактирования до FUZZY_MAX_DISTANCE) по индексу удалений в духе SymSpell:
+# для каждой формы заранее сохраняются все варианты с удалёнными символами (в пределах первых
+# FUZZY_PREFIX_LENGTH букв), поэтому при запросе проверяется лишь небольшое число кандидатов.
+# æ/ø/å приравниваются к ae/oe/aa, префиксы "å " и "har " не учитываются
+FUZZY_MAX_DISTANCE = 2
+FUZZY_PREFIX_LENGTH = 7
+FUZZY_MAX_CANDIDATES = int(os.getenv("FUZZY_MAX_CANDIDATES", "300"))
+FUZZY_MAX_RESULTS = int(os.getenv("FUZZY_MAX_RESULTS", "5"))
+FUZZY_TIME_BUDGET = float(os.getenv("FUZZY_TIME_BUDGET", "0.02"))  # секунд на один запрос
+FUZZY_HEADER = "Точных совпадений нет. <b>Возможно, вы имели в виду:</b>\n"
+FUZZY_TRANSLATION = str.maketrans({'æ': 'ae', 'ø': 'oe', 'å': 'aa'})
+
+
+def fuzzy_key(text):
+    text = text.lower().strip()
+    for prefix in ('å ', 'aa ', 'har '):
+        if text.startswith(prefix):
+            text = text[len(prefix):]
+    return text.translate(FUZZY_TRANSLATION)
+
+
+def deletions(word, depth):
+    result = {word}
+    frontier = {word}
+    for _ in range(depth):
+        frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))}
+        result |= frontier
+    return result
+
+
+# Расстояние Дамерау-Левенштейна (с перестановкой соседних букв); при превышении limit - limit + 1
+def edit_distance(a, b, limit):
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            value = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                value = min(value, previous2[j - 2] + 1)
+            current[j] = value
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+class FuzzyIndex:
+    def __init__(self):
+        self.keys = {}       # нормализованная форма -> номер строки или кортеж номеров
+        self.deletes = {}    # вариант с удалениями -> нормализованная форма или кортеж форм
+
+    # items - пары (форма, номера строк)
+    def add_many(self, items):
+        new_keys = {}
+        for form, row_ids in items:
+            new_keys.setdefault(fuzzy_key(form), []).extend(row_ids)
+        new_deletes = {}
+        for key, row_ids in new_keys.items():
+            if key not in self.keys:
+                for variant in deletions(key[:FUZZY_PREFIX_LENGTH], FUZZY_MAX_DISTANCE):
+                    new_deletes.setdefault(variant, []).append(key)
+            self.keys[key] = merge_index_values(self.keys.get(key), row_ids)
+        shared = {}  # у соседних вариантов часто один и тот же набор форм - он хранится одним кортежем
+        for variant, keys in new_deletes.items():
+            keys = merge_index_values(self.deletes.get(variant), keys)
+            self.deletes[variant] = shared.setdefault(keys, keys)
+
+    def search(self, query):
+        query = fuzzy_key(query)
+        if len(query) < 3:
+            return []
+        deadline = time.perf_counter() + FUZZY_TIME_BUDGET
+        checked = set()
+        best = {}  # номер строки -> расстояние
+        for variant in deletions(query[:FUZZY_PREFIX_LENGTH], FUZZY_MAX_DISTANCE):
+            for key in index_values(self.deletes.get(variant)):
+                if key in checked:
+                    continue
+                checked.add(key)
+                distance = edit_distance(query, key, FUZZY_MAX_DISTANCE)
+                if distance <= FUZZY_MAX_DISTANCE:
+                    for row_id in index_values(self.keys[key]):
+                        best[row_id] = min(distance, best.get(row_id, distance))
+                if len(checked) >= FUZZY_MAX_CANDIDATES or time.perf_counter() > deadline:
+                    break
+            else:
+                continue
+            break
+        return sorted(best, key=lambda row_id: (best[row_id], row_id))[:FUZZY_MAX_RESULTS]
+
+
+SEARCH_TOP_K = int(os.getenv("SEARCH_TOP_K", "50"))
+
+
+def render_verb_card(row):
+    infinitiv, presens, preteritum, perfektum, translation = row
+    return (
+        f"<b>Infinitiv:</b> {infinitiv}\n"
+        f"<b>Presens:</b> {presens}\n"
+        f"<b>Preteritum:</b> {preteritum}\n"
+        f"<b>Presens perfektum:</b> {perfektum}\n"
+        f"<b>Перевод:</b> {translation}"
+    )
+
+
+# Первая и последующие страницы поиска: (текст, начало следующей страницы или None)
+def render_search_page(search_index, row_ids, start):
+    cards = [search_index.cards[row_id] for row_id in row_ids[start:start + PAGE_MAX_ITEMS + 1]]
+    return render_page("<b>Найденные совпадения:</b>\n", cards, "\n\n", start)
+
+
+# Постраничный вывод: страница ограничена и числом элементов, и длиной текста
+# (лимит Telegram - 4096 символов), поэтому рендерится только текущая страница
+PAGE_MAX_ITEMS = int(os.getenv("PAGE_MAX_ITEMS", "10"))
+PAGE_MAX_CHARS = 3500
+
+
+# items - до PAGE_MAX_ITEMS + 1 элементов начиная с позиции start
+def render_page(header, items, separator, start):
+    page = []
+    size = len(header)
+    for item in items[:PAGE_MAX_ITEMS]:
+        item = item[:PAGE_MAX_CHARS - len(header)]
+        if page and size + len(separator) + len(item) > PAGE_MAX_CHARS:
+            break
+        page.append(item)
+        size += len(separator) + len(item)
+    next_start = start + len(page) if len(page) < len(items) else None
+    return header + separator.join(page), next_start
+
+
+# LRU-кэш готовых ответов на поисковые запросы. Используется только из цикла событий;
+# сбрасывается, когда меняется версия словаря
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+
+
+class ResponseCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, version, value):
+        if version != self.version:
+            return
+        self.entries[key] = value
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+def build_search_index(rows):
+    index = VerbSearchIndex()
+    index.add_many(rows)
+    return index
+
+
+# Модерация: хэш-множества известных инфинитивов (без регистра и без "å ") для проверки
+# дубликатов за O(1). Предложения хранятся в порядке id, номер в списке Anbefalinger - позиция в нём.
+# Изменяющие методы вызываются только в потоке-писателе
+class Moderation:
+    def __init__(self, storage, verb_rows):
+        self.storage = storage
+        self.verb_keys = {normalize_infinitiv(row[0]) for row in verb_rows}
+        self.local_verb_ids = set()  # id глаголов, добавленных этим процессом и ещё не учтённых синхронизацией
+        self.reload_suggestions()
+
+    def reload_suggestions(self):
+        self.suggestions = {}  # id предложения -> инфинитив
+        self.suggested = defaultdict(set)  # нормализованный инфинитив -> id предложений
+        self.ids = []  # id предложений по возрастанию - порядок списка Anbefalinger (ORDER BY id)
+        for row in self.storage.suggestions():
+            self.track_suggestion(row[0], row[1])
+
+    def track_suggestion(self, suggestion_id, infinitiv):
+        self.suggestions[suggestion_id] = infinitiv
+        self.suggested[normalize_infinitiv(infinitiv)].add(suggestion_id)
+        bisect.insort(self.ids, suggestion_id)
+
+    def untrack_key(self, infinitiv, suggestion_id):
+        key = normalize_infinitiv(infinitiv)
+        ids = self.suggested[key]
+        ids.discard(suggestion_id)
+        if not ids:
+            del self.suggested[key]
+
+    def forget_suggestions(self, suggestion_ids):
+        for suggestion_id in suggestion_ids:
+            self.untrack_key(self.suggestions.pop(suggestion_id), suggestion_id)
+        forgotten = set(suggestion_ids)
+        if forgotten:
+            self.ids = [suggestion_id for suggestion_id in self.ids if suggestion_id not in forgotten]
+
+    def has_verb(self, infinitiv):
+        return normalize_infinitiv(infinitiv) in self.verb_keys
+
+    def has_suggestion(self, infinitiv):
+        return normalize_infinitiv(infinitiv) in self.suggested
+
+    # Номера из Anbefalinger (от 0) -> id предложений; номера за концом списка пропускаются
+    def select(self, numbers):
+        ids = self.ids
+        return [ids[number] for number in numbers if number < len(ids)]
+
+    def add_suggestion(self, row):
+        self.track_suggestion(self.storage.add_suggestion(row), row[0])
+
+    # False, если предложение уже удалено или принято
+    def edit(self, suggestion_id, verb_row):
+        if suggestion_id not in self.suggestions:
+            return False
+        self.storage.update_suggestion(suggestion_id, verb_row)
+        # позиция в списке не меняется, переносится только ключ для проверки дубликатов
+        self.untrack_key(self.suggestions[suggestion_id], suggestion_id)
+        self.suggestions[suggestion_id] = verb_row[0]
+        self.suggested[normalize_infinitiv(verb_row[0])].add(suggestion_id)
+        return True
+
+    # Без списка id удаляются все предложения. Возвращает удалённые инфинитивы
+    def reject(self, suggestion_ids=None):
+        if suggestion_ids is None:
+            names = [self.suggestions[suggestion_id] for suggestion_id in self.ids]
+            self.storage.delete_suggestions()
+            self.suggestions.clear()
+            self.suggested.clear()
+            self.ids = []
+            return names
+        names = [self.suggestions[suggestion_id] for suggestion_id in suggestion_ids]
+        self.storage.delete_suggestions(suggestion_ids)
+        self.forget_suggestions(suggestion_ids)
+        return names
+
+    # Перенос предложений в словарь одной транзакцией; возвращает (добавленные строки, дубликаты)
+    def accept(self, suggestion_ids=None):
+        suggestion_ids = list(self.ids) if suggestion_ids is None else suggestion_ids
+        added, duplicates, keys = [], [], set()
+        for row in self.storage.suggestion_rows(suggestion_ids):
+            key = normalize_infinitiv(row[0])
+            if key in self.verb_keys or key in keys:
+                duplicates.append(row[0])
+            else:
+                keys.add(key)
+                added.append(row)
+        self.local_verb_ids.update(self.storage.move_verbs(added, suggestion_ids))
+        self.verb_keys |= keys
+        self.forget_suggestions(suggestion_ids)
+        return added, duplicates
+
+    # Добавление глаголов админом: строки, уже стоящие в словаре, пропускаются, а совпавшие с
+    # ожидающими предложениями закрывают эти предложения.
+    # Возвращает (добавленные строки, дубликаты, закрытые предложения)
+    def add_verbs(self, rows):
+        added, duplicates, keys = [], [], set()
+        for row in rows:
+            key = normalize_infinitiv(row[0])
+            if key in self.verb_keys or key in keys:
+                duplicates.append(row[0])
+            else:
+                keys.add(key)
+                added.append(row)
+        resolved_ids = [suggestion_id for key in keys for suggestion_id in self.suggested.get(key, ())]
+        resolved = sorted({self.suggestions[suggestion_id] for suggestion_id in resolved_ids})
+        self.local_verb_ids.update(self.storage.move_verbs(added, resolved_ids))
+        self.verb_keys |= keys
+        self.forget_suggestions(resolved_ids)
+        return added, duplicates, resolved
+
+
+# Выбор строк: номера и диапазоны через запятую, например "1-50, 73" (номера от 1 до count).
+# Возвращает номера от 0 по возрастанию; ValueError при ошибке формата, IndexError при номере вне
+# диапазона (проверяется до разворачивания диапазона, так что "1-2000000000" не занимает память)
+def parse_selection(text, count):
+    numbers = set()
+    for part in text.split(','):
+        first, dash, last = part.partition('-')
+        first = int(first.strip())
+        last = int(last.strip()) if dash else first
+        if first > last:
+            raise ValueError(part)
+        if first < 1 or last > count:
+            raise IndexError(part)
+        numbers.update(range(first - 1, last))
+    return sorted(numbers)
+
+
+# Активность пользователей: изменения копятся в памяти (по User_ID) и
+# записываются в базу одной транзакцией раз в CONTACTS_FLUSH_INTERVAL секунд и при остановке
+CONTACTS_FLUSH_INTERVAL = int(os.getenv("CONTACTS_FLUSH_INTERVAL", "30"))
+
+
+class Contact:
+    __slots__ = ('username', 'contact', 'location', 'device', 'last_active')
+
+    def __init__(self, username, contact, location, device, last_active):
+        self.username = username
+        self.contact = contact
+        self.location = location
+        self.device = device
+        self.last_active = last_active
+
+    def values(self):
+        return self.username, self.contact, self.location, self.device, self.last_active
+
+
+class ContactTracker:
+    def __init__(self, rows):
+        self.contacts = {row[0]: Contact(*row[1:]) for row in rows}  # User_ID -> Contact
+        self.pending = {}  # User_ID -> (Username, Contact, Last_Active), ещё не записано
+        self.touches = 0   # сколько раз обновлялась активность
+        self.written = 0   # сколько строк реально записано в базу
+
+    def touch(self, user_id, username, contact, last_active):
+        self.touches += 1
+        entry = self.contacts.get(user_id)
+        if entry is None:
+            entry = self.contacts[user_id] = Contact(username, contact, None, None, last_active)
+        else:
+            entry.username = username
+            entry.last_active = last_active
+        self.pending[user_id] = (username, entry.contact, last_active)
+
+    # Перечитать контакты из базы (их обновили другие процессы), сохранив ещё не записанное
+    def reload(self, rows):
+        contacts = {row[0]: Contact(*row[1:]) for row in rows}
+        for user_id, (username, contact, last_active) in list(self.pending.items()):
+            entry = contacts.get(user_id)
+            if entry is None:
+                contacts[user_id] = Contact(username, contact, None, None, last_active)
+            else:
+                entry.username = username
+                entry.last_active = last_active
+        self.contacts = contacts
+
+    def take_pending(self):
+        pending, self.pending = self.pending, {}
+        return [(user_id, *values) for user_id, values in pending.items()]
+
+    # Сколько записей удалось объединить с более поздними
+    @property
+    def coalesced(self):
+        return self.touches - self.written - len(self.pending)
+
+    def rows_page(self, offset, limit):
+        return [(user_id, *entry.values()) for user_id, entry in islice(self.contacts.items(), offset, offset + limit)]
+
+
+# Синхронизация с изменениями других процессов (WORKERS > 1) и внешних программ: раз в SYNC_INTERVAL
+# секунд сверяются версии из meta и перечитывается только изменившееся. Выполняется в потоке-писателе,
+# поэтому не пересекается с собственными записями процесса
+SYNC_INTERVAL = float(os.getenv("SYNC_INTERVAL", "2"))
+
+
+class SharedStateSync:
+    def __init__(self, state):
+        self.verb_id, self.versions = state  # до какого id глаголы уже в индексе, последние увиденные версии
+
+    def sync(self, bot_data):
+        storage = bot_data['storage']
+        moderation = bot_data['moderation']
+        max_verb_id, versions = storage.sync_state()
+        changed = {key for key, value in versions.items() if self.versions.get(key) != value}
+        if 'verbs_generation' in changed:
+            rows = [tuple(row) for row in storage.verbs(max_verb_id)]
+            index = build_search_index(rows)
+            index.version += bot_data['search_index'].version  # чтобы кэши ответов не приняли его за старый
+            bot_data['search_index'] = index
+            moderation.verb_keys = {normalize_infinitiv(row[0]) for row in rows}
+            moderation.local_verb_ids.clear()
+        elif 'verbs_version' in changed:
+            rows = [tuple(row[1:]) for row in storage.verbs_after(self.verb_id, max_verb_id)
+                    if row[0] not in moderation.local_verb_ids]
+            bot_data['search_index'].add_many(rows)
+            moderation.verb_keys.update(normalize_infinitiv(row[0]) for row in rows)
+            moderation.local_verb_ids = {verb_id for verb_id in moderation.local_verb_ids if verb_id > max_verb_id}
+        if 'suggestions_version' in changed:
+            moderation.reload_suggestions()
+        if 'contacts_version' in changed:
+            bot_data['contact_tracker'].reload(storage.contacts())
+        self.verb_id, self.versions = max_verb_id, versions
+        return changed
+
+
+STARTUP_SECONDS = time.perf_counter() - STARTED_AT
+STARTUP_RSS_MB = current_rss_mb()
+logger.info("Данные загружены за %.2f с, память процесса: %.1f МБ", STARTUP_SECONDS, STARTUP_RSS_MB)
+
+
+# Клавиатуры создаются один раз при загрузке и переиспользуются во всех ответах
+ADMIN_KEYBOARD = ReplyKeyboardMarkup([
+    ['Старт', 'Добавить', 'Quiz'],
+    ['Anbefalinger', 'Kontaktperson']
+], resize_keyboard=True)
+USER_KEYBOARD = ReplyKeyboardMarkup([
+    ['Старт', 'Legg til ord', 'Quiz']
+], resize_keyboard=True)
+ANBEFALINGER_KEYBOARD = ReplyKeyboardMarkup([
+    ['Добавить номер', 'Добавить всё'],
+    ['Удалить номер', 'Удалить всё'],
+    ['Редактировать номер'],
+    ['Назад']
+], resize_keyboard=True)
+CANCEL_KEYBOARD = ReplyKeyboardMarkup([['Отмена']], resize_keyboard=True)
+BACK_KEYBOARD = ReplyKeyboardMarkup([['Назад']], resize_keyboard=True)
+QUIZ_KEYBOARD = ReplyKeyboardMarkup([['Не знаю'], ['Назад']], resize_keyboard=True)
 
 
 # Определение клавиатуры
-def get_keyboard(infinitiv, df_verbs, update):
+def get_keyboard(update):
     user_id = update.effective_user.id
-    if user_id == 509114893:  # Клавиатура для администратора
-        return ReplyKeyboardMarkup([
-            ['Старт', 'Добавить'],
-            ['Anbefalinger', 'Kontaktperson']
-        ], resize_keyboard=True)
+    if is_admin(user_id):  # Клавиатура для администратора
+        return ADMIN_KEYBOARD
     else:  # Клавиатура для обычных пользователей
-        return ReplyKeyboardMarkup([
-            ['Старт', 'Legg til ord']
-        ], resize_keyboard=True)
+        return USER_KEYBOARD
 
 
 # Клавиатура для Anbefalinger
 def get_anbefalinger_keyboard():
-    return ReplyKeyboardMarkup([
-        ['Добавить номер', 'Добавить всё'],
-        ['Удалить номер', 'Удалить всё'],
-        ['Редактировать номер'],
-        ['Назад']
-    ], resize_keyboard=True)
+    return ANBEFALINGER_KEYBOARD
 
 
 # Клавиатура для отмены ввода
 def get_cancel_keyboard():
-    return ReplyKeyboardMarkup([['Отмена']], resize_keyboard=True)
+    return CANCEL_KEYBOARD
 
 
 # Клавиатура для возврата из Kontaktperson, Anbefalinger или Legg til ord
 def get_back_keyboard():
-    return ReplyKeyboardMarkup([['Назад']], resize_keyboard=True)
+    return BACK_KEYBOARD
+
+
+# Результат поиска из кэша или из потока-читателя: (номера строк, первая страница)
+async def cached_search(context, query):
+    search_index = context.bot_data['search_index']
+    response_cache = context.bot_data['response_cache']
+    version = search_index.version
+    entry = response_cache.get(query, version)
+    if entry is None:
+        with metrics.timer('search'):
+            entry = await run_read(search_index.search_entry, query)
+        response_cache.put(query, version, entry)
+    return entry
+
+
+# Inline-режим (@бот legge в любом чате; включается в BotFather командой /setinline).
+# Ответ - до INLINE_MAX_RESULTS карточек; Telegram кэширует его на INLINE_CACHE_TIME секунд для всех
+# пользователей. У нас результаты хранятся в отдельном LRU по запросу: при наборе "leg" -> "legg" -> "legge"
+# следующий запрос ищется только среди строк предыдущего, если тот результат был полным.
+# Частые запросы одного пользователя при наборе прореживает PerUserUpdateProcessor
+INLINE_MAX_RESULTS = int(os.getenv("INLINE_MAX_RESULTS", "20"))
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "300"))
+INLINE_DEBOUNCE = float(os.getenv("INLINE_DEBOUNCE", "0.4"))  # секунд тишины перед ответом
+INLINE_MIN_LENGTH = 2
+
+
+def inline_article(search_index, row_id):
+    infinitiv, presens, preteritum, perfektum, translation = search_index.rows[row_id]
+    return InlineQueryResultArticle(
+        id=str(row_id),
+        title=f"{infinitiv} - {translation}",
+        description=f"{presens}, {preteritum}, {perfektum}",
+        input_message_content=InputTextMessageContent(search_index.cards[row_id], parse_mode='HTML'),
+    )
+
+
+# Запись кэша: (все найденные строки, полон ли результат, готовые результаты для ответа,
+# найдены ли строки с исправлением опечатки)
+def inline_entry(search_index, query, base_row_ids=None):
+    if base_row_ids is None:
+        row_ids = search_index.search(query)
+    else:
+        row_ids = search_index.refine(base_row_ids, query)
+    complete = len(query) >= 3 and len(row_ids) < SEARCH_TOP_K
+    fuzzy = False
+    if not row_ids:
+        row_ids = search_index.fuzzy.search(query)
+        complete = False
+        fuzzy = bool(row_ids)
+    return (tuple(row_ids), complete,
+            [inline_article(search_index, row_id) for row_id in row_ids[:INLINE_MAX_RESULTS]], fuzzy)
+
+
+# Запись кэша для запроса (см. inline_entry)
+async def cached_inline_results(context, query):
+    search_index = context.bot_data['search_index']
+    inline_cache = context.bot_data['inline_cache']
+    version = search_index.version
+    entry = inline_cache.get(query, version)
+    if entry is not None:
+        return entry
+    base_row_ids = None
+    for length in range(len(query) - 1, 2, -1):
+        prefix_entry = inline_cache.entries.get(query[:length])
+        if prefix_entry is not None and prefix_entry[1]:
+            base_row_ids = prefix_entry[0]
+            metrics.inc('inline_refined')
+            break
+    with metrics.timer('search'):
+        entry = await run_read(inline_entry, search_index, query, base_row_ids)
+    inline_cache.put(query, version, entry)
+    return entry
+
+
+@timed('inline_query')
+async def handle_inline_query(update: Update, context: ContextTypes):
+    query = update.inline_query.query.strip().lower()
+    if len(query) < INLINE_MIN_LENGTH:
+        await update.inline_query.answer([], cache_time=INLINE_CACHE_TIME, is_personal=False)
+        return
+    started = time.perf_counter()
+    row_ids, _, results, fuzzy = await cached_inline_results(context, query)
+    metrics.inc('inline_hit' if results else 'inline_miss')
+    outcome = SEARCH_MISS if not row_ids else SEARCH_FUZZY if fuzzy else SEARCH_HIT
+    infinitiv = context.bot_data['search_index'].rows[row_ids[0]][0] if row_ids else None
+    context.bot_data['analytics'].record(update.effective_user.id, query, outcome, infinitiv,
+                                         time.perf_counter() - started)
+    await update.inline_query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=False)
+
+
+# Страница списка по курсору из user_data: (текст, начало следующей страницы или None)
+async def render_cursor_page(context, cursor, page):
+    with metrics.timer('render'):
+        return await render_cursor_page_unmeasured(context, cursor, page)
+
+
+async def render_cursor_page_unmeasured(context, cursor, page):
+    start = cursor['starts'][page]
+    if cursor['kind'] == 'search':
+        row_ids, first_page = await cached_search(context, cursor['query'])
+        if start == 0:
+            return first_page
+        return render_search_page(context.bot_data['search_index'], row_ids, start)
+    if cursor['kind'] == 'suggestions':
+        rows = await run_read(context.bot_data['storage'].suggestions_page, start, PAGE_MAX_ITEMS + 1)
+        lines = [f"{start + idx + 1}. {', '.join(str(value) for value in row[1:6])}" for idx, row in enumerate(rows)]
+        return render_page("Список предложенных слов:\n", lines, "\n", start)
+    if cursor['kind'] == 'contacts':
+        rows = context.bot_data['contact_tracker'].rows_page(start, PAGE_MAX_ITEMS + 1)
+        lines = [f"{start + idx + 1}. ID: {contact_id}, @{username or 'N/A'}, Contact: {contact or 'N/A'}"
+                 for idx, (contact_id, username, contact, *_) in enumerate(rows)]
+        return render_page("Список пользователей бота:\n", lines, "\n", start)
+    raise ValueError(f"Неизвестный список: {cursor['kind']}")
+
+
+# Кнопки "назад/вперёд" под страницей
+def get_page_keyboard(cursor, page):
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀", callback_data=f"page:{cursor['token']}:{page - 1}"))
+    if page + 1 < len(cursor['starts']):
+        buttons.append(InlineKeyboardButton("▶", callback_data=f"page:{cursor['token']}:{page + 1}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+# Отправка первой страницы списка. Если страниц несколько, курсор сохраняется в user_data,
+# а обычная клавиатура (если она меняется) уходит отдельным сообщением с footer
+async def send_paged(update, context, kind, reply_markup, footer='', first_page=None, **cursor_fields):
+    cursor = {'kind': kind, 'token': context.user_data.get('pager', {}).get('token', 0) + 1, 'starts': [0],
+              **cursor_fields}
+    text, next_start = first_page or await render_cursor_page(context, cursor, 0)
+    if next_start is None:
+        await update.message.reply_text(text + footer, reply_markup=reply_markup, parse_mode='HTML')
+        return
+    cursor['starts'].append(next_start)
+    context.user_data['pager'] = cursor
+    await update.message.reply_text(text, reply_markup=get_page_keyboard(cursor, 0), parse_mode='HTML')
+    if footer:
+        await update.message.reply_text(footer.strip(), reply_markup=reply_markup, parse_mode='HTML')
+
+
+# Обработка кнопок "назад/вперёд"
+@timed('page_button')
+async def handle_page_button(update: Update, context: ContextTypes):
+    query = update.callback_query
+    try:
+        _, token, page = query.data.split(':')
+        token, page = int(token), int(page)
+    except ValueError:  # испорченные данные кнопки
+        token, page = None, -1
+    cursor = context.user_data.get('pager')
+    if (not cursor or cursor['token'] != token or not 0 <= page < len(cursor['starts'])
+            or (cursor['kind'] != 'search' and not is_admin(update.effective_user.id))):
+        await query.answer("Список устарел, запросите его заново.")
+        return
+    text, next_start = await render_cursor_page(context, cursor, page)
+    if next_start is not None and len(cursor['starts']) == page + 1:
+        cursor['starts'].append(next_start)
+    await query.edit_message_text(text, reply_markup=get_page_keyboard(cursor, page), parse_mode='HTML')
+    await query.answer()
+
+
+# Добавление глаголов в базу и в поисковый индекс (в потоке-писателе).
+# Индекс берётся уже в потоке-писателе: стоявшая раньше в очереди синхронизация могла его подменить.
+# Возвращает (добавленные строки, дубликаты, закрытые предложения)
+async def add_verbs(context, rows):
+    bot_data = context.bot_data
+    moderation = bot_data['moderation']
+
+    def write():
+        added, duplicates, resolved = moderation.add_verbs(rows)
+        bot_data['search_index'].add_many(added)
+        return added, duplicates, resolved
+
+    return await run_write(write)
+
+
+# Перенос предложений с выбранными номерами (по умолчанию всех) в словарь (в потоке-писателе)
+async def accept_suggestions(context, numbers=None):
+    bot_data = context.bot_data
+    moderation = bot_data['moderation']
+
+    def write():
+        added, duplicates = moderation.accept(None if numbers is None else moderation.select(numbers))
+        bot_data['search_index'].add_many(added)
+        return [row[0] for row in added], duplicates
+
+    return await run_write(write)
+
+
+# Массовый импорт: вставленный текст или файл CSV/TSV любого размера. Строки разбираются потоково,
+# ошибочные пропускаются с номером строки, остальные записываются одной транзакцией
+IMPORT_MAX_FILE_BYTES = 20 * 1024 * 1024  # больше Bot API не отдаёт через getFile
+IMPORT_REPORT_ITEMS = 30
+
+
+class ImportResult:
+    __slots__ = ('rows', 'errors', 'repeated', 'filled', 'added', 'duplicates', 'resolved')
+
+    def __init__(self):
+        self.rows = []        # разобранные строки без повторов внутри файла
+        self.errors = []      # (номер строки, причина)
+        self.repeated = []    # инфинитивы, повторённые внутри файла
+        self.filled = []      # строки "инфинитив, перевод", формы которых подобраны автоматически
+        self.added = []
+        self.duplicates = []
+        self.resolved = []    # предложения, закрытые импортом
+
+
+# Строка из двух полей (инфинитив, перевод) дополняется формами от conjugator.
+# Текст читается одним csv.reader, поэтому поле в кавычках может занимать несколько строк; номера строк
+# в ошибках берутся из reader.line_num. После ошибки CSV (незакрытая кавычка и т.п.) границы записей
+# неизвестны, поэтому разбор останавливается: уже разобранные строки импортируются, остальные - нет
+def parse_verb_lines(lines, delimiter=',', conjugator=None):
+    result = ImportResult()
+    seen = set()
+    reader = csv.reader(lines, delimiter=delimiter, strict=True)
+    while True:
+        number = reader.line_num + 1  # первая строка записи
+        try:
+            fields = next(reader)
+        except StopIteration:
+            break
+        except csv.Error as error:
+            result.errors.append((reader.line_num, f"ошибка CSV: {error}, дальнейшие строки не разобраны"))
+            break
+        if not any(field.strip() for field in fields):
+            continue
+        if number == 1 and fields[0].strip().lower().startswith('infinitiv'):
+            continue  # заголовок, как в 1_norwegian_verbs.csv
+        if len(fields) == 2 and conjugator is not None and fields[0].strip():
+            row = conjugator.complete_row(*fields)
+            result.filled.append(row)
+        elif len(fields) != 5:
+            result.errors.append((number, f"ожидалось 5 полей, получено {len(fields)}"))
+            continue
+        else:
+            row = tuple(field.strip() for field in fields)
+        if not row[0]:
+            result.errors.append((number, "пустой инфинитив"))
+        elif '\n' in row[0] or '\r' in row[0]:
+            result.errors.append((number, "перенос строки в инфинитиве"))
+        elif normalize_infinitiv(row[0]) in seen:
+            result.repeated.append(row[0])
+        else:
+            seen.add(normalize_infinitiv(row[0]))
+            result.rows.append(row)
+    return result
+
+
+# Разделитель определяется по первой строке: табуляция - TSV, иначе CSV
+def parse_verb_file(path, conjugator=None):
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        delimiter = '\t' if '\t' in f.readline() else ','
+        f.seek(0)
+        return parse_verb_lines(f, delimiter, conjugator)
+
+
+def format_names(names):
+    shown = ', '.join(names[:IMPORT_REPORT_ITEMS])
+    return shown + (f" и ещё {len(names) - IMPORT_REPORT_ITEMS}" if len(names) > IMPORT_REPORT_ITEMS else "")
+
+
+def format_verb_line(row):
+    return ','.join(row)
+
+
+def format_import_report(result):
+    response = "Результат добавления:\n"
+    if result.added:
+        names = format_names([row[0] for row in result.added])
+        response += f"Успешно добавлены глаголы ({len(result.added)}): {names}\n"
+    if result.duplicates:
+        response += f"Уже существуют в базе ({len(result.duplicates)}): {format_names(result.duplicates)}\n"
+    added = set(result.added)
+    filled = [row for row in result.filled if row in added]
+    if filled:
+        response += f"Формы подобраны автоматически ({len(filled)}), проверьте:\n"
+        response += "\n".join(format_verb_line(row) for row in filled[:IMPORT_REPORT_ITEMS]) + "\n"
+    if result.resolved:
+        response += f"Закрыты предложения ({len(result.resolved)}): {format_names(result.resolved)}\n"
+    if result.repeated:
+        response += f"Повторяются в списке ({len(result.repeated)}): {format_names(result.repeated)}\n"
+    if result.errors:
+        response += f"Ошибки в строках ({len(result.errors)}):\n"
+        response += "\n".join(f"{number}: {reason}" for number, reason in result.errors[:IMPORT_REPORT_ITEMS])
+        if len(result.errors) > IMPORT_REPORT_ITEMS:
+            response += f"\n... и ещё {len(result.errors) - IMPORT_REPORT_ITEMS}"
+    if not (result.added or result.duplicates or result.repeated or result.errors):
+        response += "Нет строк для добавления."
+    return response.strip()
+
+
+# Запись разобранного импорта в базу и в поисковый индекс (в потоке-писателе)
+async def import_verbs(context, result):
+    if result.rows:
+        result.added, result.duplicates, result.resolved = await add_verbs(context, result.rows)
+    metrics.inc('admin_add')
+    metrics.inc('import_rows', len(result.added))
+    return result
 
 
 # Команда /start
+@timed('start')
 async def start(update: Update, context: ContextTypes):
-    df_verbs = context.bot_data['df_verbs']
-    df_contacts = context.bot_data['df_contacts']
     user_id = update.effective_user.id
 
     # Исключаем ваш ID из записи в 1_Kontakt
-    if user_id != 509114893:
+    if not is_admin(user_id):
         username = update.effective_user.username or "N/A"
         contact = "N/A"
         last_active = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-        # Обновляем или добавляем пользователя в 1_Kontakt.csv
-        if user_id in df_contacts['User_ID'].values:
-            df_contacts.loc[df_contacts['User_ID'] == user_id, 'Last_Active'] = last_active
-            df_contacts.loc[df_contacts['User_ID'] == user_id, 'Username'] = username
-        else:
-            new_contact = pd.DataFrame({
-                'User_ID': [user_id],
-                'Username': [username],
-                'Contact': [contact],
-                'Last_Active': [last_active]
-            })
-            df_contacts = pd.concat([df_contacts, new_contact], ignore_index=True)
-        df_contacts.to_csv(CONTACTS_FILE_PATH, index=False, encoding='utf-8')
-        context.bot_data['df_contacts'] = df_contacts
+        # Обновляем или добавляем пользователя в контакты (запись в базу - отложенная)
+        context.bot_data['contact_tracker'].touch(user_id, username, contact, last_active)
 
     await update.message.reply_text(
         "Привет! Введи норвежский глагол или перевод, и я покажу его формы!\n"
         "<b>Поиск работает по частичному совпадению (минимум 3 символа)</b>, например, 'legge' найдет все варианты с 'legge'.\n"
         "<b>Используй 'Legg til ord'</b>, чтобы предложить новое слово.",
-        reply_markup=get_keyboard('', df_verbs, update),
+        reply_markup=get_keyboard(update),
         parse_mode='HTML'
     )
 
 
-# Обработка запроса глагола
-async def handle_message(update: Update, context: ContextTypes):
-    df_verbs = context.bot_data['df_verbs']
-    df_suggestions = context.bot_data['df_suggestions']
-    df_contacts = context.bot_data['df_contacts']
-    user_id = update.effective_user.id
-    user_input = update.message.text.strip()
-    print(f"Получено сообщение: {user_input}")
+# Состояния диалога. Текущее хранится в user_data['state'] (по умолчанию MAIN); str-перечисление,
+# чтобы состояние без потерь сохранялось как обычная строка
+class State(str, Enum):
+    MAIN = 'main'
+    ADD = 'add'
+    SUGGESTION = 'suggestion'
+    ANBEFALINGER = 'anbefalinger'
+    ADD_NUMBERS = 'add_numbers'
+    DELETE_NUMBERS = 'delete_numbers'
+    EDIT_NUMBER = 'edit_number'
+    EDIT_SUGGESTION = 'edit_suggestion'
+    KONTAKTPERSON = 'kontaktperson'
+    QUIZ = 'quiz'
+
+
+# Состояния, в которых работают кнопки главного меню и поиск
+MENU_STATES = (State.MAIN, State.ANBEFALINGER, State.KONTAKTPERSON)
+ANBEFALINGER_STATES = (State.ANBEFALINGER, State.ADD_NUMBERS, State.DELETE_NUMBERS, State.EDIT_NUMBER,
+                       State.EDIT_SUGGESTION)
+
+# Таблица переходов: (состояние, команда в нижнем регистре) -> (обработчик, только для админа).
+# Ввод, не совпавший ни с одной командой, получает обработчик состояния из state_inputs, иначе идёт в поиск
+transitions = {}
+state_inputs = {}
+
+
+def on_command(states, *commands, admin_only=False):
+    def register(handler):
+        for state in states:
+            for command in commands:
+                transitions[(state, command)] = (handler, admin_only)
+        return handler
+    return register
+
+
+def on_input(state, admin_only=False):
+    def register(handler):
+        state_inputs[state] = (handler, admin_only)
+        return handler
+    return register
 
-    # Проверяем отмену ввода для "Добавить"
-    if user_input.lower() == "отмена" and 'pending_add' in context.user_data and user_id == 509114893:
-        context.user_data.pop('pending_add')
+
+def set_state(context, state):
+    if state == State.MAIN:
+        context.user_data.pop('state', None)
+        context.user_data.pop('suggestion_to_edit', None)
+        context.user_data.pop('number_to_edit', None)
+        context.user_data.pop('quiz_card', None)
+        context.user_data.pop('quiz_answered', None)
+    else:
+        context.user_data['state'] = state
+
+
+# Отмена ввода для "Добавить"
+@on_command([State.ADD], "отмена", admin_only=True)
+async def cancel_add(update, context, user_input):
+    set_state(context, State.MAIN)
+    await update.message.reply_text(
+        "Добавление отменено.",
+        reply_markup=get_keyboard(update)
+    )
+
+
+# Возврат из "Kontaktperson", "Anbefalinger" (с любого шага) и "Legg til ord"
+@on_command([State.SUGGESTION], "назад")
+@on_command([State.KONTAKTPERSON, *ANBEFALINGER_STATES], "назад", admin_only=True)
+async def back_to_menu(update, context, user_input):
+    set_state(context, State.MAIN)
+    await update.message.reply_text(
+        "Возврат в главное меню.",
+        reply_markup=get_keyboard(update)
+    )
+
+
+@on_command(MENU_STATES, "старт")
+async def restart(update, context, user_input):
+    await start(update, context)
+
+
+@on_command(MENU_STATES, "legg til ord")
+async def begin_suggestion(update, context, user_input):
+    set_state(context, State.SUGGESTION)
+    await update.message.reply_text(
+        "<b>Предложите слово в формате:</b> å danse,danser,danset,har danset,перевод\n"
+        "Или коротко: <b>å danse,перевод</b> - формы будут подобраны автоматически.\n"
+        "<b>Нажмите 'Назад'</b>, чтобы отменить.",
+        reply_markup=get_back_keyboard(),
+        parse_mode='HTML'
+    )
+
+
+# Предложение нового слова от пользователя
+@on_input(State.SUGGESTION)
+async def receive_suggestion(update, context, user_input):
+    moderation = context.bot_data['moderation']
+    user_id = update.effective_user.id
+    fields = user_input.split(',')
+    filled = len(fields) == 2 and fields[0].strip()
+    if filled:
+        fields = context.bot_data['search_index'].conjugator.complete_row(*fields)
+    try:
+        infinitiv, presens, preteritum, perfektum, translation = fields
+    except ValueError:
         await update.message.reply_text(
-            "Добавление отменено.",
-            reply_markup=get_keyboard('', df_verbs, update)
+            "<b>Неверный формат. Используй:</b> å danse,danser,danset,har danset,перевод "
+            "или å danse,перевод",
+            reply_markup=get_back_keyboard(),
+            parse_mode='HTML'
         )
         return
-
-    # Проверяем возврат из "Kontaktperson"
-    if user_input.lower() == "назад" and 'pending_kontaktperson' in context.user_data and user_id == 509114893:
-        context.user_data.pop('pending_kontaktperson')
+    set_state(context, State.MAIN)
+    if moderation.has_verb(infinitiv):
         await update.message.reply_text(
-            "Возврат в главное меню.",
-            reply_markup=get_keyboard('', df_verbs, update)
+            "<b>Dette ordet er allerede i ordboken.</b>",
+            reply_markup=get_keyboard(update),
+            parse_mode='HTML'
         )
         return
-
-    # Проверяем возврат из "Anbefalinger" с очисткой всех флагов
-    if user_input.lower() == "назад" and 'pending_anbefalinger' in context.user_data and user_id == 509114893:
-        context.user_data.pop('pending_anbefalinger', None)
-        context.user_data.pop('pending_add_numbers', None)
-        context.user_data.pop('pending_delete_numbers', None)
-        context.user_data.pop('pending_edit_number', None)
-        context.user_data.pop('number_to_edit', None)
+    if moderation.has_suggestion(infinitiv):
         await update.message.reply_text(
-            "Возврат в главное меню.",
-            reply_markup=get_keyboard('', df_verbs, update)
+            "<b>Dette forslaget er allerede under vurdering.</b>",
+            reply_markup=get_keyboard(update),
+            parse_mode='HTML'
         )
         return
+    username = update.effective_user.username or "N/A"
+    contact = "N/A"
+    await run_write(moderation.add_suggestion,
+                    (infinitiv, presens, preteritum, perfektum, translation, user_id, username, contact))
+    metrics.inc('suggestion')
+    response = "Спасибо! Слово предложено и отправлено на рассмотрение администратору."
+    if filled:
+        response += f"\nФормы подобраны автоматически: {format_verb_line(fields)}"
+    await update.message.reply_text(response, reply_markup=get_keyboard(update))
+
+
+@on_command(MENU_STATES, "добавить", admin_only=True)
+async def begin_add(update, context, user_input):
+    set_state(context, State.ADD)
+    await update.message.reply_text(
+        "Введите глаголы в формате: <b>å danse,danser,danset,har danset,перевод</b>\n"
+        "Каждый глагол - с новой строки. Для правильных глаголов достаточно <b>å danse,перевод</b> - "
+        "формы будут подобраны автоматически.\n"
+        "<b>Большой список можно отправить файлом CSV или TSV</b> с теми же столбцами.\n"
+        "<b>Нажмите 'Отмена'</b>, если передумали.",
+        reply_markup=get_cancel_keyboard(),
+        parse_mode='HTML'
+    )
+
+
+# Добавление пачки слов от админа: каждая строка - отдельный глагол
+@on_input(State.ADD, admin_only=True)
+async def receive_verbs(update, context, user_input):
+    result = await import_verbs(context, parse_verb_lines(user_input.splitlines(keepends=True),
+                                                          conjugator=context.bot_data['search_index'].conjugator))
+    await update.message.reply_text(format_import_report(result), reply_markup=get_keyboard(update))
+    set_state(context, State.MAIN)
+
 
-    # Проверяем возврат из "Legg til ord"
-    if user_input.lower() == "назад" and 'pending_suggestion' in context.user_data:
-        context.user_data.pop('pending_suggestion')
+# Файл CSV/TSV в режиме "Добавить": скачивается во временный файл и разбирается в потоке-читателе
+@timed('import_file')
+async def handle_document(update: Update, context: ContextTypes):
+    document = update.message.document
+    if context.user_data.get('state') != State.ADD or not is_admin(update.effective_user.id):
+        await update.message.reply_text(
+            "Файлы принимаются только после кнопки 'Добавить' (доступна администратору).",
+            reply_markup=get_keyboard(update)
+        )
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_BYTES:
+        await update.message.reply_text(
+            f"<b>Файл слишком большой.</b> Максимум {IMPORT_MAX_FILE_BYTES // (1024 * 1024)} МБ.",
+            reply_markup=get_cancel_keyboard(),
+            parse_mode='HTML'
+        )
+        return
+    file = await document.get_file()
+    fd, path = tempfile.mkstemp(suffix='.csv')
+    os.close(fd)
+    try:
+        await file.download_to_drive(path)
+        result = await import_verbs(context, await run_read(parse_verb_file, path,
+                                                            context.bot_data['search_index'].conjugator))
+    except UnicodeDecodeError:
         await update.message.reply_text(
-            "Возврат в главное меню.",
-            reply_markup=get_keyboard('', df_verbs, update)
+            "<b>Не удалось прочитать файл.</b> Сохраните его в кодировке UTF-8.",
+            reply_markup=get_cancel_keyboard(),
+            parse_mode='HTML'
         )
         return
+    finally:
+        os.remove(path)
+    await update.message.reply_text(format_import_report(result), reply_markup=get_keyboard(update))
+    set_state(context, State.MAIN)
 
-    # Проверяем, ожидается ли предложение нового слова от пользователя
-    if 'pending_suggestion' in context.user_data:
-        try:
-            infinitiv, presens, preteritum, perfektum, translation = user_input.split(',')
-            if infinitiv in df_verbs['Infinitiv (инфинитив)'].values:
-                await update.message.reply_text(
-                    "<b>Dette ordet er allerede i ordboken.</b>",
-                    reply_markup=get_keyboard('', df_verbs, update),
-                    parse_mode='HTML'
-                )
-                context.user_data.pop('pending_suggestion')
-                return
-            if infinitiv in df_suggestions['Infinitiv (инфинитив)'].values:
-                await update.message.reply_text(
-                    "<b>Dette forslaget er allerede under vurdering.</b>",
-                    reply_markup=get_keyboard('', df_verbs, update),
-                    parse_mode='HTML'
-                )
-                context.user_data.pop('pending_suggestion')
-                return
-            username = update.effective_user.username or "N/A"
-            contact = "N/A"
-            new_suggestion = pd.DataFrame({
-                'Infinitiv (инфинитив)': [infinitiv],
-                'Presens (настоящее время)': [presens],
-                'Preteritum (прошедшее время)': [preteritum],
-                'Presens perfektum (причастие прошедшего времени)': [perfektum],
-                'Перевод': [translation],
-                'User_ID': [user_id],
-                'Username': [username],
-                'Contact': [contact]
-            })
-            df_suggestions = pd.concat([df_suggestions, new_suggestion], ignore_index=True)
-            df_suggestions.to_csv(SUGGESTIONS_FILE_PATH, index=False, encoding='utf-8')
-            context.bot_data['df_suggestions'] = df_suggestions
-            await update.message.reply_text(
-                "Спасибо! Слово предложено и отправлено на рассмотрение администратору.",
-                reply_markup=get_keyboard('', df_verbs, update)
-            )
-            context.user_data.pop('pending_suggestion')
-            return
-        except ValueError:
-            await update.message.reply_text(
-                "<b>Неверный формат. Используй:</b> å danse,danser,danset,har danset,перевод",
-                reply_markup=get_back_keyboard(),
-                parse_mode='HTML'
-            )
-            return
 
-    # Проверяем, ожидается ли добавление пачки слов от админа
-    if 'pending_add' in context.user_data and user_id == 509114893:
-        lines = user_input.split('\n')
-        if len(lines) > 100:
-            await update.message.reply_text(
-                "<b>Максимум 100 строк за раз.</b> Пожалуйста, сократите список.",
-                reply_markup=get_cancel_keyboard(),
-                parse_mode='HTML'
-            )
-            return
+@on_command(MENU_STATES, "anbefalinger", admin_only=True)
+async def show_anbefalinger(update, context, user_input):
+    set_state(context, State.ANBEFALINGER)
+    if not context.bot_data['moderation'].suggestions:
+        await update.message.reply_text(
+            "Список предложений пуст.\n<b>Нажмите 'Назад'</b>, чтобы вернуться.",
+            reply_markup=get_back_keyboard(),
+            parse_mode='HTML'
+        )
+    else:
+        await send_paged(update, context, 'suggestions', get_anbefalinger_keyboard(),
+                         footer="\n\n<b>Нажмите 'Назад'</b>, чтобы вернуться.")
 
-        new_verbs = []
-        added_verbs = []
-        duplicates = []
 
-        for line in lines:
-            try:
-                infinitiv, presens, preteritum, perfektum, translation = line.strip().split(',')
-                if infinitiv in df_verbs['Infinitiv (инфинитив)'].values:
-                    duplicates.append(infinitiv)
-                else:
-                    new_verbs.append([infinitiv, presens, preteritum, perfektum, translation])
-                    added_verbs.append(infinitiv)
-            except ValueError:
-                await update.message.reply_text(
-                    f"<b>Ошибка в строке:</b> '{line}'. <b>Используй формат:</b> å danse,danser,danset,har danset,перевод",
-                    reply_markup=get_cancel_keyboard(),
-                    parse_mode='HTML'
-                )
-                return
+@on_command(MENU_STATES, "добавить номер", admin_only=True)
+async def begin_add_numbers(update, context, user_input):
+    set_state(context, State.ADD_NUMBERS)
+    await update.message.reply_text(
+        "<b>Введите номера строк для добавления через запятую</b> (например, 1, 3, 4 или 1-50, 73):",
+        reply_markup=get_anbefalinger_keyboard(),
+        parse_mode='HTML'
+    )
 
-        if new_verbs:
-            new_df = pd.DataFrame(new_verbs, columns=[
-                'Infinitiv (инфинитив)',
-                'Presens (настоящее время)',
-                'Preteritum (прошедшее время)',
-                'Presens perfektum (причастие прошедшего времени)',
-                'Перевод'
-            ])
-            df_verbs = pd.concat([df_verbs, new_df], ignore_index=True)
-            df_verbs.to_csv(VERBS_FILE_PATH, index=False, encoding='utf-8')
-            context.bot_data['df_verbs'] = df_verbs
-
-        response = "Результат добавления:\n"
-        if added_verbs:
-            response += f"Успешно добавлены глаголы: {', '.join(added_verbs)}\n"
-        if duplicates:
-            response += f"Уже существуют в базе: {', '.join(duplicates)}"
 
+# Номера предложений (от 0) из ввода вида "1-50, 73"; None, если ввод не разобран или номер вне диапазона
+async def read_suggestion_numbers(update, context, user_input):
+    count = len(context.bot_data['moderation'].suggestions)
+    try:
+        return parse_selection(user_input, count)
+    except ValueError:
         await update.message.reply_text(
-            response.strip(),
-            reply_markup=get_keyboard('', df_verbs, update)
+            "<b>Введите номера или диапазоны через запятую</b>, например: 1, 3, 4 или 1-50, 73",
+            reply_markup=get_anbefalinger_keyboard(),
+            parse_mode='HTML'
         )
-        context.user_data.pop('pending_add')
-        return
+    except IndexError:
+        await update.message.reply_text(
+            f"<b>Некоторые номера вне диапазона.</b> Введите номера от 1 до {count}",
+            reply_markup=get_anbefalinger_keyboard(),
+            parse_mode='HTML'
+        )
+    return None
 
-    # Проверяем, ожидается ли добавление по номерам из Anbefalinger
-    if 'pending_add_numbers' in context.user_data and user_id == 509114893:
-        try:
-            numbers = [int(num.strip()) - 1 for num in user_input.split(',')]
-            if not all(0 <= num < len(df_suggestions) for num in numbers):
-                await update.message.reply_text(
-                    f"<b>Некоторые номера вне диапазона.</b> Введите номера от 1 до {len(df_suggestions)}",
-                    reply_markup=get_anbefalinger_keyboard(),
-                    parse_mode='HTML'
-                )
-                return
-            selected_verbs = df_suggestions.iloc[numbers]
-            new_verbs = []
-            added_verbs = []
-            duplicates = []
-            for _, row in selected_verbs.iterrows():
-                infinitiv = row['Infinitiv (инфинитив)']
-                if infinitiv in df_verbs['Infinitiv (инфинитив)'].values:
-                    duplicates.append(infinitiv)
-                else:
-                    new_verbs.append([row['Infinitiv (инфинитив)'], row['Presens (настоящее время)'],
-                                      row['Preteritum (прошедшее время)'],
-                                      row['Presens perfektum (причастие прошедшего времени)'],
-                                      row['Перевод']])
-                    added_verbs.append(infinitiv)
-            if new_verbs:
-                new_df = pd.DataFrame(new_verbs, columns=[
-                    'Infinitiv (инфинитив)',
-                    'Presens (настоящее время)',
-                    'Preteritum (прошедшее время)',
-                    'Presens perfektum (причастие прошедшего времени)',
-                    'Перевод'
-                ])
-                df_verbs = pd.concat([df_verbs, new_df], ignore_index=True)
-                df_verbs.to_csv(VERBS_FILE_PATH, index=False, encoding='utf-8')
-                context.bot_data['df_verbs'] = df_verbs
-                df_suggestions = df_suggestions.drop(selected_verbs.index)
-                df_suggestions.to_csv(SUGGESTIONS_FILE_PATH, index=False, encoding='utf-8')
-                context.bot_data['df_suggestions'] = df_suggestions
-
-            response = "Результат добавления:\n"
-            if added_verbs:
-                response += f"Успешно добавлены: {', '.join(added_verbs)}\n"
-            if duplicates:
-                response += f"Уже существуют: {', '.join(duplicates)}"
-            await update.message.reply_text(response.strip(), reply_markup=get_keyboard('', df_verbs, update))
-            context.user_data.pop('pending_add_numbers')
-            context.user_data.pop('pending_anbefalinger', None)
-        except ValueError:
-            await update.message.reply_text(
-                "<b>Введите номера через запятую</b>, например: 1, 3, 4",
-                reply_markup=get_anbefalinger_keyboard(),
-                parse_mode='HTML'
-            )
-        return
 
-    # Проверяем, ожидается ли удаление по номерам из Anbefalinger
-    if 'pending_delete_numbers' in context.user_data and user_id == 509114893:
-        try:
-            numbers = [int(num.strip()) - 1 for num in user_input.split(',')]
-            if not all(0 <= num < len(df_suggestions) for num in numbers):
-                await update.message.reply_text(
-                    f"<b>Некоторые номера вне диапазона.</b> Введите номера от 1 до {len(df_suggestions)}",
-                    reply_markup=get_anbefalinger_keyboard(),
-                    parse_mode='HTML'
-                )
-                return
-            deleted_verbs = df_suggestions.iloc[numbers]['Infinitiv (инфинитив)'].tolist()
-            df_suggestions = df_suggestions.drop(df_suggestions.index[numbers])
-            df_suggestions.to_csv(SUGGESTIONS_FILE_PATH, index=False, encoding='utf-8')
-            context.bot_data['df_suggestions'] = df_suggestions
-            await update.message.reply_text(
-                f"Удалены глаголы: {', '.join(deleted_verbs)}",
-                reply_markup=get_keyboard('', df_verbs, update)
-            )
-            context.user_data.pop('pending_delete_numbers')
-            context.user_data.pop('pending_anbefalinger', None)
-        except ValueError:
-            await update.message.reply_text(
-                "<b>Введите номера через запятую</b>, например: 1, 3, 4",
-                reply_markup=get_anbefalinger_keyboard(),
-                parse_mode='HTML'
-            )
-        return
+async def reply_accepted(update, added_verbs, duplicates):
+    response = "Результат добавления:\n"
+    if added_verbs:
+        response += f"Успешно добавлены ({len(added_verbs)}): {format_names(added_verbs)}\n"
+    if duplicates:
+        response += f"Уже существуют ({len(duplicates)}): {format_names(duplicates)}"
+    await update.message.reply_text(response.strip(), reply_markup=get_keyboard(update))
 
-    # Проверяем, ожидается ли редактирование номера в Anbefalinger
-    if 'pending_edit_number' in context.user_data and user_id == 509114893:
-        if 'number_to_edit' not in context.user_data:
-            try:
-                number = int(user_input) - 1
-                if 0 <= number < len(df_suggestions):
-                    context.user_data['number_to_edit'] = number
-                    verb = df_suggestions.iloc[number]['Infinitiv (инфинитив)']
-                    await update.message.reply_text(
-                        f"Введите новое описание для {verb} в формате:\n"
-                        "<b>å legge,legger,la,har lagt,класть</b>",
-                        reply_markup=get_anbefalinger_keyboard(),
-                        parse_mode='HTML'
-                    )
-                else:
-                    await update.message.reply_text(
-                        f"<b>Номер вне диапазона.</b> Введите от 1 до {len(df_suggestions)}",
-                        reply_markup=get_anbefalinger_keyboard(),
-                        parse_mode='HTML'
-                    )
-            except ValueError:
-                await update.message.reply_text(
-                    "<b>Введите номер строки</b>, например: 1",
-                    reply_markup=get_anbefalinger_keyboard(),
-                    parse_mode='HTML'
-                )
-        else:
-            try:
-                infinitiv, presens, preteritum, perfektum, translation = user_input.split(',')
-                number = context.user_data['number_to_edit']
-                df_suggestions.iloc[number] = [infinitiv, presens, preteritum, perfektum, translation,
-                                               df_suggestions.iloc[number]['User_ID'],
-                                               df_suggestions.iloc[number]['Username'],
-                                               df_suggestions.iloc[number]['Contact']]
-                df_suggestions.to_csv(SUGGESTIONS_FILE_PATH, index=False, encoding='utf-8')
-                context.bot_data['df_suggestions'] = df_suggestions
-                await update.message.reply_text(
-                    f"Строка {number + 1} обновлена:\n"
-                    f"<b>Infinitiv:</b> {infinitiv}\n<b>Presens:</b> {presens}\n<b>Preteritum:</b> {preteritum}\n"
-                    f"<b>Presens perfektum:</b> {perfektum}\n<b>Перевод:</b> {translation}",
-                    reply_markup=get_keyboard('', df_verbs, update),
-                    parse_mode='HTML'
-                )
-                context.user_data.pop('number_to_edit')
-                context.user_data.pop('pending_edit_number')
-                context.user_data.pop('pending_anbefalinger', None)
-            except ValueError:
-                await update.message.reply_text(
-                    "<b>Неверный формат. Используй:</b> å legge,legger,la,har lagt,класть",
-                    reply_markup=get_anbefalinger_keyboard(),
-                    parse_mode='HTML'
-                )
+
+# Добавление по номерам из Anbefalinger
+@on_input(State.ADD_NUMBERS, admin_only=True)
+async def receive_add_numbers(update, context, user_input):
+    numbers = await read_suggestion_numbers(update, context, user_input)
+    if numbers is None:
         return
+    added_verbs, duplicates = await accept_suggestions(context, numbers)
+    metrics.inc('admin_accept')
+    await reply_accepted(update, added_verbs, duplicates)
+    set_state(context, State.MAIN)
+
+
+@on_command(MENU_STATES, "добавить всё", admin_only=True)
+async def accept_all(update, context, user_input):
+    added_verbs, duplicates = await accept_suggestions(context)
+    metrics.inc('admin_accept')
+    await reply_accepted(update, added_verbs, duplicates)
+    set_state(context, State.MAIN)
+
+
+@on_command(MENU_STATES, "удалить номер", admin_only=True)
+async def begin_delete_numbers(update, context, user_input):
+    set_state(context, State.DELETE_NUMBERS)
+    await update.message.reply_text(
+        "<b>Введите номера строк для удаления через запятую</b> (например, 1, 3, 4 или 1-50, 73):",
+        reply_markup=get_anbefalinger_keyboard(),
+        parse_mode='HTML'
+    )
+
 
-    if user_input.lower() == "старт":
-        await start(update, context)
+# Удаление по номерам из Anbefalinger
+@on_input(State.DELETE_NUMBERS, admin_only=True)
+async def receive_delete_numbers(update, context, user_input):
+    moderation = context.bot_data['moderation']
+    numbers = await read_suggestion_numbers(update, context, user_input)
+    if numbers is None:
         return
-    elif user_input.lower() == "добавить" and user_id == 509114893:
-        context.user_data['pending_add'] = True
+    deleted_verbs = await run_write(lambda: moderation.reject(moderation.select(numbers)))
+    metrics.inc('admin_delete')
+    await update.message.reply_text(
+        f"Удалены глаголы ({len(deleted_verbs)}): {format_names(deleted_verbs)}",
+        reply_markup=get_keyboard(update)
+    )
+    set_state(context, State.MAIN)
+
+
+@on_command(MENU_STATES, "удалить всё", admin_only=True)
+async def delete_all(update, context, user_input):
+    await run_write(context.bot_data['moderation'].reject)
+    metrics.inc('admin_delete')
+    await update.message.reply_text(
+        "Все предложения удалены.",
+        reply_markup=get_keyboard(update)
+    )
+    set_state(context, State.MAIN)
+
+
+@on_command(MENU_STATES, "редактировать номер", admin_only=True)
+async def begin_edit_number(update, context, user_input):
+    set_state(context, State.EDIT_NUMBER)
+    await update.message.reply_text(
+        "<b>Введите номер строки для редактирования</b> (например, 1):",
+        reply_markup=get_anbefalinger_keyboard(),
+        parse_mode='HTML'
+    )
+
+
+# Редактирование в Anbefalinger: сначала номер строки, затем её новое содержимое
+@on_input(State.EDIT_NUMBER, admin_only=True)
+async def receive_edit_number(update, context, user_input):
+    moderation = context.bot_data['moderation']
+    try:
+        number = int(user_input) - 1
+    except ValueError:
         await update.message.reply_text(
-            "Введите глаголы в формате: <b>å danse,danser,danset,har danset,перевод</b>\n"
-            "<b>Можно добавить до 100 строк</b>, разделяя их переносом строки.\n"
-            "<b>Нажмите 'Отмена'</b>, если передумали.",
-            reply_markup=get_cancel_keyboard(),
+            "<b>Введите номер строки</b>, например: 1",
+            reply_markup=get_anbefalinger_keyboard(),
             parse_mode='HTML'
         )
         return
-    elif user_input.lower() == "anbefalinger" and user_id == 509114893:
-        context.user_data['pending_anbefalinger'] = True
-        if df_suggestions.empty:
-            await update.message.reply_text(
-                "Список предложений пуст.\n<b>Нажмите 'Назад'</b>, чтобы вернуться.",
-                reply_markup=get_back_keyboard(),
-                parse_mode='HTML'
-            )
-        else:
-            suggestions_text = "Список предложенных слов:\n"
-            for idx, row in df_suggestions.iterrows():
-                suggestions_text += (
-                    f"{idx + 1}. {row['Infinitiv (инфинитив)']}, {row['Presens (настоящее время)']}, "
-                    f"{row['Preteritum (прошедшее время)']}, {row['Presens perfektum (причастие прошедшего времени)']}, "
-                    f"{row['Перевод']}\n"
-                )
-            await update.message.reply_text(
-                suggestions_text + "\n<b>Нажмите 'Назад'</b>, чтобы вернуться.",
-                reply_markup=get_anbefalinger_keyboard(),
-                parse_mode='HTML'
-            )
+    if not 0 <= number < len(moderation.suggestions):
+        await update.message.reply_text(
+            f"<b>Номер вне диапазона.</b> Введите от 1 до {len(moderation.suggestions)}",
+            reply_markup=get_anbefalinger_keyboard(),
+            parse_mode='HTML'
+        )
         return
-    elif user_input.lower() == "добавить номер" and user_id == 509114893:
-        context.user_data['pending_add_numbers'] = True
+    suggestion_id = moderation.select([number])[0]
+    context.user_data['number_to_edit'] = number
+    context.user_data['suggestion_to_edit'] = suggestion_id
+    set_state(context, State.EDIT_SUGGESTION)
+    await update.message.reply_text(
+        f"Введите новое описание для {moderation.suggestions[suggestion_id]} в формате:\n"
+        "<b>å legge,legger,la,har lagt,класть</b>",
+        reply_markup=get_anbefalinger_keyboard(),
+        parse_mode='HTML'
+    )
+
+
+@on_input(State.EDIT_SUGGESTION, admin_only=True)
+async def receive_edit_suggestion(update, context, user_input):
+    try:
+        infinitiv, presens, preteritum, perfektum, translation = user_input.split(',')
+    except ValueError:
         await update.message.reply_text(
-            "<b>Введите номера строк для добавления через запятую</b> (например, 1, 3, 4):",
+            "<b>Неверный формат. Используй:</b> å legge,legger,la,har lagt,класть",
             reply_markup=get_anbefalinger_keyboard(),
             parse_mode='HTML'
         )
         return
-    elif user_input.lower() == "добавить всё" and user_id == 509114893:
-        new_verbs = []
-        added_verbs = []
-        duplicates = []
-        for _, row in df_suggestions.iterrows():
-            infinitiv = row['Infinitiv (инфинитив)']
-            if infinitiv in df_verbs['Infinitiv (инфинитив)'].values:
-                duplicates.append(infinitiv)
+    number = context.user_data['number_to_edit']
+    edited = await run_write(context.bot_data['moderation'].edit, context.user_data['suggestion_to_edit'],
+                             (infinitiv, presens, preteritum, perfektum, translation))
+    set_state(context, State.MAIN)
+    if not edited:
+        await update.message.reply_text("Это предложение уже удалено или принято.", reply_markup=get_keyboard(update))
+        return
+    metrics.inc('admin_edit')
+    await update.message.reply_text(
+        f"Строка {number + 1} обновлена:\n"
+        f"<b>Infinitiv:</b> {infinitiv}\n<b>Presens:</b> {presens}\n<b>Preteritum:</b> {preteritum}\n"
+        f"<b>Presens perfektum:</b> {perfektum}\n<b>Перевод:</b> {translation}",
+        reply_markup=get_keyboard(update),
+        parse_mode='HTML'
+    )
+
+
+@on_command(MENU_STATES, "kontaktperson", admin_only=True)
+async def show_contacts(update, context, user_input):
+    set_state(context, State.KONTAKTPERSON)
+    tracker = context.bot_data['contact_tracker']
+    if not tracker.contacts:
+        await update.message.reply_text(
+            "Список контактов пуст.\n<b>Нажмите 'Назад'</b>, чтобы вернуться.",
+            reply_markup=get_back_keyboard(),
+            parse_mode='HTML'
+        )
+    else:
+        await send_paged(
+            update, context, 'contacts', get_back_keyboard(),
+            footer=(f"\n\nОбновлений активности: {tracker.touches}, записано в базу: {tracker.written}, "
+                    f"объединено: {tracker.coalesced}\n\n<b>Нажмите 'Назад'</b>, чтобы вернуться.")
+        )
+
+
+# Квиз с интервальными повторениями (SM-2). Карточка - глагол из словаря, ответ - три формы через запятую;
+# число верных форм даёт оценку 1-5, от которой зависят следующий интервал и лёгкость карточки.
+# Карточки пользователя загружаются из базы при первом обращении и держатся в памяти (LRU на
+# QUIZ_MAX_LOADED_USERS пользователей) вместе с кучей сроков: ближайшая карточка берётся за O(log n).
+# Изменения записываются пачкой раз в QUIZ_FLUSH_INTERVAL секунд. Новая карточка - случайный глагол,
+# которого ещё нет у пользователя. Напоминания о наступивших повторениях рассылаются раз в
+# QUIZ_REMINDER_INTERVAL секунд, не чаще QUIZ_REMINDER_RATE сообщений в секунду и не чаще раза в
+# QUIZ_REMINDER_GAP_HOURS часов одному пользователю; /quiz off отключает их
+QUIZ_MAX_LOADED_USERS = int(os.getenv("QUIZ_MAX_LOADED_USERS", "10000"))
+QUIZ_FLUSH_INTERVAL = int(os.getenv("QUIZ_FLUSH_INTERVAL", "30"))
+QUIZ_REMINDER_INTERVAL = int(os.getenv("QUIZ_REMINDER_INTERVAL", "3600"))
+QUIZ_REMINDER_GAP_HOURS = float(os.getenv("QUIZ_REMINDER_GAP_HOURS", "20"))
+QUIZ_REMINDER_RATE = int(os.getenv("QUIZ_REMINDER_RATE", "20"))
+QUIZ_REMINDER_BATCH = 1000
+QUIZ_NEW_CARD_ATTEMPTS = 20
+QUIZ_QUALITY = {3: 5, 2: 3, 1: 2, 0: 1}  # верных форм -> оценка SM-2
+DAY_SECONDS = 86400
+
+
+class Card:
+    __slots__ = ('repetitions', 'interval', 'ease', 'due')
+
+    def __init__(self, repetitions=0, interval=0.0, ease=2.5, due=0.0):
+        self.repetitions = repetitions
+        self.interval = interval  # дней
+        self.ease = ease
+        self.due = due
+
+    def review(self, quality, now):
+        if quality >= 3:
+            if self.repetitions == 0:
+                self.interval = 1.0
+            elif self.repetitions == 1:
+                self.interval = 6.0
             else:
-                new_verbs.append([row['Infinitiv (инфинитив)'], row['Presens (настоящее время)'],
-                                  row['Preteritum (прошедшее время)'],
-                                  row['Presens perfektum (причастие прошедшего времени)'],
-                                  row['Перевод']])
-                added_verbs.append(infinitiv)
-        if new_verbs:
-            new_df = pd.DataFrame(new_verbs, columns=[
-                'Infinitiv (инфинитив)',
-                'Presens (настоящее время)',
-                'Preteritum (прошедшее время)',
-                'Presens perfektum (причастие прошедшего времени)',
-                'Перевод'
-            ])
-            df_verbs = pd.concat([df_verbs, new_df], ignore_index=True)
-            df_verbs.to_csv(VERBS_FILE_PATH, index=False, encoding='utf-8')
-            context.bot_data['df_verbs'] = df_verbs
-            df_suggestions = pd.DataFrame(columns=df_suggestions.columns)
-            df_suggestions.to_csv(SUGGESTIONS_FILE_PATH, index=False, encoding='utf-8')
-            context.bot_data['df_suggestions'] = df_suggestions
-
-        response = "Результат добавления:\n"
-        if added_verbs:
-            response += f"Успешно добавлены: {', '.join(added_verbs)}\n"
-        if duplicates:
-            response += f"Уже существуют: {', '.join(duplicates)}"
-        await update.message.reply_text(response.strip(), reply_markup=get_keyboard('', df_verbs, update))
-        context.user_data.pop('pending_anbefalinger', None)
-        return
-    elif user_input.lower() == "удалить номер" and user_id == 509114893:
-        context.user_data['pending_delete_numbers'] = True
+                self.interval = round(self.interval * self.ease)
+            self.repetitions += 1
+        else:
+            self.repetitions = 0
+            self.interval = 1.0
+        self.ease = max(1.3, self.ease + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+        self.due = now + self.interval * DAY_SECONDS
+
+
+# Карточки одного пользователя и куча (срок, глагол). Запись кучи устаревает, когда срок карточки
+# меняется; такие записи выбрасываются, когда оказываются наверху
+class QuizDeck:
+    __slots__ = ('cards', 'heap')
+
+    def __init__(self, rows):
+        self.cards = {row[0]: Card(*row[1:]) for row in rows}
+        self.heap = [(card.due, verb) for verb, card in self.cards.items()]
+        heapq.heapify(self.heap)
+
+    def next_due(self, now):
+        while self.heap:
+            due, verb = self.heap[0]
+            card = self.cards.get(verb)
+            if card is None or card.due != due:
+                heapq.heappop(self.heap)
+                continue
+            return verb if due <= now else None
+        return None
+
+    def review(self, verb, quality, now):
+        card = self.cards.get(verb)
+        if card is None:
+            card = self.cards[verb] = Card()
+        card.review(quality, now)
+        heapq.heappush(self.heap, (card.due, verb))
+        return card
+
+
+class QuizScheduler:
+    def __init__(self, max_users):
+        self.max_users = max_users
+        self.decks = OrderedDict()  # User_ID -> QuizDeck
+        self.pending = {}  # User_ID -> {глагол: Card}, ещё не записано
+        self.reviews = 0
+
+    # Колода из строк базы с наложенными ещё не записанными изменениями
+    def add_deck(self, user_id, rows):
+        deck = self.decks[user_id] = QuizDeck(rows)
+        for verb, card in self.pending.get(user_id, {}).items():
+            deck.cards[verb] = card
+            heapq.heappush(deck.heap, (card.due, verb))
+        while len(self.decks) > self.max_users:
+            self.decks.popitem(last=False)
+        return deck
+
+    def review(self, user_id, deck, verb, quality, now):
+        card = deck.review(verb, quality, now)
+        self.pending.setdefault(user_id, {})[verb] = card
+        self.reviews += 1
+        return card
+
+    def take_pending(self):
+        pending, self.pending = self.pending, {}
+        return [(user_id, verb, card.repetitions, card.interval, card.ease, card.due)
+                for user_id, cards in pending.items() for verb, card in cards.items()]
+
+
+def find_verb_row(search_index, verb):
+    for row_id in search_index.exact_ids(verb):
+        if normalize_infinitiv(search_index.rows[row_id][0]) == verb:
+            return search_index.rows[row_id]
+    return None
+
+
+def pick_new_verb(search_index, deck):
+    rows = search_index.rows
+    for _ in range(QUIZ_NEW_CARD_ATTEMPTS if rows else 0):
+        row = random.choice(rows)
+        verb = normalize_infinitiv(row[0])
+        if verb and verb not in deck.cards and all(row[1:4]):
+            return verb, row
+    return None
+
+
+# Число верных форм (0-3) или None, если ответ не из трёх частей. Варианты через "/" и "har" не обязательны
+def grade_answer(row, answer):
+    answers = [value.strip().lower() for value in answer.split(',')]
+    if len(answers) != 3:
+        return None
+    correct = 0
+    for value, expected in zip(answers, row[1:4]):
+        accepted = {variant.strip() for variant in expected.lower().split('/')}
+        accepted |= {participle(variant) for variant in accepted}
+        correct += value in accepted or participle(value) in accepted
+    return correct
+
+
+async def quiz_deck(context, user_id):
+    scheduler = context.bot_data['quiz']
+    deck = scheduler.decks.get(user_id)
+    if deck is not None:
+        scheduler.decks.move_to_end(user_id)
+        return deck
+    rows = await run_read(context.bot_data['storage'].reviews, user_id)
+    if not rows:
+        await run_write(context.bot_data['storage'].join_quiz, user_id)
+    return scheduler.decks.get(user_id) or scheduler.add_deck(user_id, rows)
+
+
+# Следующая карточка: наступившее повторение, иначе новый глагол. Возвращает текст вопроса
+async def next_quiz_card(context, user_id):
+    search_index = context.bot_data['search_index']
+    deck = await quiz_deck(context, user_id)
+    now = time.time()
+    while True:
+        verb = deck.next_due(now)
+        if verb is None:
+            break
+        row = find_verb_row(search_index, verb)
+        if row is not None:
+            kind = "Повторение"
+            break
+        deck.cards.pop(verb)  # глагол удалён из словаря
+    if verb is None:
+        picked = pick_new_verb(search_index, deck)
+        if picked is None:
+            context.user_data.pop('quiz_card', None)
+            return "Новых глаголов для квиза нет. Загляните позже!"
+        verb, row = picked
+        kind = "Новый глагол"
+    context.user_data['quiz_card'] = (verb, row)
+    return (f"{kind}: <b>{row[0]}</b> - {row[4]}\n"
+            "Напишите через запятую <b>presens, preteritum, perfektum</b>.")
+
+
+@on_command(MENU_STATES, "quiz")
+async def begin_quiz(update, context, user_input):
+    set_state(context, State.QUIZ)
+    question = await next_quiz_card(context, update.effective_user.id)
+    await update.message.reply_text(
+        question + "\n<b>'Не знаю'</b> - показать ответ, <b>'Назад'</b> - закончить.",
+        reply_markup=QUIZ_KEYBOARD,
+        parse_mode='HTML'
+    )
+
+
+# Команда /quiz; /quiz off и /quiz on выключают и включают напоминания
+async def quiz_command(update: Update, context: ContextTypes):
+    option = context.args[0].lower() if context.args else ''
+    if option in ('off', 'on'):
+        await run_write(context.bot_data['storage'].set_quiz_reminders, update.effective_user.id, option == 'on')
         await update.message.reply_text(
-            "<b>Введите номера строк для удаления через запятую</b> (например, 1, 3, 4):",
-            reply_markup=get_anbefalinger_keyboard(),
-            parse_mode='HTML'
+            "Напоминания о повторении включены." if option == 'on' else "Напоминания о повторении выключены.",
+            reply_markup=get_keyboard(update)
         )
         return
-    elif user_input.lower() == "удалить всё" and user_id == 509114893:
-        df_suggestions = pd.DataFrame(columns=df_suggestions.columns)
-        df_suggestions.to_csv(SUGGESTIONS_FILE_PATH, index=False, encoding='utf-8')
-        context.bot_data['df_suggestions'] = df_suggestions
-        await update.message.reply_text(
-            "Все предложения удалены.",
-            reply_markup=get_keyboard('', df_verbs, update)
-        )
-        context.user_data.pop('pending_anbefalinger', None)
+    await begin_quiz(update, context, '')
+
+
+@on_command([State.QUIZ], "назад")
+async def end_quiz(update, context, user_input):
+    answered = context.user_data.get('quiz_answered', 0)
+    set_state(context, State.MAIN)
+    await update.message.reply_text(
+        f"Квиз окончен. Карточек за эту тренировку: {answered}.",
+        reply_markup=get_keyboard(update)
+    )
+
+
+@on_command([State.QUIZ], "не знаю")
+@on_input(State.QUIZ)
+async def receive_quiz_answer(update, context, user_input):
+    card = context.user_data.get('quiz_card')
+    if card is None:
+        await begin_quiz(update, context, user_input)
         return
-    elif user_input.lower() == "редактировать номер" and user_id == 509114893:
-        context.user_data['pending_edit_number'] = True
+    verb, row = card
+    correct = 0 if user_input.lower() == "не знаю" else grade_answer(row, user_input)
+    if correct is None:
         await update.message.reply_text(
-            "<b>Введите номер строки для редактирования</b> (например, 1):",
-            reply_markup=get_anbefalinger_keyboard(),
+            "Нужно три формы через запятую, например: <b>kaster, kastet, har kastet</b>",
+            reply_markup=QUIZ_KEYBOARD,
             parse_mode='HTML'
         )
         return
-    elif user_input.lower() == "kontaktperson" and user_id == 509114893:
-        context.user_data['pending_kontaktperson'] = True
-        if df_contacts.empty:
-            await update.message.reply_text(
-                "Список контактов пуст.\n<b>Нажмите 'Назад'</b>, чтобы вернуться.",
-                reply_markup=get_back_keyboard(),
-                parse_mode='HTML'
-            )
+    user_id = update.effective_user.id
+    scheduler = context.bot_data['quiz']
+    deck = await quiz_deck(context, user_id)
+    reviewed = scheduler.review(user_id, deck, verb, QUIZ_QUALITY[correct], time.time())
+    context.user_data['quiz_answered'] = context.user_data.get('quiz_answered', 0) + 1
+    metrics.inc('quiz_review')
+    verdict = "Верно!" if correct == 3 else f"Верных форм: {correct} из 3. Правильно: {', '.join(row[1:4])}"
+    question = await next_quiz_card(context, user_id)
+    await update.message.reply_text(
+        f"{verdict}\nСледующее повторение через {reviewed.interval:.0f} дн.\n\n{question}",
+        reply_markup=QUIZ_KEYBOARD,
+        parse_mode='HTML'
+    )
+
+
+async def flush_quiz(app):
+    rows = app.bot_data['quiz'].take_pending()
+    if rows:
+        await run_write(app.bot_data['storage'].save_reviews, rows)
+
+
+async def flush_quiz_job(context: ContextTypes.DEFAULT_TYPE):
+    await flush_quiz(context.application)
+
+
+def retry_seconds(error):
+    value = error.retry_after
+    return value.total_seconds() if isinstance(value, timedelta) else value
+
+
+# 'sent', 'blocked' или 'failed'; при RetryAfter - одна повторная попытка после паузы
+async def send_quiz_reminder(bot, user_id, count):
+    text = f"Пора повторить глаголы: карточек к повторению - {count}. Отправьте /quiz, чтобы начать."
+    for attempt in range(2):
+        try:
+            await bot.send_message(user_id, text)
+            return 'sent'
+        except RetryAfter as error:
+            if attempt:
+                break
+            await asyncio.sleep(retry_seconds(error))
+        except Forbidden:
+            return 'blocked'
+        except TelegramError as error:
+            logger.debug("Напоминание %s не отправлено: %s", user_id, error)
+            break
+    return 'failed'
+
+
+async def quiz_reminders_job(context: ContextTypes.DEFAULT_TYPE):
+    app = context.application
+    storage = app.bot_data['storage']
+    await flush_quiz(app)
+    now = time.time()
+    workers, worker_id = (1, 0) if WORKER_ID is None else (WORKERS, int(WORKER_ID))
+    rows = await run_read(storage.due_reminders, now, now - QUIZ_REMINDER_GAP_HOURS * 3600, QUIZ_REMINDER_BATCH,
+                          workers, worker_id)
+    results = {'sent': [], 'blocked': [], 'failed': []}
+    for i in range(0, len(rows), QUIZ_REMINDER_RATE):
+        started = time.monotonic()
+        batch = rows[i:i + QUIZ_REMINDER_RATE]
+        outcomes = await asyncio.gather(*(send_quiz_reminder(app.bot, user_id, count) for user_id, count in batch))
+        for (user_id, _), outcome in zip(batch, outcomes):
+            results[outcome].append(user_id)
+        await asyncio.sleep(max(0.0, 1 - (time.monotonic() - started)))
+    if rows:
+        await run_write(storage.mark_reminded, results['sent'], results['blocked'], now)
+        for outcome, user_ids in results.items():
+            metrics.inc(f'quiz_reminder_{outcome}', len(user_ids))
+        logger.info("Напоминания о квизе: отправлено %d, заблокировали бота %d, ошибок %d",
+                    len(results['sent']), len(results['blocked']), len(results['failed']))
+
+
+# Рассылка админа всем контактам: /broadcast текст, /broadcast status, /broadcast stop.
+# Контакты читаются из базы порциями по id, сообщения отправляют BROADCAST_WORKERS задач через общее
+# ведро токенов на BROADCAST_RATE сообщений в секунду (лимит Telegram - около 30). RetryAfter
+# приостанавливает всю рассылку на указанное время, сетевые ошибки повторяются с растущей паузой
+# не меньше секунды (лимит Telegram на один чат), всего до BROADCAST_MAX_ATTEMPTS попыток.
+# Прогресс сохраняется раз в BROADCAST_CHECKPOINT_INTERVAL секунд; после перезапуска рассылка
+# продолжается с сохранённого места (несколько последних сообщений могут уйти повторно).
+# При нескольких процессах рассылка одна на всех (её состояние - строка в таблице broadcasts): её ведёт
+# запустивший процесс, а рассылку, владелец которой остановился или не отмечался BROADCAST_OWNER_TIMEOUT
+# секунд, подхватывает любой процесс. /broadcast stop из другого процесса помечает рассылку в базе,
+# и владелец останавливает её при следующей записи прогресса.
+# Заблокировавшие бота отмечаются и больше не получают рассылок, пока снова не напишут
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+BROADCAST_MAX_ATTEMPTS = 5
+BROADCAST_CHUNK = 500
+BROADCAST_CHECKPOINT_INTERVAL = 2
+BROADCAST_OWNER_TIMEOUT = 30
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Broadcast:
+    def __init__(self, broadcast_id, text, total, last_contact_id=0, sent=0, blocked=0, failed=0):
+        self.id = broadcast_id
+        self.text = text
+        self.total = total
+        self.sent = sent
+        self.blocked = blocked
+        self.failed = failed
+        self.dispatched_id = last_contact_id  # id последнего контакта, отданного на отправку
+        self.in_flight = set()  # id контактов, которые ещё отправляются
+        self.blocked_ids = []   # заблокировавшие бота, ещё не записанные в базу
+        self.started = time.monotonic()
+        self.done_here = 0      # обработано с момента запуска в этом процессе
+        self.stopped = False
+        self.task = None
+
+    @property
+    def done(self):
+        return self.sent + self.blocked + self.failed
+
+    # Все контакты до этого id обработаны
+    @property
+    def checkpoint(self):
+        return min(self.in_flight) - 1 if self.in_flight else self.dispatched_id
+
+    def record(self, contact_id, user_id, outcome):
+        self.in_flight.discard(contact_id)
+        self.done_here += 1
+        if outcome == 'sent':
+            self.sent += 1
+        elif outcome == 'blocked':
+            self.blocked += 1
+            self.blocked_ids.append(user_id)
         else:
-            contacts_text = "Список пользователей бота:\n"
-            for idx, row in df_contacts.iterrows():
-                contacts_text += (
-                    f"{idx + 1}. ID: {row['User_ID']}, @{row['Username']}, Contact: {row['Contact']}\n"
-                )
-            await update.message.reply_text(
-                contacts_text + "\n<b>Нажмите 'Назад'</b>, чтобы вернуться.",
-                reply_markup=get_back_keyboard(),
-                parse_mode='HTML'
-            )
+            self.failed += 1
+
+    # Сообщений в секунду и оставшееся время в секундах
+    def rate(self):
+        elapsed = time.monotonic() - self.started
+        return self.done_here / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        rate = self.rate()
+        return max(0, self.total - self.done) / rate if rate else None
+
+
+# heartbeat 0 освобождает рассылку для других процессов
+async def save_broadcast(storage, broadcast, status, heartbeat=None):
+    blocked_ids, broadcast.blocked_ids = broadcast.blocked_ids, []
+    return await run_write(storage.save_broadcast, broadcast.id, status, broadcast.checkpoint, broadcast.sent,
+                           broadcast.blocked, broadcast.failed, blocked_ids,
+                           time.time() if heartbeat is None else heartbeat)
+
+
+# 'sent', 'blocked' или 'failed'
+async def send_broadcast_message(bot, bucket, user_id, text):
+    for attempt in range(BROADCAST_MAX_ATTEMPTS):
+        await bucket.acquire()
+        try:
+            await bot.send_message(user_id, text)
+            return 'sent'
+        except RetryAfter as error:
+            metrics.inc('broadcast_retry_after')
+            bucket.pause(retry_seconds(error))
+        except Forbidden:
+            return 'blocked'
+        except BadRequest as error:
+            logger.debug("Рассылка: %s не получил сообщение: %s", user_id, error)
+            return 'failed'
+        except NetworkError as error:
+            logger.debug("Рассылка: сетевая ошибка для %s: %s", user_id, error)
+            await asyncio.sleep(min(60, 2 ** attempt))
+    return 'failed'
+
+
+async def run_broadcast(app, broadcast):
+    storage = app.bot_data['storage']
+    bucket = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+    queue = asyncio.Queue(BROADCAST_WORKERS * 2)
+
+    async def produce():
+        after_id = broadcast.dispatched_id
+        while True:
+            rows = await run_read(storage.broadcast_targets, after_id, BROADCAST_CHUNK)
+            if not rows:
+                break
+            for contact_id, user_id in rows:
+                broadcast.in_flight.add(contact_id)
+                broadcast.dispatched_id = contact_id
+                await queue.put((contact_id, user_id))
+            after_id = rows[-1][0]
+        for _ in range(BROADCAST_WORKERS):
+            await queue.put(None)
+
+    async def send():
+        while (item := await queue.get()) is not None:
+            contact_id, user_id = item
+            broadcast.record(contact_id, user_id,
+                             await send_broadcast_message(app.bot, bucket, user_id, broadcast.text))
+
+    async def checkpoints():
+        while True:
+            await asyncio.sleep(BROADCAST_CHECKPOINT_INTERVAL)
+            if await save_broadcast(storage, broadcast, 'running') == 'stopping':
+                broadcast.stopped = True
+                broadcast.task.cancel()
+                return
+
+    checkpoint_task = asyncio.create_task(checkpoints())
+    status = 'running'  # при остановке бота рассылка продолжится после перезапуска
+    try:
+        await asyncio.gather(produce(), *(send() for _ in range(BROADCAST_WORKERS)))
+        status = 'done'
+    except asyncio.CancelledError:
+        if broadcast.stopped:
+            status = 'stopped'
+        raise
+    finally:
+        checkpoint_task.cancel()
+        await save_broadcast(storage, broadcast, status, heartbeat=0)
+        if app.bot_data.get('broadcast') is broadcast:
+            app.bot_data['broadcast'] = None
+        logger.info("Рассылка #%d: %s, отправлено %d, заблокировали %d, ошибок %d",
+                    broadcast.id, status, broadcast.sent, broadcast.blocked, broadcast.failed)
+
+
+def start_broadcast(app, broadcast):
+    app.bot_data['broadcast'] = broadcast
+    broadcast.task = asyncio.create_task(run_broadcast(app, broadcast))
+
+
+# Незавершённая рассылка без владельца: после перезапуска или падения процесса, который её вёл
+async def resume_broadcast(app):
+    if app.bot_data.get('broadcast') is not None:
         return
-    elif user_input.lower() == "legg til ord":
-        context.user_data['pending_suggestion'] = True
+    now = time.time()
+    row = await run_write(app.bot_data['storage'].claim_broadcast, now, now - BROADCAST_OWNER_TIMEOUT)
+    if row is not None:
+        broadcast_id, text, _, total, last_contact_id, sent, blocked, failed = row
+        logger.info("Продолжение рассылки #%d с контакта %d", broadcast_id, last_contact_id + 1)
+        start_broadcast(app, Broadcast(broadcast_id, text, total, last_contact_id, sent, blocked, failed))
+
+
+async def resume_broadcast_job(context: ContextTypes.DEFAULT_TYPE):
+    await resume_broadcast(context.application)
+
+
+async def stop_broadcast(app):
+    broadcast = app.bot_data.get('broadcast')
+    if broadcast is not None and broadcast.task is not None:
+        broadcast.task.cancel()
+        await asyncio.gather(broadcast.task, return_exceptions=True)
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours} ч {minutes} мин" if hours else f"{minutes} мин {seconds} с"
+
+
+async def format_broadcast_status(app):
+    broadcast = app.bot_data.get('broadcast')
+    if broadcast is not None:
+        eta = broadcast.eta()
+        return (f"Рассылка #{broadcast.id}: идёт\n"
+                f"Отправлено {broadcast.sent} из {broadcast.total}, заблокировали {broadcast.blocked}, "
+                f"ошибок {broadcast.failed}\n"
+                f"Скорость {broadcast.rate():.1f} сообщ./с, осталось "
+                + (f"~{format_duration(eta)}" if eta is not None else "неизвестно"))
+    rows = await run_read(app.bot_data['storage'].broadcasts)
+    if not rows:
+        return "Рассылок ещё не было."
+    broadcast_id, _, status, total, _, sent, blocked, failed = rows[0]
+    status_text = {'done': 'завершена', 'stopped': 'остановлена', 'running': 'идёт в другом процессе',
+                   'stopping': 'останавливается'}[status]
+    return (f"Рассылка #{broadcast_id}: {status_text}\n"
+            f"Отправлено {sent} из {total}, заблокировали {blocked}, ошибок {failed}")
+
+
+# Команда /broadcast (только для админа)
+async def broadcast_command(update: Update, context: ContextTypes):
+    if not is_admin(update.effective_user.id):
         await update.message.reply_text(
-            "<b>Предложите слово в формате:</b> å danse,danser,danset,har danset,перевод\n"
-            "<b>Нажмите 'Назад'</b>, чтобы отменить.",
-            reply_markup=get_back_keyboard(),
-            parse_mode='HTML'
+            "Эта команда доступна только администратору.",
+            reply_markup=get_keyboard(update)
         )
         return
+    app = context.application
+    parts = update.message.text.split(None, 1)
+    text = parts[1].strip() if len(parts) > 1 else ''
+    if text.lower() == 'status':
+        response = await format_broadcast_status(app)
+    elif text.lower() == 'stop':
+        broadcast = app.bot_data.get('broadcast')
+        if broadcast is not None:
+            broadcast.stopped = True
+            await stop_broadcast(app)
+            response = f"Рассылка #{broadcast.id} остановлена: отправлено {broadcast.sent} из {broadcast.total}."
+        else:
+            stopped = await run_write(app.bot_data['storage'].request_broadcast_stop,
+                                      time.time() - BROADCAST_OWNER_TIMEOUT)
+            if stopped is None:
+                response = "Рассылка не идёт."
+            elif stopped[1] == 'stopped':
+                response = f"Рассылка #{stopped[0]} остановлена."
+            else:
+                response = f"Рассылка #{stopped[0]} идёт в другом процессе и остановится в течение нескольких секунд."
+    elif not text:
+        response = ("Использование:\n/broadcast текст - разослать всем контактам\n"
+                    "/broadcast status - ход рассылки\n/broadcast stop - остановить")
+    else:
+        await flush_contacts(app)
+        created = await run_write(app.bot_data['storage'].create_broadcast, text, time.time())
+        if created is None:
+            response = "Рассылка уже идёт. /broadcast status - ход, /broadcast stop - остановить."
+        else:
+            broadcast_id, total = created
+            start_broadcast(app, Broadcast(broadcast_id, text, total))
+            metrics.inc('broadcast')
+            response = f"Рассылка #{broadcast_id} запущена: получателей {total}. /broadcast status - ход рассылки."
+    await update.message.reply_text(response, reply_markup=get_keyboard(update))
+
+
+# Аналитика поиска. Обработчики только добавляют событие (время, User_ID, запрос, исход поиска,
+# первый найденный инфинитив, задержка) в кольцевой буфер на ANALYTICS_BUFFER_SIZE событий; при
+# переполнении теряются самые старые. Раз в ANALYTICS_FOLD_INTERVAL секунд буфер сворачивается в
+# счётчики по дням (запросы, опечатки, промахи, глаголы, активные пользователи) и прибавляется к таблицам
+# в базе в потоке-писателе; дни старше ANALYTICS_KEEP_DAYS удаляются. /top строится по этим таблицам.
+# Норвежское слово, которое не нашли ANALYTICS_SUGGEST_MISSES раз, само попадает в Anbefalinger
+# с подобранными формами и пустым переводом. Запросы, для которых нашлось исправление опечатки,
+# промахами не считаются и в предложения не попадают: это написанные с ошибкой известные глаголы
+ANALYTICS_BUFFER_SIZE = int(os.getenv("ANALYTICS_BUFFER_SIZE", "50000"))
+ANALYTICS_FOLD_INTERVAL = int(os.getenv("ANALYTICS_FOLD_INTERVAL", "60"))
+ANALYTICS_KEEP_DAYS = int(os.getenv("ANALYTICS_KEEP_DAYS", "90"))
+ANALYTICS_SUGGEST_MISSES = int(os.getenv("ANALYTICS_SUGGEST_MISSES", "5"))
+ANALYTICS_TOP_DAYS = 7
+ANALYTICS_TOP_ITEMS = 10
+SEARCH_HIT, SEARCH_FUZZY, SEARCH_MISS = 'hit', 'fuzzy', 'miss'
+NORWEGIAN_WORDS = re.compile(r"(å )?[a-zæøå]{3,}")
+
+
+class Analytics:
+    def __init__(self, size):
+        self.events = deque(maxlen=size)
+        self.recorded = 0
+        self.lost = 0  # вытеснено из переполненного буфера
+
+    def record(self, user_id, query, outcome, infinitiv, latency):
+        if len(self.events) == self.events.maxlen:
+            self.lost += 1
+        self.events.append((time.time(), user_id, query, outcome, infinitiv, latency))
+        self.recorded += 1
+
+    def take(self):
+        events = list(self.events)
+        self.events.clear()
+        return events
+
+
+# В потоке-писателе: счётчики по дням из событий, запись и предложения из частых промахов
+def fold_analytics(bot_data, events):
+    queries = defaultdict(lambda: [0, 0, 0])  # (день, запрос) -> [найдено, с опечаткой, не найдено]
+    verbs = Counter()
+    days = defaultdict(lambda: [0, 0, 0, 0.0])
+    users = set()
+    for timestamp, user_id, query, outcome, infinitiv, latency in events:
+        day = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d")
+        counts = queries[(day, query)]
+        totals = days[day]
+        totals[0] += 1
+        if outcome == SEARCH_FUZZY:
+            counts[1] += 1
+            totals[1] += 1
+        elif outcome == SEARCH_MISS:
+            counts[2] += 1
+            totals[2] += 1
+        else:
+            counts[0] += 1
+        totals[3] += latency
+        if infinitiv:
+            verbs[(day, infinitiv)] += 1
+        users.add((day, user_id))
+    query_rows = [(*key, *counts) for key, counts in queries.items()]
+    keep_since = (datetime.now() - timedelta(days=ANALYTICS_KEEP_DAYS)).strftime("%Y-%m-%d")
+    crossed = bot_data['storage'].save_analytics(
+        query_rows, [(*key, count) for key, count in verbs.items()], [(day, *totals) for day, totals in days.items()],
+        list(users), keep_since, ANALYTICS_SUGGEST_MISSES)
+    moderation = bot_data['moderation']
+    index = bot_data['search_index']
+    suggested = []
+    for query in crossed:
+        if (NORWEGIAN_WORDS.fullmatch(query) and not moderation.has_verb(query)
+                and not moderation.has_suggestion(query) and not index.fuzzy.search(query)):
+            moderation.add_suggestion((*index.conjugator.complete_row(query, ''), None, 'analytics', 'N/A'))
+            suggested.append(query)
+    return suggested
+
+
+async def fold_analytics_now(app):
+    events = app.bot_data['analytics'].take()
+    if events:
+        suggested = await run_write(fold_analytics, app.bot_data, events)
+        if suggested:
+            metrics.inc('analytics_suggestion', len(suggested))
+            logger.info("Частые промахи добавлены в предложения: %s", ", ".join(suggested))
+
+
+async def fold_analytics_job(context: ContextTypes.DEFAULT_TYPE):
+    await fold_analytics_now(context.application)
+
 
-    # Проверка доступа к командам администратора
-    if user_input.lower() in ["добавить", "anbefalinger", "kontaktperson",
-                              "добавить номер", "добавить всё", "удалить номер", "удалить всё",
-                              "редактировать номер"] and user_id != 509114893:
+def format_top(title, rows):
+    if not rows:
+        return [f"<b>{title}:</b> нет данных"]
+    return [f"<b>{title}:</b>"] + [f"{i}. {html.escape(value)} - {count}" for i, (value, count) in enumerate(rows, 1)]
+
+
+# Команда /top (только для админа): отчёт по свёрнутым данным за ANALYTICS_TOP_DAYS дней
+async def show_top(update: Update, context: ContextTypes):
+    if not is_admin(update.effective_user.id):
         await update.message.reply_text(
             "Эта команда доступна только администратору.",
-            reply_markup=get_keyboard('', df_verbs, update)
+            reply_markup=get_keyboard(update)
         )
         return
+    since = (datetime.now() - timedelta(days=ANALYTICS_TOP_DAYS - 1)).strftime("%Y-%m-%d")
+    report = await run_read(context.bot_data['storage'].analytics_report, since, ANALYTICS_TOP_ITEMS)
+    searches, fuzzy, misses, latency_sum = report['totals']
+    analytics = context.bot_data['analytics']
+    lines = [f"<b>Поиск за {ANALYTICS_TOP_DAYS} дн.</b>",
+             f"Запросов: {searches}, не найдено: {misses} ({misses / searches * 100 if searches else 0:.0f}%), "
+             f"исправлено опечаток: {fuzzy}, средняя задержка {latency_sum / searches * 1000 if searches else 0:.1f} мс",
+             f"Ещё не свёрнуто событий: {len(analytics.events)}, потеряно при переполнении: {analytics.lost}",
+             "",
+             "<b>Активные пользователи по дням:</b> "
+             + (", ".join(f"{day[5:]}: {count}" for day, count in report['daily_users']) or "нет данных"),
+             ""]
+    lines += format_top("Частые запросы", report['queries']) + [""]
+    lines += format_top("Частые промахи", report['misses']) + [""]
+    lines += format_top("Частые опечатки", report['fuzzy']) + [""]
+    lines += format_top("Популярные глаголы", report['verbs'])
+    await update.message.reply_text("\n".join(lines), reply_markup=get_keyboard(update), parse_mode='HTML')
 
-    print(f"Проверка в базе данных для: {user_input.lower()}")
-    # Поиск частичного совпадения (минимум 3 символа)
-    if len(user_input) >= 3:
-        result = df_verbs[
-            (df_verbs['Infinitiv (инфинитив)'].str.lower().str.contains(user_input.lower(), na=False)) |
-            (df_verbs['Presens (настоящее время)'].str.lower().str.contains(user_input.lower(), na=False)) |
-            (df_verbs['Preteritum (прошедшее время)'].str.lower().str.contains(user_input.lower(), na=False)) |
-            (df_verbs['Presens perfektum (причастие прошедшего времени)'].str.lower().str.contains(user_input.lower(),
-                                                                                                   na=False)) |
-            (df_verbs['Перевод'].str.lower().str.contains(user_input.lower(), na=False))
-            ]
-        if not result.empty:
-            response = "<b>Найденные совпадения:</b>\n"
-            for idx, row in result.iterrows():
-                response += (
-                    f"<b>Infinitiv:</b> {row['Infinitiv (инфинитив)']}\n"
-                    f"<b>Presens:</b> {row['Presens (настоящее время)']}\n"
-                    f"<b>Preteritum:</b> {row['Preteritum (прошедшее время)']}\n"
-                    f"<b>Presens perfektum:</b> {row['Presens perfektum (причастие прошедшего времени)']}\n"
-                    f"<b>Перевод:</b> {row['Перевод']}\n\n"
-                )
-            context.user_data['last_searched_verb'] = result.iloc[0]['Infinitiv (инфинитив)']
-            await update.message.reply_text(response.strip(), reply_markup=get_keyboard('', df_verbs, update),
-                                            parse_mode='HTML')
-        else:
+
+# Обработка запроса глагола: один поиск в таблице переходов, иначе - поиск по словарю
+@timed('handle_message')
+async def handle_message(update: Update, context: ContextTypes):
+    started = time.perf_counter()
+    user_id = update.effective_user.id
+    user_input = update.message.text.strip()
+    query = user_input.lower()
+    logger.debug("Получено сообщение: %s", user_input)
+
+    state = context.user_data.get('state', State.MAIN)
+    route = transitions.get((state, query)) or state_inputs.get(state)
+    metrics.observe('dispatch', time.perf_counter() - started)
+    if route is not None:
+        handler, admin_only = route
+        if admin_only and not is_admin(user_id):
+            set_state(context, State.MAIN)
             await update.message.reply_text(
-                "Слово не найдено в базе. <b>Используй 'Legg til ord'</b>, чтобы предложить его.",
-                reply_markup=get_keyboard('', df_verbs, update),
-                parse_mode='HTML'
+                "Эта команда доступна только администратору.",
+                reply_markup=get_keyboard(update)
             )
+            return
+        await handler(update, context, user_input)
+        return
+
+    logger.debug("Проверка в базе данных для: %s", query)
+    # Точное совпадение с любой формой, затем частичное (минимум 3 символа)
+    search_started = time.perf_counter()
+    row_ids, first_page = await cached_search(context, query)
+    fuzzy = bool(row_ids) and first_page[0].startswith(FUZZY_HEADER)
+    if not row_ids:
+        metrics.inc('search_miss')
+    elif fuzzy:
+        metrics.inc('search_fuzzy')
+    else:
+        metrics.inc('search_hit')
+    infinitiv = context.bot_data['search_index'].rows[row_ids[0]][0] if row_ids else None
+    outcome = SEARCH_MISS if not row_ids else SEARCH_FUZZY if fuzzy else SEARCH_HIT
+    context.bot_data['analytics'].record(user_id, query, outcome, infinitiv, time.perf_counter() - search_started)
+    if row_ids:
+        context.user_data['last_searched_verb'] = infinitiv
+        await send_paged(update, context, 'search', get_keyboard(update), first_page=first_page, query=query)
+    elif len(user_input) >= 3:
+        await update.message.reply_text(
+            "Слово не найдено в базе. <b>Используй 'Legg til ord'</b>, чтобы предложить его.",
+            reply_markup=get_keyboard(update),
+            parse_mode='HTML'
+        )
     else:
         await update.message.reply_text(
             "<b>Введите минимум 3 символа</b> для поиска.",
-            reply_markup=get_keyboard('', df_verbs, update),
+            reply_markup=get_keyboard(update),
             parse_mode='HTML'
         )
 
 
 # Обработка команды /add (только для админа через команду)
+@timed('add_verb')
 async def add_verb(update: Update, context: ContextTypes):
-    df_verbs = context.bot_data['df_verbs']
-    df_suggestions = context.bot_data['df_suggestions']
     user_id = update.effective_user.id
 
-    if user_id != 509114893:
+    if not is_admin(user_id):
         await update.message.reply_text(
             "Эта команда доступна только администратору.",
-            reply_markup=get_keyboard('', df_verbs, update)
+            reply_markup=get_keyboard(update)
         )
         return
 
@@ -626,64 +3150,785 @@ async def add_verb(update: Update, context: ContextTypes):
     if len(args) == 5:
         try:
             infinitiv, presens, preteritum, perfektum, translation = args
-            if infinitiv in df_verbs['Infinitiv (инфинитив)'].values:
+            added, _, resolved = await add_verbs(context, [(infinitiv, presens, preteritum, perfektum, translation)])
+            if not added:
                 await update.message.reply_text(
                     "<b>Dette ordet er allerede i ordboken.</b>",
-                    reply_markup=get_keyboard('', df_verbs, update),
+                    reply_markup=get_keyboard(update),
                     parse_mode='HTML'
                 )
                 return
-            new_row = pd.DataFrame({
-                'Infinitiv (инфинитив)': [infinitiv],
-                'Presens (настоящее время)': [presens],
-                'Preteritum (прошедшее время)': [preteritum],
-                'Presens perfektum (причастие прошедшего времени)': [perfektum],
-                'Перевод': [translation]
-            })
-            df_verbs = pd.concat([df_verbs, new_row], ignore_index=True)
-            df_verbs.to_csv(VERBS_FILE_PATH, index=False, encoding='utf-8')
-            context.bot_data['df_verbs'] = df_verbs
-
-            if infinitiv in df_suggestions['Infinitiv (инфинитив)'].values:
-                df_suggestions = df_suggestions[df_suggestions['Infinitiv (инфинитив)'] != infinitiv]
-                df_suggestions.to_csv(SUGGESTIONS_FILE_PATH, index=False, encoding='utf-8')
-                context.bot_data['df_suggestions'] = df_suggestions
+            metrics.inc('admin_add')
+
+            if resolved:
                 await update.message.reply_text(
                     f"Слово {infinitiv} удалено из предложений и добавлено в основную базу!"
                 )
 
             await update.message.reply_text(
                 f"Глагол {infinitiv} успешно добавлен!",
-                reply_markup=get_keyboard(infinitiv, df_verbs, update)
+                reply_markup=get_keyboard(update)
             )
         except ValueError:
             await update.message.reply_text(
                 "<b>Неверный формат. Используй:</b> /add å danse,danser,danset,har danset,перевод",
-                reply_markup=get_keyboard('', df_verbs, update),
+                reply_markup=get_keyboard(update),
                 parse_mode='HTML'
             )
     else:
         await update.message.reply_text(
             "<b>Неверный формат. Используй:</b> /add å danse,danser,danset,har danset,перевод",
-            reply_markup=get_keyboard('', df_verbs, update),
+            reply_markup=get_keyboard(update),
             parse_mode='HTML'
         )
 
 
-# Запуск бота
-def main():
-    print("Инициализация бота...")
-    app = Application.builder().token(TOKEN).job_queue(JobQueue()).build()
-    print("Бот запущен и ожидает сообщений...")
-    app.bot_data['df_verbs'] = df_verbs
-    app.bot_data['df_suggestions'] = df_suggestions
-    app.bot_data['df_contacts'] = df_contacts
+# Выгрузка базы в CSV файлы (только для админа)
+async def export_data(update: Update, context: ContextTypes):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text(
+            "Эта команда доступна только администратору.",
+            reply_markup=get_keyboard(update)
+        )
+        return
+    await flush_contacts(context.application)
+    await run_write(context.bot_data['storage'].export_csv)
+    await update.message.reply_text(
+        f"База выгружена в {VERBS_FILE_PATH}, {SUGGESTIONS_FILE_PATH} и {CONTACTS_FILE_PATH}.",
+        reply_markup=get_keyboard(update)
+    )
+
+
+# Сводка метрик: длительности по этапам, счётчики и показатели кэшей
+STAT_STAGES = ['handle_message', 'dispatch', 'search', 'render', 'send', 'persist', 'start', 'add_verb',
+               'page_button', 'import_file', 'inline_query']
+
+
+def collect_gauges(app):
+    cache = app.bot_data['response_cache']
+    tracker = app.bot_data['contact_tracker']
+    return {
+        'response_cache_hits': cache.hits,
+        'response_cache_misses': cache.misses,
+        'response_cache_entries': len(cache.entries),
+        'contacts_touches': tracker.touches,
+        'contacts_written': tracker.written,
+        'contacts_coalesced': tracker.coalesced,
+        'verbs': len(app.bot_data['search_index'].rows),
+        'rate_limited_users': len(app.update_processor.rate_limiter.full_at),
+        'sessions': len(app.user_data),
+        'quiz_decks_loaded': len(app.bot_data['quiz'].decks),
+        'quiz_reviews': app.bot_data['quiz'].reviews,
+        'sessions_written': app.persistence.written,
+        'sessions_expired': app.persistence.expired,
+        'analytics_events': app.bot_data['analytics'].recorded,
+        'analytics_buffered': len(app.bot_data['analytics'].events),
+        'analytics_lost': app.bot_data['analytics'].lost,
+        'startup_seconds': STARTUP_SECONDS,
+        'startup_rss_megabytes': STARTUP_RSS_MB,
+        'rss_megabytes': current_rss_mb(),
+    }
+
+
+def format_stats(app):
+    gauges = collect_gauges(app)
+    lines = ["<b>Статистика</b>",
+             f"Старт: {gauges['startup_seconds']:.2f} с, память при старте {gauges['startup_rss_megabytes']:.1f} МБ, "
+             f"сейчас {gauges['rss_megabytes']:.1f} МБ",
+             f"Глаголов в словаре: {gauges['verbs']}",
+             "",
+             "<b>Задержки, мс (p50 / p95 / p99, число замеров):</b>"]
+    for stage in STAT_STAGES:
+        count = metrics.totals[stage][0] if stage in metrics.totals else 0
+        if count:
+            p50, p95, p99 = metrics.percentiles(stage)
+            lines.append(f"{stage}: {p50 * 1000:.1f} / {p95 * 1000:.1f} / {p99 * 1000:.1f} ({count})")
+    lines += ["", "<b>Счётчики:</b>"]
+    lines += [f"{name}: {value}" for name, value in sorted(metrics.counters.items())]
+    lookups = gauges['response_cache_hits'] + gauges['response_cache_misses']
+    hit_rate = gauges['response_cache_hits'] / lookups * 100 if lookups else 0
+    lines += ["",
+              f"Кэш ответов: {gauges['response_cache_hits']} попаданий из {lookups} ({hit_rate:.0f}%), "
+              f"записей {gauges['response_cache_entries']}",
+              f"Активность контактов: обновлений {gauges['contacts_touches']}, записано {gauges['contacts_written']}, "
+              f"объединено {gauges['contacts_coalesced']}"]
+    return "\n".join(lines)
+
+
+def format_prometheus(app):
+    lines = ["# TYPE verbbot_stage_seconds summary"]
+    for stage, (count, total) in sorted(metrics.totals.items()):
+        for quantile, value in zip(('0.5', '0.95', '0.99'), metrics.percentiles(stage)):
+            lines.append(f'verbbot_stage_seconds{{stage="{stage}",quantile="{quantile}"}} {value:.6f}')
+        lines.append(f'verbbot_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+        lines.append(f'verbbot_stage_seconds_count{{stage="{stage}"}} {count}')
+    lines.append("# TYPE verbbot_events_total counter")
+    for name, value in sorted(metrics.counters.items()):
+        lines.append(f'verbbot_events_total{{event="{name}"}} {value}')
+    for name, value in collect_gauges(app).items():
+        lines.append(f"# TYPE verbbot_{name} gauge")
+        lines.append(f"verbbot_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# Команда /stats (только для админа)
+async def show_stats(update: Update, context: ContextTypes):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text(
+            "Эта команда доступна только администратору.",
+            reply_markup=get_keyboard(update)
+        )
+        return
+    await update.message.reply_text(format_stats(context.application), reply_markup=get_keyboard(update),
+                                    parse_mode='HTML')
+
+
+# Команда /memory (только для админа): память поискового индекса по частям
+async def show_memory(update: Update, context: ContextTypes):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text(
+            "Эта команда доступна только администратору.",
+            reply_markup=get_keyboard(update)
+        )
+        return
+    index = context.bot_data['search_index']
+    footprint = await run_write(index.footprint)
+    total = sum(footprint.values())
+    lines = [f"<b>Память поискового индекса</b> ({len(index.rows)} глаголов)"]
+    lines += [f"{name}: {size / 2 ** 20:.1f} МБ" for name, size in sorted(footprint.items(), key=lambda item: -item[1])]
+    lines += ["",
+              f"Всего: {total / 2 ** 20:.1f} МБ, {total // max(len(index.rows), 1)} байт на глагол",
+              f"Память процесса: {current_rss_mb():.1f} МБ"]
+    await update.message.reply_text("\n".join(lines), reply_markup=get_keyboard(update), parse_mode='HTML')
+
+
+# Выгрузка метрик в формате Prometheus: в файл METRICS_FILE_PATH и/или по HTTP на порту METRICS_PORT
+METRICS_FILE_PATH = os.getenv("METRICS_FILE_PATH")
+METRICS_PORT = os.getenv("METRICS_PORT")
+METRICS_EXPORT_INTERVAL = int(os.getenv("METRICS_EXPORT_INTERVAL", "15"))
+
+
+def write_metrics_file(text):
+    tmp_path = METRICS_FILE_PATH + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, METRICS_FILE_PATH)
+
+
+async def export_metrics_job(context: ContextTypes.DEFAULT_TYPE):
+    await run_read(write_metrics_file, format_prometheus(context.application))
+
+
+# Минимальный HTTP-сервер на asyncio. Маршруты - словарь путь -> async функция(app, request),
+# возвращающая (статус, тип содержимого, тело)
+HTTP_STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+                    413: 'Payload Too Large', 503: 'Service Unavailable'}
+HTTP_MAX_BODY = 1024 * 1024
+HTTP_HOST = os.getenv("HTTP_HOST", "0.0.0.0")
+
+
+async def metrics_route(app, request):
+    return 200, 'text/plain; version=0.0.4; charset=utf-8', format_prometheus(app).encode()
+
+
+http_routes = {'/metrics': metrics_route}
+
+
+async def handle_http(app, routes, reader, writer):
+    try:
+        request_line = (await reader.readline()).decode('latin-1').split()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length') or 0)
+        if len(request_line) < 2:
+            status, content_type, body = 400, 'text/plain', b'bad request'
+        elif length > HTTP_MAX_BODY:
+            status, content_type, body = 413, 'text/plain', b'too large'
+        else:
+            request = {
+                'method': request_line[0],
+                'path': request_line[1].split('?')[0],
+                'headers': headers,
+                'body': await reader.readexactly(length) if length else b'',
+            }
+            route = routes.get(request['path'])
+            if route is None:
+                status, content_type, body = 404, 'text/plain', b'not found'
+            else:
+                status, content_type, body = await route(app, request)
+        head = (f"HTTP/1.1 {status} {HTTP_STATUS_TEXT.get(status, 'OK')}\r\n"
+                f"Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n")
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError) as error:
+        logger.debug("Ошибка HTTP-запроса: %s", error)
+    finally:
+        writer.close()
+
+
+async def start_http_server(app, port, routes=http_routes):
+    server = await asyncio.start_server(lambda reader, writer: handle_http(app, routes, reader, writer), HTTP_HOST, port)
+    logger.info("HTTP-сервер слушает %s:%s", HTTP_HOST, port)
+    return server
+
+
+# Режим получения обновлений: polling (по умолчанию) или webhook. В режиме webhook обновления принимает
+# встроенный HTTP-сервер на WEBHOOK_PORT (там же /metrics и /health). Если задан WEBHOOK_URL - полный
+# публичный адрес, ведущий на WEBHOOK_PATH, - он регистрируется в Telegram; без него сервер можно проверить
+# локально, отправляя POST с JSON обновления и WEBHOOK_SECRET в заголовке X-Telegram-Bot-Api-Secret-Token
+UPDATE_MODE = os.getenv("UPDATE_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or os.getenv("PORT") or "8443")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+
+# Секрет, без которого обновление не принимается: явный WEBHOOK_SECRET, а при регистрации адреса без него -
+# случайный (его знаем только мы и Telegram). Без секрета любой, кто достучится до порта, мог бы прислать
+# обновление от имени администратора, поэтому без WEBHOOK_SECRET и WEBHOOK_URL webhook не запускается
+def webhook_secret():
+    if WEBHOOK_SECRET:
+        return WEBHOOK_SECRET
+    if WEBHOOK_URL:
+        return secrets.token_urlsafe(32)
+    raise SystemExit("Для UPDATE_MODE=webhook без WEBHOOK_URL нужно задать WEBHOOK_SECRET")
+
+
+# Обновление от Telegram: проверяется секрет и сразу ставится в очередь приложения,
+# ответ не ждёт обработки
+async def webhook_route(app, request):
+    if request['method'] != 'POST':
+        return 405, 'text/plain', b'method not allowed'
+    secret = app.bot_data.get('webhook_secret')
+    if not secret or not hmac.compare_digest(request['headers'].get('x-telegram-bot-api-secret-token', ''), secret):
+        metrics.inc('webhook_forbidden')
+        return 403, 'text/plain', b'forbidden'
+    try:
+        update = Update.de_json(json.loads(request['body']), app.bot)
+    except (ValueError, TypeError, KeyError) as error:
+        logger.debug("Некорректное обновление: %s", error)
+        return 400, 'text/plain', b'bad update'
+    await app.update_queue.put(update)
+    metrics.inc('webhook_update')
+    return 200, 'text/plain', b'ok'
+
+
+async def health_route(app, request):
+    body = json.dumps({
+        'status': 'ok' if app.running else 'stopped',
+        'mode': UPDATE_MODE,
+        'uptime_seconds': round(time.perf_counter() - STARTED_AT, 1),
+        'update_queue': app.update_queue.qsize(),
+        'verbs': len(app.bot_data['search_index'].rows),
+    })
+    return (200 if app.running else 503), 'application/json', body.encode()
+
+
+http_routes['/health'] = health_route
+
+
+async def run_webhook(app):
+    app.bot_data['webhook_secret'] = webhook_secret()
+    http_routes[WEBHOOK_PATH] = webhook_route
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    await app.initialize()
+    await post_init(app)
+    try:
+        await app.start()
+        if WEBHOOK_URL:
+            await app.bot.set_webhook(WEBHOOK_URL, secret_token=app.bot_data['webhook_secret'],
+                                      allowed_updates=Update.ALL_TYPES, max_connections=WEBHOOK_MAX_CONNECTIONS)
+        logger.info("Бот ожидает обновлений на порту %s, путь %s", WEBHOOK_PORT, WEBHOOK_PATH)
+        await stop.wait()
+    finally:
+        if app.running:
+            await app.stop()
+            await post_stop(app)
+        await app.shutdown()
+        await post_shutdown(app)
+
+
+# Запись накопленной активности пользователей одной транзакцией
+async def flush_contacts(app):
+    tracker = app.bot_data['contact_tracker']
+    rows = tracker.take_pending()
+    if rows:
+        await run_write(app.bot_data['storage'].touch_contacts, rows)
+        tracker.written += len(rows)
+        logger.info("Контакты сохранены: %d, объединено записей всего: %d", len(rows), tracker.coalesced)
+
+
+async def flush_contacts_job(context: ContextTypes.DEFAULT_TYPE):
+    await flush_contacts(context.application)
+
+
+async def sync_shared_state_job(context: ContextTypes.DEFAULT_TYPE):
+    changed = await run_write(context.bot_data['shared_state'].sync, context.bot_data)
+    if changed:
+        logger.debug("Синхронизировано из базы: %s", ", ".join(sorted(changed)))
+
+
+# Подхват изменений 1_norwegian_verbs.csv без перезапуска. Раз в DICTIONARY_WATCH_INTERVAL секунд
+# сверяются время изменения и размер файла; изменившийся файл обрабатывается, когда они не меняются
+# между двумя проверками (запись файла закончена), и только если изменился хэш содержимого.
+# Файл разбирается в потоке-читателе и сливается со словарём в базе (Storage.merge_verbs): новые
+# инфинитивы добавляются, изменённые строки обновляются, исчезнувшие из файла удаляются (кроме глаголов,
+# добавленных через бота).
+# Если строки изменились, новый индекс строит SharedStateSync и подменяет одним присваиванием,
+# так что начатый запрос до конца видит прежний индекс.
+# При нескольких процессах файл отслеживает только обработчик 0, остальные узнают об изменении из базы
+DICTIONARY_WATCH_INTERVAL = float(os.getenv("DICTIONARY_WATCH_INTERVAL", "5"))
+
+
+class DictionaryWatcher:
+    def __init__(self, path):
+        self.path = path
+        self.seen = self.applied = self.file_stat()
+        self.digest = None  # хэш последнего обработанного содержимого
+
+    def file_stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    # Файл изменился и уже не меняется
+    def settled(self):
+        stat = self.file_stat()
+        if stat != self.seen:
+            self.seen = stat
+            return False
+        if stat is None or stat == self.applied:
+            return False
+        self.applied = stat
+        return True
+
+    # В потоке-читателе: (хэш, строки) или None, если содержимое то же
+    def read(self):
+        digest = file_digest(self.path)
+        if digest is None or digest == self.digest:
+            return None
+        return digest, read_csv_rows(self.path, VERB_COLUMNS)
+
+
+async def watch_dictionary_job(context: ContextTypes.DEFAULT_TYPE):
+    watcher = context.bot_data['dictionary_watcher']
+    if not watcher.settled():
+        return
+    try:
+        changes = await run_read(watcher.read)
+    except (OSError, ValueError) as error:
+        logger.error("Не удалось прочитать %s: %s", watcher.path, error)
+        return
+    if changes is None:
+        return
+    digest, rows = changes
+    if not rows:
+        logger.warning("Файл %s пуст, словарь не изменён", watcher.path)
+        return
+    added, updated, deleted = await run_write(context.bot_data['storage'].merge_verbs, rows, digest)
+    watcher.digest = digest
+    if added or updated or deleted:
+        await run_write(context.bot_data['shared_state'].sync, context.bot_data)
+        metrics.inc('dictionary_reload')
+        logger.info("Словарь обновлён из %s: добавлено строк %d, изменено %d, удалено %d",
+                    watcher.path, added, updated, deleted)
+
+
+# Сохранение user_data между перезапусками. Приложение раз в SESSIONS_FLUSH_INTERVAL секунд передаёт
+# данные пользователей, с которыми было взаимодействие; в базу одной транзакцией уходят только изменившиеся,
+# в формате marshal. Сессии без активности дольше SESSION_TTL_HOURS удаляются и из памяти, и из базы
+SESSIONS_FLUSH_INTERVAL = int(os.getenv("SESSIONS_FLUSH_INTERVAL", "30"))
+SESSION_TTL_HOURS = float(os.getenv("SESSION_TTL_HOURS", "72"))
+SESSION_TRANSIENT_KEYS = ('pager',)  # курсор страниц ссылается на строки индекса конкретного процесса
+
+
+def dump_session(data):
+    data = {key: value for key, value in data.items() if key not in SESSION_TRANSIENT_KEYS}
+    if 'state' in data:
+        data['state'] = State(data['state']).value
+    return marshal.dumps(data) if data else None
+
+
+def load_session(blob):
+    data = marshal.loads(blob)
+    if 'state' in data:
+        data['state'] = State(data['state'])
+    return data
+
+
+class SessionPersistence(BasePersistence):
+    def __init__(self, storage, ttl):
+        super().__init__(PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+                         update_interval=SESSIONS_FLUSH_INTERVAL)
+        self.storage = storage
+        self.ttl = ttl
+        self.saved = {}      # User_ID -> (записанные данные, время записи)
+        self.pending = {}    # User_ID -> данные для записи, None - удалить
+        self.last_seen = {}  # User_ID -> время последнего обращения
+        self.written = 0
+        self.expired = 0
+
+    async def get_user_data(self):
+        rows = await run_read(self.storage.sessions, time.time() - self.ttl)
+        user_data = {}
+        for user_id, blob, updated_at in rows:
+            if worker_owns(user_id):
+                user_data[user_id] = load_session(blob)
+                self.saved[user_id] = (blob, updated_at)
+                self.last_seen[user_id] = updated_at
+        return user_data
+
+    # Неизменившиеся данные переписываются только раз в половину TTL, чтобы сессия не устарела в базе
+    async def update_user_data(self, user_id, data):
+        now = self.last_seen[user_id] = time.time()
+        blob = dump_session(data)
+        saved_blob, saved_at = self.saved.get(user_id, (None, now))
+        if blob != saved_blob or now - saved_at > self.ttl / 2:
+            self.pending[user_id] = blob
+        else:
+            self.pending.pop(user_id, None)
+
+    async def drop_user_data(self, user_id):
+        self.pending[user_id] = None
+        self.last_seen.pop(user_id, None)
+
+    def stale_users(self, now):
+        return [user_id for user_id, seen in self.last_seen.items() if now - seen > self.ttl]
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        now = time.time()
+        rows = [(user_id, blob, now) for user_id, blob in pending.items() if blob is not None]
+        dropped = [user_id for user_id, blob in pending.items() if blob is None]
+        await run_write(self.storage.save_sessions, rows, dropped, now - self.ttl)
+        for user_id, blob in pending.items():
+            if user_id in self.last_seen:
+                self.saved[user_id] = (blob, now)
+            else:
+                self.saved.pop(user_id, None)
+        self.written += len(rows)
+
+    # Остальные данные не сохраняются
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+
+# Сброс давно неактивных сессий и запись накопленных изменений
+async def flush_sessions_job(context: ContextTypes.DEFAULT_TYPE):
+    app = context.application
+    for user_id in app.persistence.stale_users(time.time()):
+        app.drop_user_data(user_id)
+        app.persistence.expired += 1
+    await app.update_persistence()
+    await app.persistence.flush()
+
+
+# Запуск: HTTP-сервер для webhook или для метрик, если задан порт
+async def post_init(app):
+    if UPDATE_MODE == 'webhook':
+        app.bot_data['http_server'] = await start_http_server(app, WEBHOOK_PORT)
+    elif METRICS_PORT:
+        app.bot_data['http_server'] = await start_http_server(app, int(METRICS_PORT))
+    await resume_broadcast(app)
+
+
+# Завершение работы: сохраняем накопленное и дожидаемся фоновых записей
+async def post_stop(app):
+    await stop_broadcast(app)
+    await flush_contacts(app)
+    await fold_analytics_now(app)
+    await flush_quiz(app)
+
+
+async def post_shutdown(app):
+    server = app.bot_data.pop('http_server', None)
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+    write_executor.shutdown(wait=True)
+    read_executor.shutdown(wait=True)
+
+
+# База, словарь с поисковым индексом, предложения и контакты. Загружаются только в процессе, который
+# обрабатывает обновления: диспетчеру при WORKERS > 1 они не нужны
+def load_state():
+    logger.info("Открытие базы данных...")
+    storage = Storage(DB_FILE_PATH)
+    logger.info("Построение поискового индекса...")
+    verb_rows, loaded_state = load_verbs(storage)
+    search_index = build_search_index(verb_rows)
+    logger.info("Загрузка предложений...")
+    return {
+        'storage': storage,
+        'search_index': search_index,
+        'moderation': Moderation(storage, search_index.rows),
+        'contact_tracker': ContactTracker(storage.contacts()),
+        'shared_state': SharedStateSync(loaded_state),
+    }
+
+
+# Сборка приложения
+def build_application(state=None, **builder_options):
+    if state is None:
+        state = load_state()
+    update_processor = PerUserUpdateProcessor(
+        CONCURRENT_UPDATES, RateLimiter(RATE_LIMIT_PER_MINUTE, RATE_LIMIT_BURST, RATE_LIMIT_MAX_USERS))
+    builder = (Application.builder().token(TOKEN).job_queue(JobQueue()).concurrent_updates(update_processor)
+               .persistence(SessionPersistence(state['storage'], SESSION_TTL_HOURS * 3600))
+               .post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown))
+    if 'request' not in builder_options:
+        builder.request(TimedRequest())
+    for name, value in builder_options.items():
+        getattr(builder, name)(value)
+    app = builder.build()
+    app.bot_data.update(state)
+    app.bot_data['response_cache'] = ResponseCache(RESPONSE_CACHE_SIZE)
+    app.bot_data['inline_cache'] = ResponseCache(RESPONSE_CACHE_SIZE)
+    app.bot_data['quiz'] = QuizScheduler(QUIZ_MAX_LOADED_USERS)
+    app.bot_data['broadcast'] = None
+    app.bot_data['analytics'] = Analytics(ANALYTICS_BUFFER_SIZE)
+    app.job_queue.run_repeating(flush_contacts_job, interval=CONTACTS_FLUSH_INTERVAL, first=CONTACTS_FLUSH_INTERVAL)
+    app.job_queue.run_repeating(sync_shared_state_job, interval=SYNC_INTERVAL, first=SYNC_INTERVAL)
+    app.job_queue.run_repeating(flush_sessions_job, interval=SESSIONS_FLUSH_INTERVAL, first=SESSIONS_FLUSH_INTERVAL)
+    app.job_queue.run_repeating(flush_quiz_job, interval=QUIZ_FLUSH_INTERVAL, first=QUIZ_FLUSH_INTERVAL)
+    app.job_queue.run_repeating(fold_analytics_job, interval=ANALYTICS_FOLD_INTERVAL, first=ANALYTICS_FOLD_INTERVAL)
+    app.job_queue.run_repeating(quiz_reminders_job, interval=QUIZ_REMINDER_INTERVAL, first=QUIZ_REMINDER_INTERVAL)
+    app.job_queue.run_repeating(resume_broadcast_job, interval=BROADCAST_OWNER_TIMEOUT, first=BROADCAST_OWNER_TIMEOUT)
+    if DICTIONARY_WATCH_INTERVAL and WORKER_ID in (None, '0'):
+        app.bot_data['dictionary_watcher'] = DictionaryWatcher(VERBS_FILE_PATH)
+        app.job_queue.run_repeating(watch_dictionary_job, interval=DICTIONARY_WATCH_INTERVAL,
+                                    first=DICTIONARY_WATCH_INTERVAL)
+    if METRICS_FILE_PATH:
+        app.job_queue.run_repeating(export_metrics_job, interval=METRICS_EXPORT_INTERVAL, first=METRICS_EXPORT_INTERVAL)
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("add", add_verb))
+    app.add_handler(CommandHandler("export", export_data))
+    app.add_handler(CommandHandler("stats", show_stats))
+    app.add_handler(CommandHandler("memory", show_memory))
+    app.add_handler(CommandHandler("quiz", quiz_command))
+    app.add_handler(CommandHandler("broadcast", broadcast_command))
+    app.add_handler(CommandHandler("top", show_top))
     app.add_handler(MessageHandler(Text() & ~Command(), handle_message))
+    app.add_handler(MessageHandler(Document.ALL, handle_document))
+    app.add_handler(CallbackQueryHandler(handle_page_button, pattern=r'^page:'))
+    app.add_handler(InlineQueryHandler(handle_inline_query))
+    return app
+
+
+# Несколько процессов: при WORKERS > 1 главный процесс (диспетчер) сам получает обновления - polling или
+# webhook на WEBHOOK_PORT - и раздаёт их WORKERS процессам-обработчикам по user_id. Обновления одного
+# пользователя всегда попадают в один процесс и в прежнем порядке, поэтому диалог не теряет user_data.
+# Обработчики - копии этого скрипта в режиме webhook на 127.0.0.1:WORKER_BASE_PORT + i с общей базой;
+# изменения, сделанные другими процессами, они подхватывают через SharedStateSync
+WORKERS = int(os.getenv("WORKERS", "1"))
+WORKER_ID = os.getenv("WORKER_ID")
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", "18000"))
+WORKER_QUEUE_SIZE = 10000
+WORKER_SEND_ATTEMPTS = 30
+POLL_TIMEOUT = 30
+
+
+# Пользователи, чьи обновления диспетчер направляет в этот процесс
+def worker_owns(user_id):
+    return WORKER_ID is None or user_id % WORKERS == int(WORKER_ID)
+
+
+class Dispatcher:
+    def __init__(self, workers):
+        self.secret = secrets.token_urlsafe(32)  # для передачи обновлений обработчикам
+        self.webhook_secret = webhook_secret() if UPDATE_MODE == 'webhook' else None
+        self.processes = [None] * workers
+        self.queues = [asyncio.Queue(WORKER_QUEUE_SIZE) for _ in range(workers)]
+        self.stop = asyncio.Event()
+
+    def worker_env(self, worker_id):
+        env = dict(os.environ, WORKER_ID=str(worker_id), UPDATE_MODE='webhook', WEBHOOK_URL='',
+                   WEBHOOK_PORT=str(WORKER_BASE_PORT + worker_id), WEBHOOK_SECRET=self.secret,
+                   HTTP_HOST='127.0.0.1')
+        env.pop('METRICS_PORT', None)
+        if METRICS_FILE_PATH:
+            env['METRICS_FILE_PATH'] = f"{METRICS_FILE_PATH}.{worker_id}"
+        return env
+
+    # Процесс-обработчик; упавший перезапускается
+    async def run_worker(self, worker_id):
+        while not self.stop.is_set():
+            process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__),
+                                                           env=self.worker_env(worker_id))
+            self.processes[worker_id] = process
+            logger.info("Обработчик %d запущен, pid %d", worker_id, process.pid)
+            code = await process.wait()
+            if not self.stop.is_set():
+                metrics.inc('worker_restart')
+                logger.error("Обработчик %d завершился с кодом %s, перезапуск", worker_id, code)
+                await asyncio.sleep(1)
+
+    def route(self, user, body):
+        worker_id = (user.id if user else 0) % len(self.queues)
+        try:
+            self.queues[worker_id].put_nowait(body)
+        except asyncio.QueueFull:
+            metrics.inc('dispatch_dropped')
+            logger.warning("Очередь обработчика %d переполнена, обновление отброшено", worker_id)
+
+    # Одна задача на обработчик: обновления уходят строго по очереди
+    async def send_updates(self, client, worker_id):
+        url = f"http://127.0.0.1:{WORKER_BASE_PORT + worker_id}{WEBHOOK_PATH}"
+        headers = {'X-Telegram-Bot-Api-Secret-Token': self.secret, 'Content-Type': 'application/json'}
+        queue = self.queues[worker_id]
+        while True:
+            body = await queue.get()
+            for _ in range(WORKER_SEND_ATTEMPTS):
+                try:
+                    response = await client.post(url, content=body, headers=headers)
+                    if response.status_code == 200:
+                        metrics.inc('dispatch_sent')
+                        break
+                    logger.warning("Обработчик %d ответил %d", worker_id, response.status_code)
+                except httpx.HTTPError as error:
+                    logger.debug("Обработчик %d недоступен: %s", worker_id, error)
+                await asyncio.sleep(1)
+            else:
+                metrics.inc('dispatch_dropped')
+                logger.error("Обработчик %d не принял обновление", worker_id)
+
+    async def poll(self, bot):
+        await bot.delete_webhook()
+        offset = None
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT, allowed_updates=Update.ALL_TYPES)
+            except TelegramError as error:
+                logger.warning("Ошибка получения обновлений: %s", error)
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                self.route(update.effective_user, update.to_json().encode())
+
+    async def webhook_route(self, app, request):
+        if request['method'] != 'POST':
+            return 405, 'text/plain', b'method not allowed'
+        secret = self.webhook_secret
+        if not secret or not hmac.compare_digest(request['headers'].get('x-telegram-bot-api-secret-token', ''), secret):
+            metrics.inc('webhook_forbidden')
+            return 403, 'text/plain', b'forbidden'
+        try:
+            update = Update.de_json(json.loads(request['body']), None)
+        except (ValueError, TypeError, KeyError) as error:
+            logger.debug("Некорректное обновление: %s", error)
+            return 400, 'text/plain', b'bad update'
+        self.route(update.effective_user, request['body'])
+        return 200, 'text/plain', b'ok'
+
+    async def health_route(self, app, request):
+        workers = [{'id': worker_id,
+                    'pid': process.pid if process else None,
+                    'alive': process is not None and process.returncode is None,
+                    'queue': self.queues[worker_id].qsize()}
+                   for worker_id, process in enumerate(self.processes)]
+        healthy = all(worker['alive'] for worker in workers)
+        body = json.dumps({
+            'status': 'ok' if healthy else 'degraded',
+            'mode': UPDATE_MODE,
+            'uptime_seconds': round(time.perf_counter() - STARTED_AT, 1),
+            'workers': workers,
+        })
+        return (200 if healthy else 503), 'application/json', body.encode()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stop.set)
+        routes = {'/health': self.health_route}
+        server = None
+        if UPDATE_MODE == 'webhook':
+            routes[WEBHOOK_PATH] = self.webhook_route
+            server = await start_http_server(self, WEBHOOK_PORT, routes)
+        elif METRICS_PORT:
+            server = await start_http_server(self, int(METRICS_PORT), routes)
+        bot = Bot(TOKEN, get_updates_request=HTTPXRequest(read_timeout=POLL_TIMEOUT + 10))
+        async with bot, httpx.AsyncClient(timeout=10) as client:
+            tasks = [asyncio.create_task(self.run_worker(worker_id)) for worker_id in range(len(self.queues))]
+            tasks += [asyncio.create_task(self.send_updates(client, worker_id)) for worker_id in range(len(self.queues))]
+            if UPDATE_MODE == 'webhook':
+                if WEBHOOK_URL:
+                    await bot.set_webhook(WEBHOOK_URL, secret_token=self.webhook_secret,
+                                          allowed_updates=Update.ALL_TYPES, max_connections=WEBHOOK_MAX_CONNECTIONS)
+            else:
+                tasks.append(asyncio.create_task(self.poll(bot)))
+            logger.info("Диспетчер запущен, обработчиков: %d", len(self.queues))
+            await self.stop.wait()
+            if server is not None:
+                server.close()
+            for process in self.processes:
+                if process is not None and process.returncode is None:
+                    process.terminate()
+            await asyncio.gather(*(process.wait() for process in self.processes if process is not None))
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# Запуск бота
+def main():
+    if WORKERS > 1 and WORKER_ID is None:
+        logger.info("Запуск диспетчера на %d процессов...", WORKERS)
+        asyncio.run(Dispatcher(WORKERS).run())
+        return
+    logger.info("Инициализация бота...")
+    app = build_application()
+    if UPDATE_MODE == 'webhook':
+        asyncio.run(run_webhook(app))
+        return
+    logger.info("Бот запущен и ожидает сообщений...")
     app.run_polling()
 
 
 if __name__ == '__main__':
-    print("Запуск программы...")
+    logger.info("Запуск программы...")
     main()